@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    bench_listing.py
+    Benchmark for building the plugin listings (albums, artists, tracks) from a synthetic library
+
+    Runs outside of Kodi with minimal stand-ins for the Kodi modules, the python requests module is needed.
+    Usage: python benchmarks/bench_listing.py [--sizes 1000,10000,100000] [--call-overhead 20]
+    The call overhead (in microseconds) simulates the cost of crossing the python/C++ boundary per call
+    to xbmcplugin.addDirectoryItem(s).
+'''
+
+import sys
+import time
+import argparse
+from kodistubs import install_kodi_stubs, CALLS, CALL_OVERHEAD, SETTINGS
+from lmsemulator import SyntheticLibrary
+
+
+def run(sizes, actions):
+    '''time the listing actions for each size'''
+    from lmsserver import LMSServer
+    from plugin_content import PluginContent
+
+    class BenchPluginContent(PluginContent):
+        '''plugin content without the kodi entry point'''
+
+        def __init__(self, lmsserver, action):
+            self.lmsserver = lmsserver
+            self.addon = sys.modules["xbmcaddon"].Addon()
+            self.params = {"action": action}
+            self.listitems = []
+
+    # the complete listings are built, not a page
+    for listing in ("albums", "artists", "tracks"):
+        SETTINGS["paged_%s" % listing] = "false"
+    print "%-10s %10s %12s %12s %10s" % ("action", "items", "seconds", "items/sec", "kodi calls")
+    for size in sizes:
+        lmsserver = LMSServer("127.0.0.1", 9000, "aa:bb:cc:dd:ee:ff")
+        library = SyntheticLibrary(size, albums=size, artists=size)
+        lmsserver.send_request = lambda cmd, library=library: library.handle(LMSServer.split_cmd(cmd))
+        # the full track details are served as one batch
+        lmsserver.send_batch = lambda cmds: [{"songinfo_loop": [{"comment": "synthetic"}]} for cmd in cmds]
+        for action in actions:
+            CALLS["addDirectoryItem"] = CALLS["addDirectoryItems"] = 0
+            start = time.time()
+            BenchPluginContent(lmsserver, action).main()
+            duration = time.time() - start
+            print "%-10s %10s %12.3f %12.0f %10s" % (action, size, duration, size / duration,
+                                                    CALLS["addDirectoryItem"] + CALLS["addDirectoryItems"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the plugin listing construction")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated number of items")
+    parser.add_argument("--actions", default="albums,artists,tracks", help="comma separated plugin actions")
+    parser.add_argument("--call-overhead", type=float, default=0, help="simulated microseconds per kodi call")
+    args = parser.parse_args()
+    CALL_OVERHEAD[0] = args.call_overhead / 1000000.0
+    install_kodi_stubs()
+    run([int(size) for size in args.sizes.split(",")], args.actions.split(","))
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    bench_proxy.py
+    Benchmark for the silence stream of the http proxy: throughput and cpu time per served track
+
+    Runs outside of Kodi with minimal stand-ins for the Kodi modules, the python six module is needed.
+    Usage: python benchmarks/bench_proxy.py [--duration 600] [--clients 1,4] [--seeks 200] [--streams 10,50,200]
+    The generator test compares the previous per-chunk allocating generator with the current one,
+    the http test downloads the track from a running proxy with concurrent clients,
+    the seek test measures the time from a range request to the first audio bytes at that offset and
+    the capacity test opens many slowly read streams at once. The http tests run for each proxy engine.
+'''
+
+import os
+import time
+import random
+import socket
+import argparse
+import threading
+from kodistubs import install_kodi_stubs
+
+
+def legacy_stream(filesize, wave_header=None, max_buffer_size=8196):
+    '''the previous implementation: a new string for every chunk'''
+    bytes_written = 0
+    if wave_header is not None:
+        bytes_written = len(wave_header)
+        yield wave_header
+    while bytes_written < filesize:
+        if bytes_written + max_buffer_size < filesize:
+            yield '\0' * max_buffer_size
+            bytes_written += max_buffer_size
+        else:
+            yield '\0' * (filesize - bytes_written)
+            bytes_written = filesize
+
+
+def cpu_time():
+    '''user + system time of this process'''
+    times = os.times()
+    return times[0] + times[1]
+
+
+def measure(func):
+    '''run func and return the result, wall time and cpu time'''
+    start_wall, start_cpu = time.time(), cpu_time()
+    result = func()
+    return result, time.time() - start_wall, cpu_time() - start_cpu
+
+
+def consume(stream):
+    '''exhaust the generator like the webserver would do, return the number of bytes'''
+    total = 0
+    chunks = 0
+    for chunk in stream:
+        total += len(chunk)
+        chunks += 1
+    return total, chunks
+
+
+def bench_generator(duration, rounds):
+    '''compare the stream generators without any network io'''
+    from httpproxy import Track
+    track = Track(["127.0.0.1"])
+    print "%-10s %8s %10s %10s %10s %10s" % ("generator", "chunks", "MB", "seconds", "MB/s", "cpu sec")
+    for name, factory in [("legacy", lambda size, header: legacy_stream(size, header)),
+                          ("current", lambda size, header: track.send_audio_stream(0, size, header))]:
+        def run():
+            for _ in range(rounds):
+                header, filesize = track._get_wave_header(duration)
+                total, chunks = consume(factory(filesize, header))
+            return total, chunks
+        (total, chunks), wall, cpu = measure(run)
+        megabytes = total * rounds / 1048576.0
+        print "%-10s %8s %10.1f %10.3f %10.0f %10.3f" % (name, chunks, megabytes, wall, megabytes / wall, cpu)
+
+
+def download(host, port, path, results):
+    '''fetch the path with a raw socket and store the number of received bytes'''
+    sock = socket.create_connection((host, port))
+    sock.sendall("GET %s HTTP/1.1\r\nHost: %s:%s\r\nConnection: close\r\n\r\n" % (path, host, port))
+    total = 0
+    while True:
+        data = sock.recv(262144)
+        if not data:
+            break
+        total += len(data)
+    sock.close()
+    results.append(total)
+
+
+def start_proxy(engine):
+    '''start the proxy with the given webserver engine'''
+    from httpproxy import ProxyRunner
+    proxy = ProxyRunner(host="127.0.0.1", allow_ranges=True, engine=engine)
+    proxy.daemon = True
+    proxy.start()
+    proxy.ready_wait()
+    return proxy
+
+
+def bench_http(engine, duration, clients_list):
+    '''download the track from a running proxy with concurrent clients'''
+    proxy = start_proxy(engine)
+    path = "/track/%s" % duration
+    print "%-10s %8s %10s %10s %10s %10s" % ("http", "clients", "MB", "seconds", "MB/s", "cpu sec")
+    try:
+        for clients in clients_list:
+            results = []
+
+            def run():
+                threads = [threading.Thread(target=download, args=(proxy.get_host(), proxy.get_port(), path, results))
+                           for _ in range(clients)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            _, wall, cpu = measure(run)
+            megabytes = sum(results) / 1048576.0
+            print "%-10s %8s %10.1f %10.3f %10.0f %10.3f" % (engine, clients, megabytes, wall, megabytes / wall, cpu)
+    finally:
+        proxy.stop()
+
+
+def seek(host, port, path, offset, length, expected):
+    '''request the range like kodi does on a seek, return the latency and if the content is correct'''
+    start = time.time()
+    sock = socket.create_connection((host, port))
+    sock.sendall("GET %s HTTP/1.1\r\nHost: %s:%s\r\nRange: bytes=%s-\r\n\r\n" % (path, host, port, offset))
+    data = ""
+    while "\r\n\r\n" not in data or len(data.split("\r\n\r\n", 1)[1]) < length:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    latency = time.time() - start
+    sock.close()
+    headers, body = data.split("\r\n\r\n", 1)
+    content_range = [line for line in headers.split("\r\n") if line.lower().startswith("content-range")]
+    correct = (headers.startswith("HTTP/1.1 206") and body[:length] == expected and
+               content_range and content_range[0].split(" ")[-1].startswith("%s-" % offset))
+    return latency, bool(correct)
+
+
+def bench_seek(engine, duration, seeks, length=65536):
+    '''seek to random positions in the track, the start of the file contains the wave header'''
+    from httpproxy import Track
+    proxy = start_proxy(engine)
+    header, filesize = Track(["127.0.0.1"])._get_wave_header(duration)
+    offsets = [random.randint(0, 100) for _ in range(seeks / 10)]
+    offsets += [random.randint(0, filesize - length) for _ in range(seeks - len(offsets))]
+    latencies = []
+    correct = 0
+    try:
+        for offset in offsets:
+            expected = (header + "\0" * (offset + length))[offset:offset + length]
+            latency, is_correct = seek(proxy.get_host(), proxy.get_port(), "/track/%s" % duration,
+                                       offset, length, expected)
+            latencies.append(latency * 1000)
+            correct += is_correct
+    finally:
+        proxy.stop()
+    latencies.sort()
+    print "%-10s %8s %10s %10s %10s" % ("seek", "requests", "median ms", "p95 ms", "correct")
+    print "%-10s %8s %10.2f %10.2f %10s" % (engine, seeks, latencies[len(latencies) / 2],
+                                             latencies[int(len(latencies) * 0.95)], correct)
+
+
+def rss_kb():
+    '''resident memory of this process in kB (linux only)'''
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+def bench_capacity(engine, duration, streams_list, wait=3.0, read_size=16384):
+    '''open many streams at once which are read slowly like a player does, count the served streams'''
+    proxy = start_proxy(engine)
+    print "%-10s %8s %10s %10s %10s" % ("capacity", "streams", "served", "threads", "rss kB")
+    try:
+        for streams in streams_list:
+            threads_before, rss_before = threading.active_count(), rss_kb()
+            socks = []
+            for index in range(streams):
+                sock = socket.create_connection((proxy.get_host(), proxy.get_port()))
+                sock.sendall("GET /track/%s?seq=%s HTTP/1.1\r\nHost: %s\r\n\r\n" % (duration, index, proxy.get_host()))
+                sock.setblocking(0)
+                socks.append(sock)
+            served = set()
+            end = time.time() + wait
+            while time.time() < end:
+                for sock in socks:
+                    try:
+                        data = sock.recv(read_size)
+                    except socket.error:
+                        continue
+                    if data.startswith("HTTP/1.1 "):
+                        served.add(sock)
+                time.sleep(0.1)
+            print "%-10s %8s %10s %10s %10s" % (engine, streams, len(served), threading.active_count() - threads_before,
+                                                rss_kb() - rss_before)
+            for sock in socks:
+                sock.close()
+            time.sleep(1)
+    finally:
+        proxy.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the silence stream of the http proxy")
+    parser.add_argument("--duration", type=int, default=600, help="track duration in seconds")
+    parser.add_argument("--rounds", type=int, default=5, help="number of streams for the generator test")
+    parser.add_argument("--clients", default="1,4", help="comma separated number of concurrent http clients")
+    parser.add_argument("--seeks", type=int, default=200, help="number of range requests for the seek test")
+    parser.add_argument("--streams", default="10,50,200", help="comma separated number of concurrent streams")
+    parser.add_argument("--engines", default="eventloop,threaded", help="comma separated proxy engines")
+    parser.add_argument("--skip-http", action="store_true", help="only run the generator test")
+    args = parser.parse_args()
+    install_kodi_stubs()
+    bench_generator(args.duration, args.rounds)
+    if not args.skip_http:
+        for proxy_engine in args.engines.split(","):
+            bench_http(proxy_engine, args.duration, [int(item) for item in args.clients.split(",")])
+            bench_seek(proxy_engine, args.duration, args.seeks)
+            bench_capacity(proxy_engine, args.duration, [int(item) for item in args.streams.split(",")])
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    kodistubs.py
+    Minimal stand-ins for the Kodi modules so the addon code can be benchmarked outside of Kodi
+'''
+
+import os
+import sys
+import time
+import types
+import tempfile
+import xml.etree.ElementTree as ET
+
+ADDON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ADDON_DIR, "resources", "lib"))
+
+CALLS = {"addDirectoryItem": 0, "addDirectoryItems": 0}
+CALL_OVERHEAD = [0.0]
+# the window properties (set by the service in kodi) and the addon settings, shared by all instances
+WINDOW_PROPS = {}
+SETTINGS = {}
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), "plugin.audio.squeezebox-bench")
+
+
+def load_default_settings():
+    '''the default values of the settings of the addon'''
+    tree = ET.parse(os.path.join(ADDON_DIR, "resources", "settings.xml"))
+    for setting in tree.iter("setting"):
+        if setting.get("id"):
+            SETTINGS[setting.get("id")] = setting.get("default", "")
+
+
+def busy_wait(seconds):
+    '''simulate time spent in kodi without releasing the cpu'''
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class PlayListItem(object):
+    '''an entry of the kodi playlist'''
+
+    def __init__(self, filename, listitem):
+        self.filename = filename
+        self.listitem = listitem
+
+    def getfilename(self):
+        return self.filename
+
+    def setProperty(self, key, value):
+        if self.listitem is not None:
+            self.listitem.data[key] = value
+
+
+class PlayList(object):
+    '''the music playlist of kodi, a single instance like in kodi'''
+    _items = []
+    _position = [-1]
+
+    def __init__(self, playlist_id=0):
+        pass
+
+    def add(self, url, listitem=None, index=-1):
+        if index < 0:
+            index = len(self._items)
+        self._items.insert(index, PlayListItem(url, listitem))
+        busy_wait(CALL_OVERHEAD[0])
+
+    def remove(self, filename):
+        for item in self._items:
+            if item.filename == filename:
+                self._items.remove(item)
+                break
+        busy_wait(CALL_OVERHEAD[0])
+
+    def clear(self):
+        del self._items[:]
+        self._position[0] = -1
+
+    def getposition(self):
+        return self._position[0]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+
+def install_kodi_stubs():
+    '''install minimal stand-ins for the kodi modules used by the plugin'''
+    xbmc = types.ModuleType("xbmc")
+    xbmc.LOGDEBUG, xbmc.LOGNOTICE, xbmc.LOGWARNING, xbmc.LOGERROR = 0, 2, 3, 4
+    xbmc.ISO_639_1 = 0
+    xbmc.log = lambda msg, level=0: None
+    xbmc.getInfoLabel = lambda label: "17.0" if label == "System.BuildVersion" else ""
+    xbmc.getLanguage = lambda fmt=None: "en"
+    xbmc.getLocalizedString = lambda string_id: "string %s" % string_id
+    xbmc.getCondVisibility = lambda cond: False
+    xbmc.executebuiltin = lambda cmd: None
+    xbmc.sleep = lambda msec: None
+    xbmc.Monitor = type("Monitor", (object,), {"abortRequested": lambda self: False,
+                                               "waitForAbort": lambda self, timeout=0: False})
+    xbmc.Player = type("Player", (object,), {"__init__": lambda self: None})
+    xbmc.PLAYLIST_MUSIC = 0
+    xbmc.translatePath = lambda path: path
+    xbmc.PlayList = PlayList
+
+    class ListItem(object):
+        '''stores everything that is set on the listitem'''
+
+        def __init__(self, label="", iconImage="", **kwargs):
+            self.label = label
+            self.data = {}
+
+        def __getattr__(self, name):
+            def setter(*args, **kwargs):
+                self.data[name] = args
+            return setter
+
+    xbmcgui = types.ModuleType("xbmcgui")
+    xbmcgui.ListItem = ListItem
+    xbmcgui.Window = type("Window", (object,), {"__init__": lambda self, win_id: None,
+                                                "getProperty": lambda self, key: WINDOW_PROPS.get(key, ""),
+                                                "setProperty": lambda self, key, value: WINDOW_PROPS.update(
+                                                    {key: value}),
+                                                "clearProperty": lambda self, key: WINDOW_PROPS.pop(key, None)})
+
+    def add_directory_item(handle, url, listitem, isFolder=False, totalItems=0):
+        CALLS["addDirectoryItem"] += 1
+        busy_wait(CALL_OVERHEAD[0])
+
+    def add_directory_items(handle, items, totalItems=0):
+        CALLS["addDirectoryItems"] += 1
+        busy_wait(CALL_OVERHEAD[0])
+
+    xbmcplugin = types.ModuleType("xbmcplugin")
+    xbmcplugin.SORT_METHOD_UNSORTED = 0
+    xbmcplugin.addDirectoryItem = add_directory_item
+    xbmcplugin.addDirectoryItems = add_directory_items
+    xbmcplugin.endOfDirectory = lambda handle, **kwargs: None
+    xbmcplugin.setContent = lambda handle, content: None
+    xbmcplugin.setProperty = lambda handle, key, value: None
+    xbmcplugin.addSortMethod = lambda handle, method: None
+
+    xbmcaddon = types.ModuleType("xbmcaddon")
+    xbmcaddon.Addon = type("Addon", (object,), {"__init__": lambda self, id=None: None,
+                                                "getSetting": lambda self, key: SETTINGS.get(key, ""),
+                                                "setSetting": lambda self, key, value: SETTINGS.update(
+                                                    {key: value}),
+                                                "getAddonInfo": lambda self, key: PROFILE_DIR if key == "profile"
+                                                else "plugin.audio.squeezebox",
+                                                "getLocalizedString": lambda self, string_id: "%s" % string_id})
+    xbmcvfs = types.ModuleType("xbmcvfs")
+    xbmcvfs.exists = os.path.exists
+    xbmcvfs.mkdirs = os.makedirs
+
+    simplecache = types.ModuleType("simplecache")
+    simplecache.SimpleCache = type("SimpleCache", (object,), {"get": lambda self, key, **kwargs: None,
+                                                              "set": lambda self, key, data, **kwargs: None})
+
+    load_default_settings()
+    for module in [xbmc, xbmcgui, xbmcplugin, xbmcaddon, xbmcvfs, simplecache]:
+        sys.modules[module.__name__] = module
+    # the plugin reads its handle and params from the commandline
+    sys.argv = ["plugin://plugin.audio.squeezebox/", "1", ""]
@@ -0,0 +1,415 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    lmsemulator.py
+    Stand-in for a Logitech Media Server with a synthetic library, for benchmarks without a real server
+
+    Serves /jsonrpc.js (status, songinfo, albums, artists, tracks/titles, menu, favorites and the basic player
+    commands), the artwork urls and the udp discovery on port 3483 (or a free port if 3483 is in use).
+    Usage: python benchmarks/lmsemulator.py [--size 10000] [--latency 20] [--jitter 5] [--port 9000]
+'''
+
+import json
+import random
+import socket
+import threading
+import time
+import argparse
+import BaseHTTPServer
+import SocketServer
+
+DISCOVERY_PORT = 3483
+SERVER_NAME = "LMS Emulator"
+SERVER_UUID = "00000000-0000-0000-0000-0000000e6a11"
+GENRES = ("Rock", "Jazz", "Classical", "Pop", "Electronic", "Folk")
+# how json-rpc batches are answered: with a list of results, with an error object, or the connection is dropped
+# without a response (what the server does, it finds no method in an array body)
+BATCHES_SUPPORTED = "supported"
+BATCHES_ERROR = "error"
+BATCHES_DROP = "drop"
+
+
+class SyntheticLibrary(object):
+    '''a music library of generated tracks, albums and artists and the state of one player'''
+
+    def __init__(self, tracks=1000, albums=None, artists=None, queue_size=100, favorites=50):
+        self.num_tracks = tracks
+        self.num_albums = albums or max(1, tracks / 10)
+        self.num_artists = artists or max(1, self.num_albums / 5)
+        self.num_favorites = favorites
+        self.lock = threading.Lock()
+        self.player = {"mode": "play", "time": 0.0, "started": time.time(), "power": 1,
+                       "index": 0, "queue": range(min(queue_size, tracks))}
+
+    def track(self, track_id):
+        '''the basic details of a track'''
+        album_id = track_id % self.num_albums
+        return {"id": track_id, "title": "Track %s" % track_id, "artist": "Artist %s" % self.album_artist(album_id),
+                "artist_id": self.album_artist(album_id), "album": "Album %s" % album_id, "album_id": album_id,
+                "duration": 180 + track_id % 120, "tracknum": track_id / self.num_albums % 20 + 1,
+                "genre": GENRES[album_id % len(GENRES)], "coverid": "c%s" % album_id,
+                "artwork_track_id": "c%s" % album_id, "year": 1960 + album_id % 60,
+                "url": "file:///music/album%s/track%s.flac" % (album_id, track_id), "remote": 0}
+
+    def album_artist(self, album_id):
+        '''the artist id of an album'''
+        return album_id % self.num_artists
+
+    def album(self, album_id):
+        '''the details of an album'''
+        return {"id": album_id, "album": "Album %s" % album_id, "artist": "Artist %s" % self.album_artist(album_id),
+                "artist_id": self.album_artist(album_id), "year": 1960 + album_id % 60,
+                "artwork_track_id": "c%s" % album_id}
+
+    @staticmethod
+    def parse(cmd):
+        '''split a command in the positional params and the tagged (key:value) params'''
+        positional = []
+        tagged = {}
+        for param in cmd:
+            param = "%s" % param
+            if ":" in param and not param.startswith("http") and not param.startswith("file"):
+                key, value = param.split(":", 1)
+                tagged[key] = value
+            else:
+                positional.append(param)
+        return positional, tagged
+
+    @staticmethod
+    def page(items, start, count, loop_key):
+        '''a page of a listing in the format of the server'''
+        try:
+            start = int(start)
+            count = int(count)
+        except ValueError:
+            start, count = 0, len(items)
+        return {"count": len(items), loop_key: items[start:start + count]}
+
+    def handle(self, cmd):
+        '''the result for a command of the json-rpc slim.request'''
+        positional, tagged = self.parse(cmd)
+        verb = positional[0] if positional else ""
+        args = positional[1:] + ["0", "100000"]
+        if verb == "albums":
+            ids = range(self.num_albums)
+            if "artist_id" in tagged:
+                ids = [album_id for album_id in ids if self.album_artist(album_id) == int(tagged["artist_id"])]
+            return self.page([self.album(album_id) for album_id in ids], args[0], args[1], "albums_loop")
+        if verb == "artists":
+            return self.page([{"id": artist_id, "artist": "Artist %s" % artist_id}
+                              for artist_id in range(self.num_artists)], args[0], args[1], "artists_loop")
+        if verb in ("tracks", "titles"):
+            if "track_id" in tagged:
+                ids = [int(track_id) for track_id in tagged["track_id"].split(",")]
+            elif "album_id" in tagged:
+                ids = range(int(tagged["album_id"]), self.num_tracks, self.num_albums)
+            else:
+                ids = range(self.num_tracks)
+            return self.page([self.track(track_id) for track_id in ids], args[0], args[1], "titles_loop")
+        if verb == "songinfo":
+            return self.songinfo(tagged)
+        if verb == "status":
+            return self.status(positional)
+        if verb == "menu":
+            return {"count": len(MENU), "item_loop": MENU}
+        if verb == "favorites":
+            return self.favorites(positional, tagged)
+        if verb == "serverstatus":
+            return {"lastscan": "1500000000", "info total songs": self.num_tracks, "version": "7.9.1"}
+        if verb == "playlist":
+            return self.playlist(positional)
+        return self.player_command(verb, positional)
+
+    def songinfo(self, tagged):
+        '''the full details of a track as the weird list of single key dicts'''
+        if "track_id" in tagged:
+            track_id = int(tagged["track_id"])
+        else:
+            try:
+                track_id = int(tagged.get("url", "").split("track")[-1].split(".")[0])
+            except ValueError:
+                return {"count": 0, "songinfo_loop": []}
+        details = self.track(track_id)
+        details.update({"comment": "synthetic track", "rating": 60, "lastUpdated": 1500000000,
+                        "lyrics": "", "bitrate": "900kbps VBR", "samplerate": 44100})
+        return {"count": len(details), "songinfo_loop": [{key: value} for key, value in details.iteritems()]}
+
+    def favorites(self, positional, tagged):
+        '''the favorites: tracks and a folder with more favorites'''
+        items = []
+        for fav_id in range(self.num_favorites):
+            if fav_id % 10 == 9:
+                items.append({"id": "fav%s" % fav_id, "name": "Folder %s" % fav_id, "isaudio": 0, "hasitems": 1})
+            else:
+                track_id = fav_id * 7 % self.num_tracks
+                items.append({"id": "fav%s" % fav_id, "name": "Favorite %s" % fav_id, "isaudio": 1,
+                              "hasitems": 0, "type": "audio", "url": self.track(track_id)["url"]})
+        return self.page(items, positional[2] if len(positional) > 2 else 0,
+                         positional[3] if len(positional) > 3 else 100000, "loop_loop")
+
+    def status(self, positional):
+        '''the status of the player with (a part of) the queue'''
+        with self.lock:
+            player = dict(self.player)
+            queue = list(player["queue"])
+        cur_time = player["time"]
+        if player["mode"] == "play":
+            cur_time += time.time() - player["started"]
+        status = {"mode": player["mode"], "time": cur_time, "power": player["power"], "rate": 1,
+                  "playlist_cur_index": player["index"], "playlist_tracks": len(queue),
+                  "mixer volume": 50, "playlist repeat": 0, "playlist shuffle": 0}
+        if queue:
+            status["duration"] = self.track(queue[player["index"]])["duration"]
+        if len(positional) > 1 and positional[1] == "-":
+            # the current track only
+            entries = [(player["index"], queue[player["index"]])] if queue else []
+        else:
+            start = int(positional[1]) if len(positional) > 1 else 0
+            count = int(positional[2]) if len(positional) > 2 else 1
+            entries = list(enumerate(queue))[start:start + count]
+        loop = []
+        for index, track_id in entries:
+            item = self.track(track_id)
+            item["playlist index"] = index
+            loop.append(item)
+        status["playlist_loop"] = loop
+        return status
+
+    def playlist(self, positional):
+        '''the playlist commands'''
+        with self.lock:
+            player = self.player
+            if positional[1:] == ["tracks", "?"]:
+                return {"_tracks": len(player["queue"])}
+            if positional[1:] == ["index", "?"]:
+                return {"_index": player["index"]}
+            if len(positional) > 2 and positional[1] == "index":
+                index = positional[2]
+                if index[0] in "+-":
+                    index = player["index"] + int(index)
+                player["index"] = max(0, min(int(index), len(player["queue"]) - 1))
+                player["time"], player["started"] = 0.0, time.time()
+            elif positional[1:] == ["clear"]:
+                player["queue"] = []
+                player["index"] = 0
+            elif len(positional) > 3 and positional[1] == "move":
+                src, dst = int(positional[2]), int(positional[3])
+                player["queue"].insert(dst, player["queue"].pop(src))
+            elif len(positional) > 2 and positional[1] == "delete":
+                del player["queue"][int(positional[2])]
+        return {}
+
+    def player_command(self, verb, positional):
+        '''the player state commands'''
+        with self.lock:
+            player = self.player
+            if verb == "play":
+                player["mode"], player["started"] = "play", time.time()
+            elif verb == "stop":
+                player["mode"], player["time"] = "stop", 0.0
+            elif verb == "pause":
+                pause = positional[1] == "1" if len(positional) > 1 else player["mode"] == "play"
+                if pause and player["mode"] == "play":
+                    player["time"] += time.time() - player["started"]
+                    player["mode"] = "pause"
+                elif not pause:
+                    player["mode"], player["started"] = "play", time.time()
+            elif verb == "time" and len(positional) > 1 and positional[1] != "?":
+                player["time"], player["started"] = float(positional[1]), time.time()
+            elif verb == "power" and len(positional) > 1 and positional[1] != "?":
+                player["power"] = int(positional[1])
+            elif verb == "time":
+                return {"_time": player["time"]}
+        return {}
+
+    def set_queue(self, track_ids, index=0):
+        '''replace the queue of the player'''
+        with self.lock:
+            self.player["queue"] = list(track_ids)
+            self.player["index"] = index
+
+
+def menu_item(item_id, text, node, weight, **kwargs):
+    '''an entry of the home menu'''
+    item = {"id": item_id, "text": text, "node": node, "weight": weight}
+    item.update(kwargs)
+    return item
+
+
+MENU = [
+    menu_item("myMusic", "My Music", "home", 11, isANode=1),
+    menu_item("myMusicAlbums", "Albums", "myMusic", 20,
+              actions={"go": {"cmd": ["browselibrary", "items"], "params": {"mode": "albums", "menu": "1"}}}),
+    menu_item("myMusicArtists", "Artists", "myMusic", 10,
+              actions={"go": {"cmd": ["browselibrary", "items"], "params": {"mode": "artists", "menu": "1"}}}),
+    menu_item("myMusicTracks", "Tracks", "myMusic", 30,
+              actions={"go": {"cmd": ["browselibrary", "items"], "params": {"mode": "tracks", "menu": "1"}}}),
+    menu_item("radios", "Radio", "home", 20, actions={"go": {"cmd": ["radios"], "params": {"menu": "radio"}}}),
+    menu_item("favorites", "Favorites", "home", 100,
+              actions={"go": {"cmd": ["favorites", "items"], "params": {"menu": "favorites"}}}),
+    menu_item("globalSearch", "Search", "home", 110, actions={"go": {"cmd": ["globalsearch", "items"]}}),
+]
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''the json-rpc and artwork requests'''
+    protocol_version = "HTTP/1.1"
+    # the headers are written unbuffered, with nagle and delayed acks every keep-alive request waits ~40ms
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.emulator.delay()
+        if self.path.startswith("/jsonrpc.js"):
+            self.jsonrpc()
+        elif self.path.startswith("/music/") or self.path.startswith("/imageproxy/"):
+            self.respond(200, self.server.emulator.artwork, "image/png")
+        else:
+            self.respond(404, "", "text/plain")
+
+    do_POST = do_GET
+
+    def jsonrpc(self):
+        '''answer a single or a batch of slim.request calls'''
+        length = int(self.headers.getheader("content-length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.respond(400, "", "text/plain")
+            return
+        emulator = self.server.emulator
+        if isinstance(request, list):
+            emulator.count("batch")
+            if emulator.batches == BATCHES_ERROR:
+                self.respond(200, json.dumps({"id": None, "error": "batches not supported"}), "application/json")
+                return
+            if emulator.batches == BATCHES_DROP:
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            response = [self.call(item) for item in request]
+        else:
+            response = self.call(request)
+        self.respond(200, json.dumps(response), "application/json")
+
+    def call(self, request):
+        '''the response for a single slim.request'''
+        cmd = request.get("params", [None, [""]])[1]
+        self.server.emulator.count(cmd[0] if cmd else "")
+        return {"id": request.get("id"), "method": "slim.request", "params": request.get("params"),
+                "result": self.server.emulator.library.handle(cmd)}
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class LMSEmulator(object):
+    '''the json-rpc, artwork and discovery service of a server with a synthetic library'''
+
+    def __init__(self, size=1000, latency=0.0, jitter=0.0, host="127.0.0.1", port=0, queue_size=100,
+                 discovery=True, batches=BATCHES_SUPPORTED, artwork_size=20000):
+        self.library = SyntheticLibrary(size, queue_size=queue_size)
+        self.latency = latency
+        self.jitter = jitter
+        self.batches = batches
+        self.artwork = "\x89PNG" + "\0" * (artwork_size - 4)
+        self.requests = {}
+        self._requests_lock = threading.Lock()
+        self._http = _HTTPServer((host, port), _Handler)
+        self._http.emulator = self
+        self.host, self.port = self._http.server_address
+        self._udp = None
+        self.discovery_port = None
+        if discovery:
+            self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                self._udp.bind(("", DISCOVERY_PORT))
+            except socket.error:
+                # a real server runs on this machine
+                self._udp.bind(("", 0))
+            self.discovery_port = self._udp.getsockname()[1]
+        self._threads = []
+
+    def delay(self):
+        '''the injected latency of a request'''
+        seconds = self.latency + random.uniform(-self.jitter, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def count(self, verb):
+        '''count the requests per command verb'''
+        with self._requests_lock:
+            self.requests[verb] = self.requests.get(verb, 0) + 1
+
+    def start(self):
+        '''serve the requests in background threads'''
+        targets = [self._http.serve_forever]
+        if self._udp:
+            targets.append(self._serve_discovery)
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        '''stop serving'''
+        self._http.shutdown()
+        self._http.server_close()
+        if self._udp:
+            self._udp.close()
+
+    def _serve_discovery(self):
+        '''answer the discovery requests with the name, uuid and json port'''
+        values = {"NAME": SERVER_NAME, "UUID": SERVER_UUID, "JSON": str(self.port), "VERS": "7.9.1"}
+        while True:
+            try:
+                data, addr = self._udp.recvfrom(1024)
+            except socket.error:
+                return
+            if not data.startswith("e"):
+                continue
+            self.delay()
+            response = "E"
+            for tag in [data[pos:pos + 4] for pos in range(1, len(data) - 3, 5)]:
+                if tag in values:
+                    response += "%s%s%s" % (tag, chr(len(values[tag])), values[tag])
+            try:
+                self._udp.sendto(response, addr)
+            except socket.error:
+                return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Logitech Media Server emulator with a synthetic library")
+    parser.add_argument("--size", type=int, default=10000, help="number of tracks in the library")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0, help="random milliseconds added or removed")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--batches", choices=(BATCHES_SUPPORTED, BATCHES_ERROR, BATCHES_DROP),
+                        default=BATCHES_SUPPORTED, help="answer json-rpc batches, with an error or drop the connection")
+    args = parser.parse_args()
+    emulator = LMSEmulator(args.size, args.latency / 1000.0, args.jitter / 1000.0, host="0.0.0.0", port=args.port,
+                           batches=args.batches).start()
+    print "serving %s tracks at http://%s:%s/jsonrpc.js, discovery on udp port %s" % (
+        args.size, emulator.host, emulator.port, emulator.discovery_port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulator.stop()
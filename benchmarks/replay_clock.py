@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    replay_clock.py
+    Replays recorded LMS status sequences to compare the seek decisions of the old drift check and the playback clock
+
+    Runs outside of Kodi, no other modules are needed.
+    Usage: python benchmarks/replay_clock.py [recording.json ...]
+    A recording is a json object with a list of "samples", each with the receive time "t" (seconds),
+    the status fields "time", "mode", "rate", "index" and "url", "pushed" for a status pushed by the server
+    and "kodi" for the position of the Kodi player at that moment. "expected_seeks" is the number of real jumps.
+'''
+
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources", "lib"))
+from playbackclock import PlaybackClock  # pylint: disable=wrong-import-position
+
+# same values as the service
+SEEK_THRESHOLD = 2
+DRIFT_CHECKS = 5
+
+
+def replay_legacy(samples):
+    '''the old check: seek when the last status differs more than 2 seconds from kodi'''
+    seeks = []
+    kodi_offset = 0
+    track = None
+    for sample in samples:
+        if track != (sample.get("index"), sample.get("url")):
+            # kodi starts the next track on its own, the correction of earlier seeks no longer applies
+            track = (sample.get("index"), sample.get("url"))
+            kodi_offset = 0
+        kodi = sample["kodi"] + kodi_offset
+        lms = int(float(sample["time"]))
+        if sample["mode"] == "play" and kodi > 2 and kodi != lms and abs(lms - kodi) > SEEK_THRESHOLD:
+            seeks.append((sample["t"], kodi, lms))
+            kodi_offset += lms - kodi
+    return seeks
+
+
+def replay_clock(samples):
+    '''the current check: only seek on a discontinuity of the playback clock or a persisting difference'''
+    clock = PlaybackClock(clock=lambda: 0.0)
+    seeks = []
+    kodi_offset = 0
+    seek_pending = False
+    drift_checks = 0
+    track = None
+    for sample in samples:
+        if track != (sample.get("index"), sample.get("url")):
+            track = (sample.get("index"), sample.get("url"))
+            kodi_offset = 0
+        clock.update(sample["time"], sample["mode"], sample.get("rate", 1), (sample.get("index"), sample.get("url")),
+                     now=sample["t"], trusted=sample.get("pushed", False))
+        if sample["mode"] != "play":
+            continue
+        seek_pending = seek_pending or clock.consume_discontinuity()
+        kodi = sample["kodi"] + kodi_offset
+        lms = int(clock.position(now=sample["t"]))
+        if abs(lms - kodi) > SEEK_THRESHOLD:
+            drift_checks += 1
+        else:
+            drift_checks = 0
+            seek_pending = False
+        if kodi > 2 and drift_checks and (seek_pending or drift_checks >= DRIFT_CHECKS):
+            seeks.append((sample["t"], kodi, lms))
+            kodi_offset += lms - kodi
+            seek_pending = False
+            drift_checks = 0
+    return seeks, clock.stats
+
+
+def main():
+    '''replay all recordings and print the seeks of both strategies'''
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "clock_jitter.json")
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[-1])
+    parser.add_argument("recordings", nargs="*", default=[default])
+    parser.add_argument("--verbose", action="store_true", help="print every seek")
+    args = parser.parse_args()
+    for filename in args.recordings:
+        with open(filename) as recording:
+            data = json.load(recording)
+        samples = data["samples"]
+        legacy = replay_legacy(samples)
+        current, stats = replay_clock(samples)
+        print("%s: %s samples, %s expected seeks" % (os.path.basename(filename), len(samples),
+                                                    data.get("expected_seeks", "?")))
+        print("  legacy drift check: %s seeks" % len(legacy))
+        print("  playback clock:     %s seeks (%s)" % (len(current), ", ".join(
+            "%s %s" % (key, value) for key, value in sorted(stats.items()))))
+        if args.verbose:
+            for name, seeks in (("legacy", legacy), ("clock", current)):
+                for seek in seeks:
+                    print("  %s seek at %.1fs: kodi %s -> lms %s" % ((name,) + seek))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    replay_traffic.py
+    Reruns a recorded plugin session offline against the recorded server responses
+
+    Recordings are made with the setting "Record the server traffic of the plugin listings" and written to the
+    recordings folder of the addon data. Runs outside of Kodi with the stand-ins for the Kodi modules.
+    Usage: python benchmarks/replay_traffic.py RECORDING [--rounds 5] [--realtime] [--profile DIR] [--set KEY=VALUE]
+    Without --realtime the server answers instantly so only the time spent in the addon is measured. With
+    --profile the last round is profiled and the profile is written to DIR. Settings of the recorded session
+    which change the requests (e.g. the paging) are passed with --set.
+'''
+
+import os
+import sys
+import time
+import argparse
+from kodistubs import install_kodi_stubs, SETTINGS, WINDOW_PROPS
+
+# number of request types shown in the summary of the recording
+TOP_REQUESTS = 15
+
+
+def summary(replay):
+    '''the requests of the recording by the total time the server needed'''
+    from lmsserver import LMSServer
+    totals = {}
+    for entry in replay.entries:
+        verb = LMSServer.request_verb(entry["req"])
+        count, seconds = totals.get(verb, (0, 0))
+        totals[verb] = (count + 1, seconds + entry["ms"] / 1000.0)
+    print "recorded: %s (%s requests, %.3f seconds on the server)" % (
+        " ".join(replay.header.get("argv", [])), len(replay.entries), replay.recorded_seconds)
+    print "%-16s %8s %10s" % ("request", "count", "seconds")
+    for verb, (count, seconds) in sorted(totals.items(), key=lambda item: -item[1][1])[:TOP_REQUESTS]:
+        print "%-16s %8s %10.3f" % (verb, count, seconds)
+
+
+def player_id(replay):
+    '''the player of the recorded session'''
+    for entry in replay.entries:
+        requests = entry["req"] if isinstance(entry["req"], list) else [entry["req"]]
+        for request in requests:
+            if request.get("params") and request["params"][0]:
+                return request["params"][0]
+    return "aa:bb:cc:dd:ee:ff"
+
+
+def run(path, rounds, realtime, profile_dir):
+    '''rerun the plugin invocation of the recording'''
+    from traffic import TrafficReplay
+    from lmsserver import LMSServer
+    replay = TrafficReplay(path)
+    summary(replay)
+    argv = replay.header.get("argv", [])
+    if not argv or not argv[0].startswith("plugin://"):
+        print "not a recording of the plugin, only the summary is shown"
+        return 1
+    sys.argv[2] = argv[2] if len(argv) > 2 else ""
+    WINDOW_PROPS.update({"lmsplayerid": player_id(replay), "lmshost": "127.0.0.1", "lmsport": "9000"})
+    from plugin_content import PluginContent
+    durations = []
+    for count in range(rounds):
+        # the responses of identical requests are served in the recorded order in every round
+        LMSServer.replay = TrafficReplay(path, realtime)
+        start = time.time()
+        if profile_dir and count == rounds - 1:
+            from profiling import Profiler
+            profiler = Profiler(profile_dir)
+            profiler.runcall(PluginContent)
+            print "profile written to %s" % profiler.save("replay")
+        else:
+            PluginContent()
+        durations.append(time.time() - start)
+    stats = LMSServer.replay.stats
+    print "replayed %s rounds: best %.3f, worst %.3f seconds, %s requests answered, %s not in the recording" % (
+        rounds, min(durations), max(durations), stats["hits"], stats["misses"])
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded plugin session against the recorded responses")
+    parser.add_argument("recording", help="a .jsonl.gz file from the recordings folder of the addon data")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--realtime", action="store_true", help="wait the recorded duration of every request")
+    parser.add_argument("--profile", metavar="DIR", help="profile the last round and write the profile to DIR")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="an addon setting of the recorded session, e.g. --set paged_albums=false")
+    args = parser.parse_args()
+    install_kodi_stubs()
+    # the library index would answer instead of the recording
+    SETTINGS["library_index"] = "false"
+    for override in args.set:
+        key, value = override.split("=", 1)
+        SETTINGS[key] = value
+    if args.profile and not os.path.isdir(args.profile):
+        os.makedirs(args.profile)
+    sys.exit(run(args.recording, args.rounds, args.realtime, args.profile))
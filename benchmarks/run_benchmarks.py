@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    run_benchmarks.py
+    End-to-end benchmarks of the plugin, the playlist sync and the discovery against the LMS emulator
+
+    Runs outside of Kodi with the stand-ins for the Kodi modules, the python requests module is needed.
+    Usage: python benchmarks/run_benchmarks.py [--size 10000] [--latency 5] [--rounds 5] [--batches drop]
+                                               [--save-baseline FILE] [--baseline FILE] [--threshold 20]
+    Every benchmark is run --rounds times and the median is reported. With --baseline the medians are compared
+    with an earlier run and the exit code is 1 if a benchmark got slower by more than the threshold.
+'''
+
+import sys
+import json
+import time
+import argparse
+from kodistubs import install_kodi_stubs, SETTINGS, WINDOW_PROPS, CALL_OVERHEAD
+from lmsemulator import LMSEmulator, SERVER_UUID, BATCHES_SUPPORTED, BATCHES_ERROR, BATCHES_DROP
+
+PLAYER_ID = "aa:bb:cc:dd:ee:ff"
+PLUGIN_ACTIONS = ("menu", "albums", "artists", "tracks", "favorites", "currentplaylist")
+# changes smaller than this (in milliseconds) are never reported as a regression
+MIN_DELTA_MS = 2
+
+
+def median(values):
+    '''the median of a list of numbers'''
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def timed(func, rounds, setup=None):
+    '''the median duration (in milliseconds) of the function'''
+    durations = []
+    for _ in range(rounds):
+        if setup:
+            setup()
+        start = time.time()
+        func()
+        durations.append((time.time() - start) * 1000)
+    return median(durations)
+
+
+def bench_plugin(emulator, rounds):
+    '''an invocation of the plugin for each action, like kodi starts it when the user opens a listing'''
+    from plugin_content import PluginContent
+    WINDOW_PROPS.update({"lmsplayerid": PLAYER_ID, "lmshost": emulator.host, "lmsport": str(emulator.port)})
+
+    def run_action(action):
+        sys.argv[2] = "?action=%s" % action if action != "menu" else ""
+        PluginContent()
+
+    results = {}
+    for action in PLUGIN_ACTIONS:
+        results["plugin.%s" % action] = timed(lambda: run_action(action), rounds)
+    return results
+
+
+def bench_playlist(emulator, rounds):
+    '''the sync of the kodi playlist with the queue of the player, a full rebuild and a small change'''
+    from lmsserver import LMSServer
+    from player_monitor import KodiPlayer
+    import xbmc
+    library = emulator.library
+    queue = list(library.player["queue"])
+    lmsserver = LMSServer(emulator.host, emulator.port, PLAYER_ID)
+    state = {}
+
+    def full_setup():
+        xbmc.PlayList(xbmc.PLAYLIST_MUSIC).clear()
+        library.set_queue(queue)
+        state["player"] = KodiPlayer(lmsserver=lmsserver, webport=52308)
+
+    def change_setup():
+        # a synced playlist, then one track is moved and one is added to the queue on the server
+        full_setup()
+        state["player"].update_playlist()
+        changed = list(queue)
+        changed.insert(len(changed) / 2, changed.pop(0))
+        changed.append((queue[-1] + 1) % library.num_tracks)
+        library.set_queue(changed)
+
+    results = {"playlist.full": timed(lambda: state["player"].update_playlist(), rounds, full_setup),
+               "playlist.change": timed(lambda: state["player"].update_playlist(), rounds, change_setup)}
+    library.set_queue(queue)
+    lmsserver.close()
+    return results
+
+
+def bench_discovery(emulator, rounds):
+    '''the discovery of the server, when the last used server is known and when all servers are awaited'''
+    import lmsserver
+    lmsserver.DISCOVERY_PORT = emulator.discovery_port
+    preferred = {"host": "127.0.0.1", "port": emulator.port, "uuid": SERVER_UUID}
+    discovery = lmsserver.LMSDiscovery()
+    if not discovery.all(preferred):
+        print "no discovery response from the emulator, skipping the discovery benchmarks"
+        return {}
+    return {"discovery.preferred": timed(lambda: discovery.all(preferred), rounds),
+            "discovery.first": timed(lambda: discovery.all(), rounds)}
+
+
+def compare(results, baseline, threshold):
+    '''print the results next to the baseline, returns the names of the benchmarks which got slower'''
+    regressions = []
+    print "%-22s %12s %12s %8s" % ("benchmark", "ms", "baseline", "change")
+    for name in sorted(results):
+        duration = results[name]
+        base = baseline.get(name)
+        if not base:
+            print "%-22s %12.1f %12s %8s" % (name, duration, "-", "")
+            continue
+        change = (duration - base) / base * 100
+        flag = ""
+        if change > threshold and duration - base > MIN_DELTA_MS:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print "%-22s %12.1f %12.1f %+7.1f%%%s" % (name, duration, base, change, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmarks against the LMS emulator")
+    parser.add_argument("--size", type=int, default=10000, help="number of tracks in the synthetic library")
+    parser.add_argument("--queue", type=int, default=200, help="number of tracks in the queue of the player")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every server request")
+    parser.add_argument("--jitter", type=float, default=0, help="random milliseconds added or removed")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--batches", choices=(BATCHES_SUPPORTED, BATCHES_ERROR, BATCHES_DROP),
+                        default=BATCHES_SUPPORTED, help="how the emulator answers json-rpc batches")
+    parser.add_argument("--call-overhead", type=float, default=0, help="simulated microseconds per kodi call")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override an addon setting, e.g. --set paged_albums=false")
+    parser.add_argument("--only", default="plugin,playlist,discovery", help="comma separated benchmark groups")
+    parser.add_argument("--baseline", help="json file with the results of an earlier run to compare with")
+    parser.add_argument("--save-baseline", help="write the results to this json file")
+    parser.add_argument("--threshold", type=float, default=20, help="percentage slower that is a regression")
+    args = parser.parse_args()
+
+    install_kodi_stubs()
+    CALL_OVERHEAD[0] = args.call_overhead / 1000000.0
+    # the library index needs a sync first, the listings are taken from the server
+    SETTINGS["library_index"] = "false"
+    for override in args.set:
+        key, value = override.split("=", 1)
+        SETTINGS[key] = value
+
+    emulator = LMSEmulator(args.size, args.latency / 1000.0, args.jitter / 1000.0, queue_size=args.queue,
+                           batches=args.batches).start()
+    groups = {"plugin": bench_plugin, "playlist": bench_playlist, "discovery": bench_discovery}
+    results = {}
+    try:
+        for group in args.only.split(","):
+            results.update(groups[group](emulator, args.rounds))
+    finally:
+        emulator.stop()
+    print "%s tracks, %s ms latency, median of %s rounds, server requests: %s" % (
+        args.size, args.latency, args.rounds, emulator.requests)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = compare(results, baseline, args.threshold)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if regressions:
+        print "%s regression(s) over %s%%: %s" % (len(regressions), args.threshold, ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
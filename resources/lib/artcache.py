@@ -0,0 +1,241 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    artcache.py
+    Size bounded on-disk cache for the artwork of the server, served by the webproxy at /art/
+'''
+
+import os
+import re
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict, deque
+import requests
+from utils import log_msg, log_exception, get_profile_path
+import xbmc
+
+ARTWORK_PATH = "/art/"
+ARTWORK_DIR = "artwork"
+MAX_MB_DEFAULT = 100
+FETCH_TIMEOUT = (5, 20)
+# seconds an image is used before it's retrieved again (the ids in the paths change after a rescan)
+MAX_AGE = 7 * 24 * 3600
+# max number of images which are waiting to be prefetched
+PREFETCH_MAX = 200
+# local artwork url of any instance of the webproxy (the port can be different after a restart)
+LOCAL_URL_RE = re.compile(r"^http://127\.0\.0\.1:\d+%s([A-Za-z0-9_-]+)" % ARTWORK_PATH)
+
+
+class ArtworkCache(object):
+    '''on-disk cache of the artwork with lru eviction, concurrent misses for the same image are fetched once'''
+
+    def __init__(self, max_bytes, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir or get_profile_path(ARTWORK_DIR)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.server_url = None
+        self.base_url = None
+        self._http = requests.Session()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # filename --> size in bytes, least recently used first
+        self._total = 0
+        self._inflight = {}  # filename --> event which is set when the fetch is done
+        self._prefetch = deque(maxlen=PREFETCH_MAX)
+        self._prefetch_event = threading.Event()
+        self._prefetch_thread = None
+        self._exit = False
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evicted": 0, "expired": 0, "errors": 0, "prefetched": 0}
+        self._load()
+
+    def _load(self):
+        '''index the images of a previous session, the oldest modification time is evicted first'''
+        files = []
+        expired = time.time() - MAX_AGE
+        for filename in os.listdir(self.cache_dir):
+            filepath = os.path.join(self.cache_dir, filename)
+            if filename.endswith(".tmp"):
+                os.remove(filepath)
+                continue
+            stat = os.stat(filepath)
+            if stat.st_mtime < expired:
+                os.remove(filepath)
+                continue
+            files.append((stat.st_mtime, filename, stat.st_size))
+        for _, filename, size in sorted(files):
+            self._entries[filename] = size
+            self._total += size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def get_local_url(base_url, path):
+        '''the url of the proxy for the artwork path of the server'''
+        return "%s%s" % (base_url, base64.urlsafe_b64encode(path.encode("utf-8")).rstrip("="))
+
+    @staticmethod
+    def parse_local_url(url):
+        '''the artwork path of the server for a local url, None if it isn't a local url'''
+        match = LOCAL_URL_RE.match(url)
+        if not match:
+            return None
+        return ArtworkCache.decode_key(match.group(1))
+
+    @staticmethod
+    def decode_key(key):
+        '''the artwork path of the server from the key in the local url'''
+        try:
+            return base64.urlsafe_b64decode(str(key) + "=" * (-len(key) % 4)).decode("utf-8")
+        except (TypeError, ValueError):
+            return None
+
+    def get_filename(self, path):
+        '''name of the cache file for the artwork path of the server, keeps the extension for the content type
+           the paths contain ids of the server so the server is part of the name'''
+        ext = os.path.splitext(path.split("?")[0])[1].lower()
+        if ext not in (".png", ".jpg", ".jpeg", ".gif"):
+            ext = ".png"
+        return hashlib.sha1(("%s/%s" % (self.server_url, path)).encode("utf-8")).hexdigest() + ext
+
+    def set_server(self, host, port):
+        '''the server the artwork is retrieved from'''
+        self.server_url = "http://%s:%s" % (host, port)
+
+    def get(self, path):
+        '''the local file with the artwork path of the server, None if it can't be retrieved'''
+        filename = self.get_filename(path)
+        filepath = os.path.join(self.cache_dir, filename)
+        with self._lock:
+            if filename in self._entries and not self._expired(filepath):
+                self._entries[filename] = self._entries.pop(filename)
+                self.stats["hits"] += 1
+                return filepath
+            event = self._inflight.get(filename)
+            fetching = event is None
+            if fetching:
+                event = self._inflight[filename] = threading.Event()
+                self.stats["misses"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        if fetching:
+            try:
+                self._fetch(path, filename)
+            finally:
+                with self._lock:
+                    del self._inflight[filename]
+                event.set()
+        else:
+            # another request is already retrieving this image
+            event.wait(sum(FETCH_TIMEOUT))
+        with self._lock:
+            return filepath if filename in self._entries else None
+
+    def _fetch(self, path, filename):
+        '''retrieve the image from the server and add it to the cache'''
+        if not self.server_url:
+            return
+        filepath = os.path.join(self.cache_dir, filename)
+        tmp_path = "%s.%s.tmp" % (filepath, threading.current_thread().ident)
+        try:
+            response = self._http.get("%s/%s" % (self.server_url, path.lstrip("/")), timeout=FETCH_TIMEOUT)
+            if response.status_code != 200:
+                log_msg("Artwork %s not available: %s" % (path, response.status_code), xbmc.LOGDEBUG)
+                self.stats["errors"] += 1
+                self._remove(filepath)
+                return
+            with open(tmp_path, "wb") as tmp_file:
+                tmp_file.write(response.content)
+            try:
+                os.rename(tmp_path, filepath)
+            except OSError:
+                # an expired image is still there, rename doesn't replace a file on windows
+                os.remove(filepath)
+                os.rename(tmp_path, filepath)
+        except Exception as exc:
+            log_exception(__name__, exc)
+            self.stats["errors"] += 1
+            self._remove(tmp_path)
+            # an expired image which isn't in the index anymore would never be evicted
+            self._remove(filepath)
+            return
+        with self._lock:
+            self._entries[filename] = len(response.content)
+            self._total += len(response.content)
+            self._evict()
+
+    def _expired(self, filepath):
+        '''bool indicating if the image is too old to be used, an expired image is removed from the index'''
+        try:
+            if os.path.getmtime(filepath) >= time.time() - MAX_AGE:
+                return False
+        except OSError:
+            pass
+        filename = os.path.basename(filepath)
+        self._total -= self._entries.pop(filename)
+        self.stats["expired"] += 1
+        self._remove(filepath)
+        return True
+
+    @staticmethod
+    def _remove(filepath):
+        '''remove a file of the cache if it exists'''
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+
+    def _evict(self):
+        '''remove the least recently used images until the cache fits in its size, call with the lock held'''
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            filename, size = self._entries.popitem(last=False)
+            self._total -= size
+            self.stats["evicted"] += 1
+            self._remove(os.path.join(self.cache_dir, filename))
+
+    def prefetch(self, urls):
+        '''retrieve the artwork of the local urls in the background (e.g. the covers of the queue)'''
+        for url in urls:
+            path = self.parse_local_url(url) if url else None
+            if path:
+                self._prefetch.append(path)
+        if not self._prefetch:
+            return
+        if not self._prefetch_thread:
+            self._prefetch_thread = threading.Thread(target=self._prefetch_worker)
+            self._prefetch_thread.daemon = True
+            self._prefetch_thread.start()
+        self._prefetch_event.set()
+
+    def _prefetch_worker(self):
+        '''fetch the queued images one at a time so browsing isn't slowed down'''
+        while not self._exit:
+            self._prefetch_event.wait()
+            self._prefetch_event.clear()
+            while self._prefetch and not self._exit:
+                try:
+                    path = self._prefetch.popleft()
+                except IndexError:
+                    break
+                if self.get_filename(path) not in self._entries:
+                    self.stats["prefetched"] += 1
+                    self.get(path)
+
+    def get_stats(self):
+        '''the statistics of the cache as a dict'''
+        with self._lock:
+            stats = dict(self.stats)
+            stats["images"] = len(self._entries)
+            stats["bytes"] = self._total
+        return stats
+
+    def close(self):
+        '''stop the prefetching and log the statistics'''
+        self._exit = True
+        self._prefetch_event.set()
+        log_msg("Artwork cache stats: %s" % self.get_stats(), xbmc.LOGDEBUG)
+        self._http.close()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    commandqueue.py
+    Serializes the player commands on one worker thread and merges commands which are superseded
+'''
+
+import threading
+from utils import log_exception
+
+
+class CommandFuture(object):
+    '''the outcome of a queued command: True if the status confirmed it, False if not (or it was dropped)'''
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.superseded_by = None
+        self._result = None
+        self._done = threading.Event()
+
+    def done(self):
+        '''bool indicating if the command was processed'''
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''wait for the command to be processed, returns None if it's still pending after the timeout'''
+        self._done.wait(timeout)
+        return self._result
+
+    def set_result(self, result, cmd=None):
+        '''called by the worker when the (merged) command was processed'''
+        if cmd and cmd != self.cmd:
+            self.superseded_by = cmd
+        self._result = result
+        self._done.set()
+
+
+class CommandQueue(threading.Thread):
+    '''one worker sends the commands in order, newer commands replace pending commands with the same key'''
+
+    def __init__(self, send_command):
+        self._send_command = send_command
+        self._pending = []  # list of [key, cmd, futures] in the order the commands should be sent
+        self._lock = threading.Condition()
+        self._busy = False
+        self._exit = False
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    @staticmethod
+    def coalesce_key(cmd):
+        '''commands with the same key replace each other, None for commands which can't be merged'''
+        params = cmd.split(" ")
+        if params[0] in ("time", "pause", "power") and len(params) == 2 and params[1][0] not in "+-":
+            # absolute values: only the last one matters
+            return params[0]
+        if params[0] in ("play", "stop"):
+            return "mode"
+        if cmd.startswith("playlist index ") and params[2].isdigit():
+            return "playlist index"
+        return None
+
+    @property
+    def busy(self):
+        '''bool indicating if commands are pending or being sent'''
+        return self._busy or bool(self._pending)
+
+    def put(self, cmd):
+        '''queue the command and return a future for its outcome'''
+        future = CommandFuture(cmd)
+        key = self.coalesce_key(cmd)
+        with self._lock:
+            if self._exit:
+                future.set_result(False)
+                return future
+            futures = [future]
+            if key:
+                for entry in self._pending:
+                    if entry[0] == key:
+                        # the pending command is superseded, the new one keeps the order of the latest request
+                        self._pending.remove(entry)
+                        futures = entry[2] + futures
+                        break
+            self._pending.append([key, cmd, futures])
+            self._lock.notify()
+        return future
+
+    def stop(self):
+        '''stop the worker, pending commands are dropped'''
+        with self._lock:
+            self._exit = True
+            pending = self._pending
+            self._pending = []
+            self._lock.notify()
+        for _, _, futures in pending:
+            for future in futures:
+                future.set_result(False)
+
+    def run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._exit:
+                    self._lock.wait()
+                if self._exit:
+                    return
+                _, cmd, futures = self._pending.pop(0)
+                self._busy = True
+            try:
+                result = self._send_command(cmd)
+            except Exception as exc:
+                log_exception(__name__, exc)
+                result = False
+            finally:
+                self._busy = False
+            for future in futures:
+                future.set_result(result, cmd)
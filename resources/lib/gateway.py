@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    gateway.py
+    Json-rpc gateway to the server for the plugin, identical queries are sent once and kept for a short time
+'''
+
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from cherrypy.lib.caching import AntiStampedeCache
+from cherrypy._cpcompat import Event
+from utils import log_msg, log_exception, json
+from metrics import METRICS
+import xbmc
+
+GATEWAY_PATH = "/lms"
+# seconds a query result is served from memory
+CACHE_TTL = 10
+# max number of cached query results
+CACHE_MAX_ENTRIES = 100
+# max seconds to wait for an identical request which is already sent to the server
+COALESCE_TIMEOUT = 20
+HTTP_TIMEOUT = (5, 20)
+HTTP_POOL_SIZE = 4
+# commands which only read from the server, the results of other commands are never cached
+QUERY_COMMANDS = ("albums", "artists", "tracks", "titles", "songs", "genres", "years", "playlists", "musicfolder",
+                  "songinfo", "search", "apps", "radios", "serverstatus")
+
+
+class LMSGateway(object):
+    '''passes the json-rpc requests of the plugin to the server, queries are coalesced and cached'''
+
+    def __init__(self, host, port):
+        self.url = "http://%s:%s/jsonrpc.js" % (host, port)
+        self._http = requests.Session()
+        self._http.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, pool_block=True))
+        self._cache = AntiStampedeCache()  # request --> (expiration, status, response body)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "hits": 0, "coalesced": 0, "misses": 0, "passthrough": 0, "errors": 0}
+
+    @staticmethod
+    def is_query(params):
+        '''bool indicating if the (batch) request only reads from the server'''
+        if not isinstance(params, list):
+            params = [params]
+        for request in params:
+            try:
+                cmd = request["params"][1]
+            except (TypeError, KeyError, IndexError):
+                return False
+            if request.get("method") != "slim.request" or not cmd:
+                return False
+            # the items of the apps and favorites are queried with "<app> items"
+            if cmd[0] not in QUERY_COMMANDS and not (len(cmd) > 1 and cmd[1] == "items"):
+                return False
+        return True
+
+    def request(self, body):
+        '''the (status, response body) of the server for the json-rpc request'''
+        self.stats["requests"] += 1
+        try:
+            params = json.loads(body)
+        except ValueError:
+            return 400, ""
+        verb = self.request_verb(params)
+        if not self.is_query(params):
+            # a command can change what the queries return
+            self.stats["passthrough"] += 1
+            self.clear()
+            return self._send(body, verb)
+        key = json.dumps(params, sort_keys=True)
+        self._expire(key)
+        inflight = isinstance(self._cache.get(key), Event)
+        entry = self._cache.wait(key, timeout=COALESCE_TIMEOUT)
+        if entry:
+            self.stats["coalesced" if inflight else "hits"] += 1
+            return entry[1], entry[2]
+        # we're the first to ask, other threads wait for our result
+        self.stats["misses"] += 1
+        status, content = self._send(body, verb)
+        if status == 200:
+            self._cache[key] = (time.time() + CACHE_TTL, status, content)
+        else:
+            # wake up the waiting threads, they try for themselves
+            self._cache[key] = None
+            self._cache.pop(key, None)
+        return status, content
+
+    @staticmethod
+    def request_verb(params):
+        '''the command verb (e.g. albums, songinfo) of the request for the statistics'''
+        if isinstance(params, list):
+            return "batch"
+        try:
+            return params["params"][1][0]
+        except (TypeError, KeyError, IndexError):
+            return "unknown"
+
+    def _send(self, body, verb):
+        '''send the request to the server'''
+        start = time.time()
+        try:
+            response = self._http.post(self.url, data=body, timeout=HTTP_TIMEOUT)
+            if response.status_code != 200:
+                METRICS.increment("gateway.%s.errors" % verb)
+            return response.status_code, response.content
+        except Exception as exc:
+            log_exception(__name__, exc)
+            self.stats["errors"] += 1
+            METRICS.increment("gateway.%s.errors" % verb)
+            return 502, ""
+        finally:
+            METRICS.record_latency("gateway.%s" % verb, time.time() - start)
+
+    def _expire(self, key):
+        '''remove the expired results (and the oldest ones if there are too many)'''
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+            if isinstance(entry, tuple) and entry[0] < now:
+                self._cache.pop(key, None)
+            results = [(value[0], item) for item, value in self._cache.items() if isinstance(value, tuple)]
+            for expiration, item in sorted(results)[:max(len(results) - CACHE_MAX_ENTRIES, 0)]:
+                self._cache.pop(item, None)
+            for expiration, item in results:
+                if expiration < now:
+                    self._cache.pop(item, None)
+
+    def clear(self):
+        '''forget the cached results'''
+        with self._lock:
+            for key, value in self._cache.items():
+                if isinstance(value, tuple):
+                    self._cache.pop(key, None)
+
+    def close(self):
+        '''log the statistics and close the http session'''
+        log_msg("Gateway stats: %s" % self.stats, xbmc.LOGDEBUG)
+        self._http.close()
@@ -1,21 +1,40 @@
 # -*- coding: utf8 -*-
 import threading
+import socket
 import time
-import StringIO
 import re
 import struct
 import cherrypy
+from cherrypy.lib import httputil
+from cherrypy.lib.static import serve_file
 from cherrypy import wsgiserver
-from cherrypy.process import servers
 from datetime import datetime
 import random
 import sys
 import platform
 import logging
 import os
-from utils import log_msg
+from streamserver import StreamServer
+from artcache import ArtworkCache, ARTWORK_PATH
+from gateway import GATEWAY_PATH
+from metrics import METRICS
+from utils import log_msg, log_exception, json
 import xbmc
 
+# all silence is served from one preallocated read-only buffer
+SILENCE_CHUNK_SIZE = 65536
+SILENCE = "\0" * SILENCE_CHUNK_SIZE
+SILENCE_VIEW = memoryview(SILENCE)
+# the wave headers are the same for every request of the same duration
+WAVE_HEADERS = {}
+# the webserver engines of the proxy
+ENGINE_EVENTLOOP = "eventloop"
+ENGINE_THREADED = "threaded"
+# maximum size in the wave header, used for the open-ended radio streams
+STREAM_DATA_SIZE = 0xFFFFFFFF
+# max seconds to wait for the webserver to listen
+READY_TIMEOUT = 10
+
 
 class HTTPProxyError(Exception):
     pass
@@ -25,22 +44,39 @@ class Track:
     __is_playing = None
     __allowed_ips = None
     __allow_ranges = None
+    __stream_generation = 0
 
     def __init__(self, allowed_ips, allow_ranges=True):
         self.__allowed_ips = allowed_ips
         self.__is_playing = False
         self.__allow_ranges = allow_ranges
 
+    def end_streams(self):
+        '''end all running open-ended (radio) streams, the player will see the end of the file'''
+        self.__stream_generation += 1
+
     def _get_wave_header(self, duration):
+        '''get the (cached) wave header for our silence stream'''
+        cached = WAVE_HEADERS.get(duration)
+        if cached is None:
+            cached = self._create_wave_header(duration)
+            WAVE_HEADERS[duration] = cached
+        return cached
+
+    @staticmethod
+    def _create_wave_header(duration):
         '''generate a wave header for our silence stream'''
-        file = StringIO.StringIO()
-
-        # always add 2 seconds of additional duration to solve crossfade issues
-        duration += 2
-        numsamples = 44100 * duration
         channels = 2
         samplerate = 44100
         bitspersample = 16
+        if duration is None:
+            # open-ended stream: the maximum sizes tell the player the length is unknown
+            datasize = STREAM_DATA_SIZE
+        else:
+            # always add 2 seconds of additional duration to solve crossfade issues
+            duration += 2
+            numsamples = 44100 * duration
+            datasize = numsamples * channels * (bitspersample / 8)
 
         # Generate format chunk
         format_chunk_spec = "<4sLHHLLHH"
@@ -57,7 +93,6 @@ class Track:
         )
         # Generate data chunk
         data_chunk_spec = "<4sL"
-        datasize = numsamples * channels * (bitspersample / 8)
         data_chunk = struct.pack(
             data_chunk_spec,
             "data",  # Chunk id
@@ -72,7 +107,7 @@ class Track:
             struct.calcsize(data_chunk_spec) + datasize
         ]
         # Generate main header
-        all_cunks_size = int(sum(sum_items))
+        all_cunks_size = min(int(sum(sum_items)), STREAM_DATA_SIZE)
         main_header_spec = "<4sL4s"
         main_header = struct.pack(
             main_header_spec,
@@ -80,40 +115,77 @@ class Track:
             all_cunks_size,
             "WAVE"
         )
-        # Write all the contents in
-        file.write(main_header)
-        file.write(format_chunk)
-        file.write(data_chunk)
-
-        return file.getvalue(), all_cunks_size + 8
-
-    def send_audio_stream(self, filesize, wave_header=None, max_buffer_size=8196):
-
-        # Initialize some loop vars
-        output_buffer = StringIO.StringIO()
-        bytes_written = 0
-        has_frames = True
-
-        # Write wave header
-        if wave_header is not None:
-            output_buffer.write(wave_header)
-            bytes_written = output_buffer.tell()
-            yield wave_header
-            output_buffer.truncate(0)
-            
-        # this is where we would/could normally stream packets from an audio input
-        # In this case we stream only silence until the end is reached
-        while bytes_written < filesize:
+        return main_header + format_chunk + data_chunk, all_cunks_size + 8
 
-            # The buffer size fits into the file size
-            if bytes_written + max_buffer_size < filesize:
-                yield '\0' * max_buffer_size
-                bytes_written += max_buffer_size
+    def send_audio_stream(self, start, stop, wave_header=None):
+        '''yield the bytes start to stop of the wave file: the (part of the) header followed by silence'''
+        # Write the requested part of the wave header
+        if wave_header is not None and start < len(wave_header):
+            yield wave_header[start:stop]
+            start = min(len(wave_header), stop)
 
-            # Does not fit, just generate the remaining bytes
-            else:
-                yield '\0' * (filesize - bytes_written)
-                bytes_written = filesize
+        # this is where we would/could normally stream packets from an audio input
+        # In this case we stream only silence until the end is reached
+        remaining = stop - start
+        while remaining >= SILENCE_CHUNK_SIZE:
+            yield SILENCE
+            remaining -= SILENCE_CHUNK_SIZE
+
+        # the remaining bytes are a slice of the same buffer, this is only safe with a content-length:
+        # the chunked writer of the webserver can only join strings
+        if remaining > 0:
+            yield SILENCE_VIEW[:remaining]
+
+    def send_endless_stream(self, wave_header):
+        '''yield the wave header followed by silence until the streams are ended by the service'''
+        generation = self.__stream_generation
+        yield wave_header
+        while generation == self.__stream_generation:
+            yield SILENCE
+
+    def send_multipart_stream(self, parts, wave_header, boundary):
+        '''yield a multipart/byteranges body for the (part headers, start, stop) parts'''
+        for part_header, start, stop in parts:
+            yield part_header
+            for chunk in self.send_audio_stream(start, stop, wave_header):
+                yield chunk
+            yield "\r\n"
+        yield "--%s--\r\n" % boundary
+
+    @staticmethod
+    def count_stream(body, kind):
+        '''pass the body through while counting the streams and bytes for the statistics'''
+        METRICS.increment("proxy.streams")
+        METRICS.increment("proxy.streams.%s" % kind)
+        sent = 0
+        try:
+            for chunk in body:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            METRICS.increment("proxy.bytes", sent)
+
+    def _get_ranges(self, filesize, etag, headers, protocol):
+        '''parse the requested byte ranges, returns None if the whole file should be served'''
+        if not self.__allow_ranges or protocol < (1, 1):
+            return None
+        if_range = headers.get('if-range')
+        if if_range and if_range != etag:
+            # the client has another version of the file, send the full file
+            return None
+        try:
+            ranges = httputil.get_ranges(headers.get('range'), filesize)
+        except ValueError:
+            # a syntactically invalid range is ignored
+            return None
+        if ranges:
+            # the parser doesn't limit the last byte position to the file size
+            return [(start, min(stop, filesize)) for start, stop in ranges]
+        return ranges
+
+    def is_allowed(self, remote_addr):
+        '''bool indicating if the requester is allowed to use the proxy'''
+        return remote_addr in self.__allowed_ips
 
     def _check_request(self):
         method = cherrypy.request.method.upper()
@@ -124,76 +196,159 @@ class Track:
             raise cherrypy.HTTPError(405)
 
         # Error if the requester is not allowed
-        if headers['Remote-Addr'] not in self.__allowed_ips:
+        if not self.is_allowed(headers['Remote-Addr']):
             raise cherrypy.HTTPError(403)
 
         return method
 
-    @cherrypy.expose
-    def default(self, track_id, **kwargs):
-        # Check sanity of the request
-        self._check_request()
-
-        # get duration from track id
+    def get_response(self, track_id, method, headers, protocol=(1, 1)):
+        '''the (status, headers, body) for a track request, independent of the webserver engine'''
+        # get duration from track id, radio streams have no duration
         is_radio = False
         try:
             duration = int(track_id)
         except:
             is_radio = True
-            duration = 3600
+            duration = None
 
         # Calculate file size, and obtain the header
         file_header, filesize = self._get_wave_header(duration)
+        response_headers = [('Content-Type', 'audio/x-wav')]
+        is_get = method == 'GET'
 
         # headers
         if is_radio:
-            cherrypy.response.headers['Content-Type'] = 'audio/x-wav'
-            cherrypy.response.headers['Connection'] = 'close'
-            #cherrypy.response.headers['Transfer-Encoding'] = 'chunked'
-        elif cherrypy.request.headers.get('Range', '') == "bytes=0-":
-            cherrypy.response.status = '206 Partial Content'
-            cherrypy.response.headers['Content-Type'] = 'audio/x-wav'
-            cherrypy.response.headers['Accept-Ranges'] = 'bytes'
-            cherrypy.response.headers['Content-Length'] = filesize
-            cherrypy.response.headers['Content-Range'] = "bytes 0-%s/%s" % (filesize, filesize)
-        elif cherrypy.request.headers.get('Range'):
-            # partial request
-            cherrypy.response.status = '206 Partial Content'
-            cherrypy.response.headers['Content-Type'] = 'audio/x-wav'
-            range = cherrypy.request.headers["Range"].split("bytes=")[1].split("-")
-            range_l = int(range[0])
-            try:
-                range_r = int(range[1])
-            except:
-                range_r = filesize
-            chunk = range_r - range_l
-            cherrypy.response.headers['Accept-Ranges'] = 'bytes'
-            cherrypy.response.headers['Content-Length'] = chunk
-            cherrypy.response.headers['Content-Range'] = "bytes %s-%s/%s" % (range_l, range_r, filesize)
-            filesize = chunk
+            # no content-length: the stream is sent chunked and runs until the service ends it
+            response_headers.append(('Connection', 'close'))
+            body = self.count_stream(self.send_endless_stream(file_header), "radio") if is_get else None
+            return '200 OK', response_headers, body
+
+        etag = '"silence-%s"' % duration
+        response_headers.append(('ETag', etag))
+        if self.__allow_ranges:
+            response_headers.append(('Accept-Ranges', 'bytes'))
+        ranges = self._get_ranges(filesize, etag, headers, protocol)
+
+        if ranges == []:
+            response_headers = [('Content-Range', "bytes */%s" % filesize), ('Content-Length', '0')]
+            return '416 Requested Range Not Satisfiable', response_headers, None
+        elif not ranges:
+            status = '200 OK'
+            response_headers.append(('Content-Length', str(filesize)))
+            ranges = [(0, filesize)]
+        elif len(ranges) == 1:
+            # partial request, only the requested window is generated
+            status = '206 Partial Content'
+            start, stop = ranges[0]
+            response_headers.append(('Content-Length', str(stop - start)))
+            response_headers.append(('Content-Range', "bytes %s-%s/%s" % (start, stop - 1, filesize)))
         else:
-            cherrypy.response.status = '200 OK'
-            cherrypy.response.headers['Content-Type'] = 'audio/x-wav'
-            cherrypy.response.headers['Content-Length'] = filesize
+            # multiple ranges are sent as multipart/byteranges with a precalculated length
+            boundary = "%032x" % random.getrandbits(128)
+            response_headers[0] = ('Content-Type', "multipart/byteranges; boundary=%s" % boundary)
+            parts = [("--%s\r\nContent-Type: audio/x-wav\r\nContent-Range: bytes %s-%s/%s\r\n\r\n" %
+                      (boundary, start, stop - 1, filesize), start, stop) for start, stop in ranges]
+            content_length = sum([len(part_header) + stop - start + 2 for part_header, start, stop in parts])
+            response_headers.append(('Content-Length', str(content_length + len(boundary) + 6)))
+            body = self.send_multipart_stream(parts, file_header, boundary) if is_get else None
+            if body:
+                body = self.count_stream(body, "multipart")
+            return '206 Partial Content', response_headers, body
 
         # If method was GET, write the file content
-        if cherrypy.request.method.upper() == 'GET':
-            return self.send_audio_stream(filesize, file_header)
+        start, stop = ranges[0]
+        if not is_get:
+            return status, response_headers, None
+        body = self.send_audio_stream(start, stop, file_header)
+        return status, response_headers, self.count_stream(body, "partial" if status.startswith("206") else "full")
+
+    @cherrypy.expose
+    def default(self, track_id, **kwargs):
+        # Check sanity of the request
+        method = self._check_request()
+        status, headers, body = self.get_response(track_id, method, cherrypy.request.headers,
+                                                  cherrypy.request.protocol)
+        cherrypy.response.status = status
+        for key, value in headers:
+            cherrypy.response.headers[key] = value
+        return body
 
     default._cp_config = {'response.stream': True}
 
 
+class Artwork:
+    __allowed_ips = None
+    __cache = None
+
+    def __init__(self, allowed_ips, cache):
+        self.__allowed_ips = allowed_ips
+        self.__cache = cache
+
+    @cherrypy.expose
+    def default(self, key, **kwargs):
+        '''serve the artwork of the server from the local cache, the key is the encoded path on the server'''
+        if cherrypy.request.method.upper() not in ("GET", "HEAD"):
+            raise cherrypy.HTTPError(405)
+        if cherrypy.request.headers['Remote-Addr'] not in self.__allowed_ips:
+            raise cherrypy.HTTPError(403)
+        path = ArtworkCache.decode_key(key)
+        filepath = self.__cache.get(path) if path else None
+        if not filepath:
+            raise cherrypy.NotFound()
+        return serve_file(filepath)
+
+
+class Gateway:
+    __allowed_ips = None
+    backend = None
+
+    def __init__(self, allowed_ips):
+        self.__allowed_ips = allowed_ips
+
+    @cherrypy.expose
+    def jsonrpc_js(self, **kwargs):
+        '''pass the json-rpc request of the plugin to the gateway of the service'''
+        if cherrypy.request.headers['Remote-Addr'] not in self.__allowed_ips:
+            raise cherrypy.HTTPError(403)
+        if not self.backend:
+            raise cherrypy.HTTPError(503)
+        # the plugin sends the request as the body of a get request, like for the server
+        length = int(cherrypy.request.headers.get('Content-Length') or 0)
+        status, content = self.backend.request(cherrypy.request.rfile.read(length))
+        cherrypy.response.status = status
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return content
+
+
 class Root:
     track = None
+    art = None
+    lms = None
+    __allowed_ips = None
 
-    def __init__(self, allowed_ips, allow_ranges=True):
+    def __init__(self, allowed_ips, allow_ranges=True, artwork_cache=None):
+        self.__allowed_ips = allowed_ips
         self.track = Track(
             allowed_ips, allow_ranges
         )
+        if artwork_cache:
+            self.art = Artwork(allowed_ips, artwork_cache)
+        self.lms = Gateway(allowed_ips)
+
+    @cherrypy.expose
+    def stats(self):
+        '''the statistics of the service as json'''
+        if cherrypy.request.headers['Remote-Addr'] not in self.__allowed_ips:
+            raise cherrypy.HTTPError(403)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return json.dumps(METRICS.summary(), indent=2, sort_keys=True)
 
     def cleanup(self):
         self.__session = None
         self.track = None
+        self.art = None
+        self.lms = None
 
 
 class ProxyRunner(threading.Thread):
@@ -202,23 +357,32 @@ class ProxyRunner(threading.Thread):
     __allowed_ips = None
     __cb_stream_ended = None
     __root = None
+    __artwork_cache = None
 
     def _find_free_port(self, host, port_list):
         '''find a free tcp port we can use for our webserver'''
         for port in port_list:
+            # binding is instant, unlike a connect attempt with a timeout
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             try:
-                servers.check_port(host, port, .1)
+                sock.bind((host, port))
                 return port
-            except:
+            except socket.error:
                 pass
+            finally:
+                sock.close()
         list_str = ','.join([str(item) for item in port_list])
         raise HTTPProxyError("Cannot find a free port. Tried: %s" % list_str)
 
-    def __init__(self, host='localhost', try_ports=range(51100, 51150), allowed_ips=['127.0.0.1'], allow_ranges=True):
+    def __init__(self, host='localhost', try_ports=range(51100, 51150), allowed_ips=['127.0.0.1'], allow_ranges=True,
+                 engine=ENGINE_EVENTLOOP, artwork_cache=None):
         port = self._find_free_port(host, try_ports)
         self.__allowed_ips = allowed_ips
+        self.__artwork_cache = artwork_cache
+        if artwork_cache:
+            artwork_cache.base_url = "http://%s:%s%s" % (host, port, ARTWORK_PATH)
         self.__root = Root(
-            self.__allowed_ips, allow_ranges
+            self.__allowed_ips, allow_ranges, artwork_cache
         )
         app = cherrypy.tree.mount(self.__root, '/')
         log = cherrypy.log
@@ -226,11 +390,24 @@ class ProxyRunner(threading.Thread):
         log.error_file = ''
         log.screen = True
 
-        self.__server = wsgiserver.CherryPyWSGIServer((host, port), app)
+        if engine == ENGINE_THREADED:
+            self.__server = wsgiserver.CherryPyWSGIServer((host, port), app)
+        else:
+            # the silent tracks are served from one thread, all other urls by the cherrypy app
+            self.__server = StreamServer((host, port), self.__root.track, app)
+        log_msg("webproxy uses the %s engine" % engine, xbmc.LOGDEBUG)
+        METRICS.register("proxy", lambda: {"engine": engine,
+                                           "connections": getattr(self.__server, "connections", None)})
+        if artwork_cache:
+            METRICS.register("artwork", artwork_cache.get_stats)
         threading.Thread.__init__(self)
 
     def run(self):
-        self.__server.start()
+        try:
+            self.__server.start()
+        except Exception as exc:
+            # e.g. the port was taken after it was found free, ready_wait reports the failure
+            log_exception(__name__, exc)
 
     def get_port(self):
         return self.__server.bind_addr[1]
@@ -238,11 +415,39 @@ class ProxyRunner(threading.Thread):
     def get_host(self):
         return self.__server.bind_addr[0]
 
-    def ready_wait(self):
+    def ready_wait(self, timeout=READY_TIMEOUT):
+        '''wait until the webserver listens, raises HTTPProxyError if it failed to start'''
+        deadline = time.time() + timeout
         while not self.__server.ready:
+            if not self.is_alive():
+                raise HTTPProxyError("The webproxy failed to start")
+            if time.time() > deadline:
+                raise HTTPProxyError("The webproxy did not start within %s seconds" % timeout)
             time.sleep(.1)
 
+    @property
+    def artwork_cache(self):
+        '''the cache behind the /art/ urls, None if the artwork isn't cached'''
+        return self.__artwork_cache
+
+    def set_gateway(self, gateway):
+        '''serve the json-rpc gateway to the server at /lms/jsonrpc.js, returns its base url'''
+        self.__root.lms.backend = gateway
+        METRICS.register("gateway", lambda: dict(gateway.stats))
+        return "http://%s:%s%s" % (self.get_host(), self.get_port(), GATEWAY_PATH)
+
+    def end_streams(self):
+        '''end the open-ended (radio) streams which are currently served'''
+        self.__root.track.end_streams()
+
     def stop(self):
+        self.end_streams()
+        for name in ("proxy", "artwork", "gateway"):
+            METRICS.unregister(name)
+        if self.__artwork_cache:
+            self.__artwork_cache.close()
+        if self.__root.lms.backend:
+            self.__root.lms.backend.close()
         self.__server.stop()
         self.join(1)
         self.__root.cleanup()
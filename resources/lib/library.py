@@ -0,0 +1,344 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    library.py
+    Local (sqlite) index of the LMS library, synced by the service and used by the plugin for browsing
+'''
+
+import os
+import sqlite3
+import threading
+from utils import log_msg, log_exception, json, get_profile_path
+from lmsserver import TAGS_FULL, TAGS_ALBUM
+
+DB_FILE = "library.db"
+SYNC_PAGE_SIZE = 2000
+SYNC_INTERVAL = 300
+# number of ids to request at once when fetching changed items
+SYNC_CHUNK_SIZE = 100
+# above this number of changed albums, re-fetching all albums is cheaper than one request per album
+SYNC_MAX_ALBUM_LOOKUPS = 200
+TAGS_LIBRARY_ALBUM = TAGS_ALBUM + "S"  # artist_id
+TAGS_LIBRARY_TRACK = TAGS_FULL + "pU"  # genre_id and lastUpdated
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS artists (id INTEGER PRIMARY KEY, name TEXT, data TEXT)",
+    "CREATE TABLE IF NOT EXISTS albums (id INTEGER PRIMARY KEY, artist_id INTEGER, year INTEGER, "
+    "title TEXT, data TEXT)",
+    "CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY, album_id INTEGER, artist_id INTEGER, "
+    "genre_id INTEGER, year INTEGER, disc INTEGER, tracknum INTEGER, title TEXT, lastupdated INTEGER, data TEXT)",
+    "CREATE TABLE IF NOT EXISTS genres (id INTEGER PRIMARY KEY, name TEXT, data TEXT)",
+    "CREATE TABLE IF NOT EXISTS years (year INTEGER PRIMARY KEY, data TEXT)",
+    "CREATE INDEX IF NOT EXISTS albums_artist ON albums (artist_id)",
+    "CREATE INDEX IF NOT EXISTS albums_year ON albums (year)",
+    "CREATE INDEX IF NOT EXISTS tracks_album ON tracks (album_id, disc, tracknum)",
+    "CREATE INDEX IF NOT EXISTS tracks_artist ON tracks (artist_id)",
+    "CREATE INDEX IF NOT EXISTS tracks_genre ON tracks (genre_id)",
+    "CREATE INDEX IF NOT EXISTS tracks_year ON tracks (year)"
+]
+
+# per listing: the query, the supported filters and the sort order
+QUERIES = {
+    "artists": ("SELECT data FROM artists", {
+        "genre_id": "id IN (SELECT artist_id FROM tracks WHERE genre_id = ?)"
+    }, "name COLLATE NOCASE"),
+    "albums": ("SELECT data FROM albums", {
+        "artist_id": "id IN (SELECT id FROM albums WHERE artist_id = ? "
+                     "UNION SELECT album_id FROM tracks WHERE artist_id = ?)",
+        "genre_id": "id IN (SELECT album_id FROM tracks WHERE genre_id = ?)",
+        "year": "year = ?"
+    }, "title COLLATE NOCASE"),
+    "tracks": ("SELECT data FROM tracks", {
+        "album_id": "album_id = ?",
+        "artist_id": "artist_id = ?",
+        "genre_id": "genre_id = ?",
+        "year": "year = ?"
+    }, "disc, tracknum, title COLLATE NOCASE"),
+    "genres": ("SELECT data FROM genres", {}, "name COLLATE NOCASE"),
+    "years": ("SELECT data FROM years", {}, "year DESC")
+}
+
+
+class LibraryIndex(object):
+    '''sqlite index of the artists, albums, tracks, genres and years in the LMS library'''
+
+    def __init__(self, db_path=None):
+        if not db_path:
+            db_path = get_profile_path(DB_FILE)
+        self._db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        for statement in SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def open_synced(server):
+        '''open the existing index for browsing, returns None if it is not (yet) synced with the server'''
+        db_path = get_profile_path(DB_FILE)
+        if os.path.exists(db_path):
+            library = LibraryIndex(db_path)
+            if library.ready(server):
+                return library
+            library.close()
+        return None
+
+    def close(self):
+        '''close the database'''
+        self._db.close()
+
+    def get_meta(self, key, default=None):
+        '''get a value from the meta table'''
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        '''store a value in the meta table (within the current transaction)'''
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, "%s" % value))
+
+    def ready(self, server):
+        '''bool indicating if the index is fully synced with the given server'''
+        return bool(self.get_meta("lastscan")) and self.get_meta("server") == server
+
+    def query(self, listing, args, start=0, count=0):
+        '''query a listing with the lms style filter params (e.g. "artist_id:5")
+           returns a tuple with the items and the total count or None if the filters are not supported'''
+        if listing not in QUERIES:
+            return None
+        sql, supported, order = QUERIES[listing]
+        where = []
+        values = []
+        for param in args.split():
+            if ":" not in param or param.startswith("tags:"):
+                continue
+            key, value = param.split(":", 1)
+            if key == "library_id" and value.startswith("myMusic"):
+                # the menu node is passed as library id, this is not a real virtual library
+                continue
+            if key not in supported:
+                return None
+            where.append(supported[key])
+            values += [value] * supported[key].count("?")
+        if where:
+            sql += " WHERE %s" % " AND ".join(where)
+        total = self._db.execute(sql.replace("SELECT data", "SELECT COUNT(*)", 1), values).fetchone()[0]
+        sql += " ORDER BY %s" % order
+        if count:
+            sql += " LIMIT %s OFFSET %s" % (int(count), int(start))
+        items = [json.loads(row[0]) for row in self._db.execute(sql, values)]
+        return items, total
+
+    def store(self, table, items):
+        '''store items from the lms server in the index (within the current transaction)'''
+        rows = []
+        for item in items:
+            data = json.dumps(item)
+            if table == "artists":
+                rows.append((item["id"], item.get("artist"), data))
+            elif table == "albums":
+                rows.append((item["id"], item.get("artist_id"), item.get("year"), item.get("album"), data))
+            elif table == "tracks":
+                rows.append((item["id"], item.get("album_id"), item.get("artist_id"), item.get("genre_id"),
+                             item.get("year"), item.get("disc"), item.get("tracknum"), item.get("title"),
+                             item.get("lastUpdated"), data))
+            elif table == "genres":
+                rows.append((item["id"], item.get("genre"), data))
+            elif table == "years":
+                rows.append((item["year"], data))
+        if rows:
+            self._db.executemany("INSERT OR REPLACE INTO %s VALUES (%s)" %
+                                 (table, ",".join(["?"] * len(rows[0]))), rows)
+
+    def track_checksums(self):
+        '''get the lastUpdated value of all tracks in the index, dict with the track id as key'''
+        return dict(self._db.execute("SELECT id, lastupdated FROM tracks").fetchall())
+
+    def album_ids(self, track_ids):
+        '''get the album ids for the given track ids'''
+        result = set()
+        for i in range(0, len(track_ids), SYNC_CHUNK_SIZE):
+            chunk = track_ids[i:i + SYNC_CHUNK_SIZE]
+            sql = "SELECT DISTINCT album_id FROM tracks WHERE id IN (%s)" % ",".join(["?"] * len(chunk))
+            result.update([row[0] for row in self._db.execute(sql, chunk)])
+        return result
+
+    def apply_changes(self, lastscan, changes, removed_tracks, replace_albums=False):
+        '''apply the changes since the last scan to the index
+           changes is a dict with the new/changed items per table,
+           artists, genres and years in the changes are complete listings and replace the current ones'''
+        with self._lock:
+            try:
+                for i in range(0, len(removed_tracks), SYNC_CHUNK_SIZE):
+                    chunk = removed_tracks[i:i + SYNC_CHUNK_SIZE]
+                    self._db.execute("DELETE FROM tracks WHERE id IN (%s)" % ",".join(["?"] * len(chunk)), chunk)
+                for table in ["artists", "genres", "years"] + (["albums"] if replace_albums else []):
+                    self._db.execute("DELETE FROM %s" % table)
+                for table, items in changes.iteritems():
+                    self.store(table, items)
+                # remove the albums which have no tracks left
+                self._db.execute("DELETE FROM albums WHERE NOT EXISTS "
+                                 "(SELECT 1 FROM tracks WHERE tracks.album_id = albums.id)")
+                self.set_meta("lastscan", lastscan)
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+
+    def replace_all(self, server, lastscan, library):
+        '''replace the whole index with the given library (dict with the items per table)'''
+        with self._lock:
+            try:
+                for table, items in library.iteritems():
+                    self._db.execute("DELETE FROM %s" % table)
+                    self.store(table, items)
+                self.set_meta("server", server)
+                self.set_meta("lastscan", lastscan)
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+
+
+class LibrarySync(threading.Thread):
+    '''keeps the library index in sync with the LMS server in the background'''
+
+    def __init__(self, lmsserver):
+        self.lmsserver = lmsserver
+        self._exit = threading.Event()
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def stop(self):
+        '''stop syncing'''
+        self._exit.set()
+        self.join(1)
+
+    def run(self):
+        library = LibraryIndex()
+        while not self._exit.is_set():
+            try:
+                self.sync(library)
+            except Exception as exc:
+                log_exception(__name__, exc)
+            self._exit.wait(SYNC_INTERVAL)
+        library.close()
+
+    def sync(self, library):
+        '''sync the index if the library on the server changed since the last sync'''
+        result = self.lmsserver.send_request("rescan ?")
+        if not result or int(result.get("_rescan", 0)):
+            # the server is offline or (re)scanning the library, try again later
+            return
+        result = self.lmsserver.send_request("serverstatus 0 0")
+        lastscan = result.get("lastscan") if result else None
+        server = self.lmsserver.host
+        if not lastscan:
+            return
+        if library.ready(server):
+            if library.get_meta("lastscan") != "%s" % lastscan:
+                self.sync_changes(library, lastscan)
+        else:
+            self.sync_all(library, server, lastscan)
+
+    def sync_all(self, library, server, lastscan):
+        '''fill the index with the complete library of the server'''
+        log_msg("Syncing library index with LMS server (lastscan %s)" % lastscan)
+        content = {
+            "artists": self.get_all("artists", "", "artists_loop"),
+            "albums": self.get_all("albums", "tags:%s" % TAGS_LIBRARY_ALBUM, "albums_loop"),
+            "genres": self.get_all("genres", "", "genres_loop"),
+            "years": self.get_all("years", "", "years_loop"),
+            "tracks": self.get_all("titles", "tags:%s" % TAGS_LIBRARY_TRACK, "titles_loop")
+        }
+        if None in content.values():
+            return
+        library.replace_all(server, lastscan, content)
+        log_msg("Library index synced - %s artists, %s albums, %s tracks" %
+                (len(content["artists"]), len(content["albums"]), len(content["tracks"])))
+
+    @staticmethod
+    def checksum(value):
+        '''the lastUpdated value as an integer, the server can send it as a string'''
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def sync_changes(self, library, lastscan):
+        '''only sync the tracks, albums and artists that were added, changed or removed since the last scan'''
+        # the lightest listing of the tracks (id, title and lastUpdated) is used to find the changes
+        remote_tracks = self.get_all("titles", "tags:U", "titles_loop")
+        if remote_tracks is None:
+            return
+        checksums = library.track_checksums()
+        remote_ids = set()
+        changed = []
+        for item in remote_tracks:
+            remote_ids.add(item["id"])
+            if item["id"] not in checksums or self.checksum(checksums[item["id"]]) != self.checksum(
+                    item.get("lastUpdated")):
+                changed.append(item["id"])
+        removed = [track_id for track_id in checksums if track_id not in remote_ids]
+        tracks = self.get_by_ids("titles", "track_id", changed, "tags:%s" % TAGS_LIBRARY_TRACK, "titles_loop")
+        if tracks is None:
+            return
+        # albums of the changed and removed tracks
+        album_ids = library.album_ids(removed + changed)
+        album_ids.update([item["album_id"] for item in tracks if item.get("album_id")])
+        replace_albums = len(album_ids) > SYNC_MAX_ALBUM_LOOKUPS
+        if replace_albums:
+            albums = self.get_all("albums", "tags:%s" % TAGS_LIBRARY_ALBUM, "albums_loop")
+        else:
+            albums = self.get_by_ids("albums", "album_id", list(album_ids),
+                                     "tags:%s" % TAGS_LIBRARY_ALBUM, "albums_loop", False)
+        changes = {
+            "tracks": tracks,
+            "albums": albums,
+            # these listings only contain the id and name so they're cheap to get completely
+            "artists": self.get_all("artists", "", "artists_loop"),
+            "genres": self.get_all("genres", "", "genres_loop"),
+            "years": self.get_all("years", "", "years_loop")
+        }
+        if None in changes.values():
+            return
+        library.apply_changes(lastscan, changes, removed, replace_albums)
+        log_msg("Library index updated - %s tracks added or changed, %s tracks removed, %s albums updated" %
+                (len(tracks), len(removed), len(albums)))
+
+    def get_by_ids(self, cmd, id_key, ids, args, loop_key, multiple_ids=True):
+        '''get the items with the given ids, multiple ids are combined in a single request if supported
+           returns None if the server failed'''
+        items = []
+        chunk_size = SYNC_CHUNK_SIZE if multiple_ids else 1
+        for i in range(0, len(ids), chunk_size):
+            if self._exit.is_set():
+                return None
+            chunk = ids[i:i + chunk_size]
+            result = self.lmsserver.send_request("%s 0 %s %s:%s %s" %
+                                                 (cmd, len(chunk), id_key, ",".join(["%s" % x for x in chunk]), args))
+            if not result:
+                return None
+            found = result.get(loop_key, [])
+            if len(chunk) > 1 and len(found) < len(chunk):
+                # the server did not return all ids, request the missing ones one by one
+                found_ids = set([item["id"] for item in found])
+                missing = [item_id for item_id in chunk if item_id not in found_ids]
+                found += self.get_by_ids(cmd, id_key, missing, args, loop_key, False) or []
+            items += found
+        return items
+
+    def get_all(self, cmd, args, loop_key):
+        '''get all items of a listing from the server in pages, returns None if the server failed'''
+        items = []
+        while not self._exit.is_set():
+            result = self.lmsserver.send_request("%s %s %s %s" % (cmd, len(items), SYNC_PAGE_SIZE, args))
+            if not result:
+                return None
+            items += result.get(loop_key, [])
+            if not result.get(loop_key) or len(items) >= int(result.get("count", 0)):
+                return items
+        return None
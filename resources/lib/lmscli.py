@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    lmscli.py
+    Persistent connection to the LMS CLI (telnet) interface to receive status changes as they happen
+'''
+
+import socket
+import threading
+from urllib import quote, unquote
+from utils import log_msg, log_exception
+import xbmc
+
+CLI_DEFAULT_PORT = 9090
+RECONNECT_DELAY = 5
+# status fields which are numeric in the json api but arrive as strings on the cli
+NUMERIC_FIELDS = ["power", "time", "duration", "rate", "playlist_cur_index", "playlist_tracks",
+                  "playlist_timestamp", "playlist repeat", "playlist shuffle", "playlist index",
+                  "player_connected", "can_seek", "mixer volume", "seq_no", "id"]
+
+
+class LMSCliListener(threading.Thread):
+    '''subscribes to the player status on the LMS CLI and pushes every change to the callback'''
+    _sock = None
+    _connected = False
+
+    def __init__(self, host, port, playerid, callback):
+        self._host = host
+        self._port = int(port)
+        self._playerid = playerid
+        self._callback = callback
+        self._exit = threading.Event()
+        # subscribe:0 makes the server push the status whenever it changes
+        self._cmd = [playerid, "status", "-", "1", "tags:u", "subscribe:0"]
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    @property
+    def connected(self):
+        '''bool indicating if we have a working subscription on the cli'''
+        return self._connected
+
+    def stop(self):
+        '''stop listening and close the connection'''
+        self._exit.set()
+        self._close()
+        self.join(1)
+
+    def run(self):
+        while not self._exit.is_set():
+            try:
+                self._listen()
+            except socket.error as exc:
+                if not self._exit.is_set():
+                    log_msg("CLI connection to %s:%s lost (%s) - falling back to polling" %
+                            (self._host, self._port, exc), xbmc.LOGWARNING)
+            except Exception as exc:
+                log_exception(__name__, exc)
+            self._connected = False
+            self._close()
+            self._exit.wait(RECONNECT_DELAY)
+
+    def _listen(self):
+        '''connect to the cli, subscribe to status changes and process the incoming lines'''
+        self._sock = socket.create_connection((self._host, self._port), RECONNECT_DELAY)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # short read timeout so we can respond to a stop request
+        self._sock.settimeout(1)
+        self._sock.sendall(" ".join([quote(item, safe="") for item in self._cmd]) + "\n")
+        log_msg("Subscribed to status changes on LMS CLI at %s:%s" % (self._host, self._port), xbmc.LOGDEBUG)
+        data = ""
+        while not self._exit.is_set():
+            try:
+                chunk = self._sock.recv(4096)
+            except socket.timeout:
+                continue
+            if not chunk:
+                raise socket.error("connection closed by server")
+            data += chunk
+            while "\n" in data:
+                line, data = data.split("\n", 1)
+                status = self.parse_status(line.strip())
+                if status is not None:
+                    self._connected = True
+                    self._callback(status)
+
+    def _close(self):
+        '''close the socket if it's open'''
+        if self._sock:
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
+            self._sock = None
+
+    def parse_status(self, line):
+        '''parse a cli status line into the same structure as returned by the json api'''
+        tokens = line.split(" ")
+        if len(tokens) < len(self._cmd) or unquote(tokens[1]) != "status":
+            return None
+        status = {}
+        cur_item = None
+        for token in tokens[len(self._cmd):]:
+            token = unquote(token).decode("utf-8", "replace")
+            if ":" not in token:
+                continue
+            key, value = token.split(":", 1)
+            if key in NUMERIC_FIELDS:
+                value = self._to_number(value)
+            if key == "playlist index":
+                # all following fields belong to the (current) playlist item
+                cur_item = {key: value}
+                status.setdefault("playlist_loop", []).append(cur_item)
+            elif cur_item is not None:
+                cur_item[key] = value
+            else:
+                status[key] = value
+        return status
+
+    @staticmethod
+    def _to_number(value):
+        '''the cli returns everything as string, convert the numeric fields'''
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return value
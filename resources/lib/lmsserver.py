@@ -9,18 +9,58 @@
 '''
 
 import xbmc
-from utils import log_msg, log_exception, json, process_method_on_list
+import xbmcaddon
+from utils import log_msg, log_exception, json, process_method_on_list, THREADPOOL_SIZE, get_profile_path, ADDON_ID
 import requests
+from requests.adapters import HTTPAdapter
 import thread
 import socket
+import sys
 import threading
 import re
+import time
+from urllib import quote
 from simplecache import SimpleCache
+from trackcache import TrackCache
+from lmscli import LMSCliListener, CLI_DEFAULT_PORT
+from metrics import METRICS
+from commandqueue import CommandQueue
+from playbackclock import PlaybackClock
+from artcache import ArtworkCache
 
 TAGS_FULL = "aAcCdegGijJKlostuxyRwk"  # full track/album details
 TAGS_BASIC = "acdgjKluNxy"  # basic track details for initial listings
 TAGS_ALBUM = "yjtiqwaal"
 
+# max number of commands to send in a single batch request
+BATCH_SIZE = 50
+
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 20
+# the processing threadpool + the service loop and kodi player callbacks
+HTTP_POOL_SIZE = THREADPOOL_SIZE + 2
+
+# max seconds to wait for the status to confirm a command and the interval to check it
+COMMAND_TIMEOUT = 1.0
+COMMAND_POLL_INTERVAL = 0.1
+# log the command latency percentiles every x commands
+COMMAND_STATS_INTERVAL = 50
+
+# max seconds to wait for a discovery response and to wait for other servers after the first response
+DISCOVERY_TIMEOUT = 5
+DISCOVERY_GRACE = 0.3
+DISCOVERY_CACHE_FILE = "server.json"
+DISCOVERY_PORT = 3483
+
+# default size (in pixels) of the artwork per view type, 0 for the original image
+ARTWORK_SIZES_DEFAULT = {"albums": 300, "artists": 300, "tracks": 300, "other": 300, "fanart": 1280}
+# size suffix of an lms artwork url, e.g. cover_300x300_m.png
+ARTWORK_RESIZE_RE = re.compile(r"(_\d+x\d+(_[a-zA-Z])?)?(\.(png|jpe?g|gif))$", re.IGNORECASE)
+
+
+class ServerResponseError(Exception):
+    pass
+
 
 class LMSServer:
     ''' LMS Class containing our helper methods'''
@@ -29,18 +69,61 @@ class LMSServer:
     _playerid = None
     _state_changing = False
     _status = {}
+    _listener = None
+    _on_status = None
+    _batch_supported = None
+    _commands = None
+    artwork_proxy = None  # base url of the local artwork cache of the service
+    gateway = None  # base url of the json-rpc gateway of the service
+    recorder = None  # writes the json-rpc traffic to a file if enabled
+    replay = None  # serves the json-rpc responses from a recording instead of the server
 
     def __init__(self, host, port, playerid):
         self._host = host
         self._port = port
         self._playerid = playerid
         self._status = self.status_default()
+        self.clock = PlaybackClock()
         self.cache = SimpleCache()
+        self.trackcache = TrackCache()
+        # keep-alive http session with a bounded connection pool, shared by all threads
+        self._http = requests.Session()
+        self._http_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, pool_block=True)
+        self._http.mount("http://", self._http_adapter)
+        self._http_requests = 0
+        self._http_lock = threading.Lock()
+        self._status_changed = threading.Condition()
+        self._commands_lock = threading.Lock()
+        addon = xbmcaddon.Addon(id=ADDON_ID)
+        self.artwork_sizes = {}
+        for view, default in ARTWORK_SIZES_DEFAULT.iteritems():
+            self.artwork_sizes[view] = int(addon.getSetting("artwork_%s" % view) or default)
+        if addon.getSetting("record_traffic") == "true" and sys.argv[0].startswith("plugin://"):
+            # only the plugin sessions are recorded (the service polls the status for the whole kodi session),
+            # the recorder is only loaded when it's used
+            from traffic import TrafficRecorder
+            self.recorder = TrafficRecorder()
+        del addon
+
+    def close(self):
+        '''log the connection stats and close the http session'''
+        if self._commands:
+            self._commands.stop()
+        log_msg("HTTP connection stats: %s" % self.http_stats(), xbmc.LOGDEBUG)
+        METRICS.log_latency("command")
+        self.trackcache.log_stats()
+        if self.recorder:
+            self.recorder.close()
+        self._http.close()
 
     @property
     def host(self):
         return self._host
 
+    @property
+    def port(self):
+        return self._port
+
     @property
     def playerid(self):
         return self._playerid
@@ -48,7 +131,7 @@ class LMSServer:
     @property
     def state_changing(self):
         '''bool is set whenever a command is issued and we're waiting for the status to be updated'''
-        return self._state_changing
+        return self._state_changing or (self._commands is not None and self._commands.busy)
 
     @property
     def mode(self):
@@ -78,9 +161,13 @@ class LMSServer:
         }
 
     def update_status(self):
-        '''set the current status of the player'''
-        result = self.status_default()
+        '''poll the current status of the player'''
         status = self.send_request("status - 1 tags:u")
+        self._set_status(status)
+
+    def _set_status(self, status, pushed=False):
+        '''set the current status of the player from a (polled or pushed) status result'''
+        result = self.status_default()
         if status and "error" not in status:
             result.update(status)
             try:
@@ -89,6 +176,40 @@ class LMSServer:
             except:
                 result["url"] = ""
         self._status = result
+        self.clock.update(result["time"], result["mode"], result.get("rate", 1),
+                          (result["playlist_cur_index"], result["url"]), trusted=pushed)
+        with self._status_changed:
+            self._status_changed.notify_all()
+
+    def start_listener(self, on_status=None):
+        '''subscribe to status changes on the CLI so we don't have to poll the server'''
+        cli_port = CLI_DEFAULT_PORT
+        result = self.send_request("pref plugin.cli:cliport ?")
+        if result and result.get("_p2"):
+            cli_port = int(result["_p2"])
+        if not cli_port:
+            log_msg("CLI is disabled on the LMS server - using polling for status updates")
+            return
+        self._on_status = on_status
+        self._listener = LMSCliListener(self._host, cli_port, self._playerid, self._status_pushed)
+        self._listener.start()
+
+    def stop_listener(self):
+        '''stop the CLI subscription'''
+        if self._listener:
+            self._listener.stop()
+            self._listener = None
+
+    @property
+    def listening(self):
+        '''bool indicating if status changes are pushed by the server (no need to poll)'''
+        return self._listener is not None and self._listener.connected
+
+    def _status_pushed(self, status):
+        '''callback for the CLI listener when the server pushed a new status'''
+        self._set_status(status, pushed=True)
+        if self._on_status:
+            self._on_status()
 
     @property
     def cur_title(self):
@@ -117,33 +238,87 @@ class LMSServer:
 
     def next_track(self):
         '''go to the next track of the playlist'''
-        self.send_command("playlist jump +1")
+        return self.queue_command("playlist jump +1")
 
     def pause(self):
         '''pause the player'''
-        self.send_command("pause 1")
+        return self.queue_command("pause 1")
 
     def unpause(self):
         '''pause the player'''
-        self.send_command("pause 0")
+        return self.queue_command("pause 0")
 
     def stop(self):
         '''stop the player'''
-        self.send_command("stop")
+        return self.queue_command("stop")
+
+    def queue_command(self, cmd):
+        '''send the command from the command worker, returns a future instead of blocking the caller'''
+        with self._commands_lock:
+            if not self._commands:
+                self._commands = CommandQueue(self.send_command)
+                self._commands.start()
+        return self._commands.put(cmd)
 
     @property
     def time(self):
         '''current point in time of the player'''
-        return self._status["time"]
+        # extrapolated from the last status, a pushed status is only sent on changes
+        return self.clock.position()
 
-    def send_command(self, cmd):
-        '''send command to the player and update the status afterwards'''
+    def send_command(self, cmd, expected=None):
+        '''send command to the player and wait until the status confirms it, at most COMMAND_TIMEOUT seconds'''
+        if expected is None:
+            expected = self.expected_state(cmd)
         self._state_changing = True
-        self.send_request(cmd)
-        xbmc.sleep(500)
-        self.update_status()
-        xbmc.sleep(500)
-        self._state_changing = False
+        start = time.time()
+        try:
+            self.send_request(cmd)
+            confirmed = self.wait_for_status(expected, start + COMMAND_TIMEOUT)
+        finally:
+            self._state_changing = False
+        duration = time.time() - start
+        if not confirmed:
+            log_msg("Command %s not confirmed by the server within %s seconds" % (cmd, COMMAND_TIMEOUT), xbmc.LOGDEBUG)
+        METRICS.record_latency("command.%s" % cmd.split(" ")[0], duration)
+        if METRICS.record_latency("command", duration) % COMMAND_STATS_INTERVAL == 0:
+            METRICS.log_latency("command")
+        return confirmed
+
+    def expected_state(self, cmd):
+        '''returns a function which checks if the status reflects the command, None if there is nothing to check'''
+        params = cmd.split(" ")
+        if cmd in ("pause 1", "pause 0", "play", "stop"):
+            expected_mode = {"pause 1": "pause", "pause 0": "play", "play": "play", "stop": "stop"}[cmd]
+            return lambda server: server.mode == expected_mode
+        elif params[0] == "power" and len(params) == 2:
+            return lambda server: str(server.power) == params[1]
+        elif params[0] == "time" and len(params) == 2:
+            try:
+                seek_time = float(params[1])
+            except ValueError:
+                return None
+            return lambda server: abs(float(server.time) - seek_time) < 2
+        elif cmd.startswith("playlist index ") and params[2].isdigit():
+            return lambda server: server.cur_index == int(params[2])
+        elif cmd.startswith("playlist jump "):
+            prev_index = self.cur_index
+            prev_timestamp = self.timestamp
+            return lambda server: server.cur_index != prev_index or server.timestamp != prev_timestamp
+        return None
+
+    def wait_for_status(self, expected, deadline):
+        '''wait for a (pushed or polled) status which matches the expected state, returns False on the deadline'''
+        while True:
+            if not self.listening:
+                self.update_status()
+            if expected is None or expected(self):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            with self._status_changed:
+                self._status_changed.wait(min(remaining, COMMAND_POLL_INTERVAL))
 
     def synced_players(self):
         '''get the synced players'''
@@ -163,29 +338,89 @@ class LMSServer:
                 result = self.process_trackdetails(result)
         return result
 
-    def process_trackdetails(self, items):
+    def process_trackdetails(self, items, lookup=True):
         '''processes a list with songs to grab the full track details'''
-        return process_method_on_list(self.trackdetails, items)
+        if not lookup:
+            # the songs already have the full details, only fix the formatting
+            return [self.format_trackdetails(lms_song, False) for lms_song in items]
+        result = []
+        lookup = []
+        for lms_song in items:
+            cache = self.get_cached_trackdetails(lms_song)
+            if cache:
+                result.append(cache)
+            else:
+                # details are merged into the song dict itself
+                result.append(lms_song)
+                lookup.append(lms_song)
+        # grab the details of all tracks not in the cache with as few requests as possible
+        track_ids = [lms_song["id"] for lms_song in lookup if self.is_library_track(lms_song)]
+        all_details = self.get_songinfo_bulk(track_ids) if track_ids else {}
+        missing = []
+        for lms_song in lookup:
+            if self.is_library_track(lms_song):
+                details = all_details.get(str(lms_song["id"]))
+                if not details:
+                    # tracks missing in the bulk results are processed one by one
+                    missing.append(lms_song)
+                    continue
+                self.merge_trackdetails(lms_song, details)
+            self.format_trackdetails(lms_song)
+        if missing:
+            process_method_on_list(self.trackdetails, missing)
+        return result
 
     def trackdetails(self, lms_song):
         '''gets the full track details and fixes the formatting for kodi compatability'''
         # check cache first
-        cache_str = "lmssongdetails.%s.%s" % (lms_song.get("id"), lms_song["title"])
-        cache = self.cache.get(cache_str, checksum=lms_song.get("lastUpdated"))
+        cache = self.get_cached_trackdetails(lms_song)
         if cache:
-            # merge the details - do not overwrite the playlist index with value from cache
-            cache["playlist index"] = lms_song.get("playlist index")
             return cache
         # grab rating, lyrics and comment field (these can't be grabbed from the
         # overall results as it causes strange issues)
-        if "id" in lms_song and not int(lms_song.get("remote", 0)):
+        if self.is_library_track(lms_song):
             result = self.send_request("songinfo 0 100 tags:%s track_id:%s" % (TAGS_FULL, lms_song["id"]))
-            if result and result.get("songinfo_loop") and result["songinfo_loop"]:
-                for item in result["songinfo_loop"]:
-                    # merge results without overwriting
-                    for key, value in item.iteritems():
-                        if not (lms_song.get(key) or lms_song.get(key) == "0"):
-                            lms_song[key] = value
+            if result and result.get("songinfo_loop"):
+                self.merge_trackdetails(lms_song, self.parse_songinfo(result["songinfo_loop"]))
+        return self.format_trackdetails(lms_song)
+
+    @staticmethod
+    def is_library_track(lms_song):
+        '''bool indicating if the song is a track in the local library (and not a radio stream)'''
+        return "id" in lms_song and not int(lms_song.get("remote", 0))
+
+    @staticmethod
+    def trackdetails_cache_str(lms_song):
+        '''the key for the trackdetails in the cache'''
+        return "lmssongdetails.%s.%s" % (lms_song.get("id"), lms_song["title"])
+
+    def get_cached_trackdetails(self, lms_song):
+        '''get the full track details from the cache'''
+        cache = self.trackcache.get(self.trackdetails_cache_str(lms_song), checksum=lms_song.get("lastUpdated"))
+        if cache:
+            # merge the details - do not overwrite the playlist index with value from cache
+            cache["playlist index"] = lms_song.get("playlist index")
+        return cache
+
+    @staticmethod
+    def parse_songinfo(songinfo_loop):
+        '''songinfo is really weird formatted in the server response, flatten it into one dict'''
+        result = {}
+        for item in songinfo_loop:
+            if isinstance(item, dict):
+                for key, value in item.iteritems():
+                    result.setdefault(key, value)
+        return result
+
+    @staticmethod
+    def merge_trackdetails(lms_song, details):
+        '''merge the full details into the song without overwriting'''
+        for key, value in details.iteritems():
+            if not (lms_song.get(key) or lms_song.get(key) == "0"):
+                lms_song[key] = value
+
+    def format_trackdetails(self, lms_song, store=True):
+        '''fixes the formatting of the track details for kodi compatability and stores them in the cache'''
         # correct some other weird stuff
         if not "track_number" in lms_song and "tracknum" in lms_song:
             lms_song["track_number"] = lms_song["tracknum"]
@@ -199,13 +434,37 @@ class LMSServer:
         if "rating" in lms_song:
             lms_song["rating"] = str((int(lms_song["rating"]) / 100) * 5)
         # grab thumb
-        lms_song["thumb"] = self.get_thumb(lms_song)
-        if "id" in lms_song and not int(lms_song.get("remote", 0)):  # do not save radio streams to cache
-            self.cache.set(cache_str, lms_song, checksum=lms_song.get("lastUpdated"))
+        lms_song["thumb"] = self.get_thumb(lms_song, "tracks")
+        if store and "id" in lms_song:  # radio streams are only kept for a short time
+            self.trackcache.set(self.trackdetails_cache_str(lms_song), lms_song,
+                                checksum=lms_song.get("lastUpdated"), remote=not self.is_library_track(lms_song))
         return lms_song
 
-    def send_request(self, cmd):
-        '''send request to lms server'''
+    def get_songinfo_bulk(self, track_ids):
+        '''get the full details for many tracks at once, returns a dict with the track id as key'''
+        result = {}
+        for i in range(0, len(track_ids), BATCH_SIZE):
+            chunk = track_ids[i:i + BATCH_SIZE]
+            # prefer a json-rpc batch of songinfo requests, these return the most complete details
+            cmds = ["songinfo 0 100 tags:%s track_id:%s" % (TAGS_FULL, track_id) for track_id in chunk]
+            batch_result = self.send_batch(cmds)
+            if batch_result is not None:
+                for track_id, item in zip(chunk, batch_result):
+                    if item and item.get("songinfo_loop"):
+                        result[str(track_id)] = self.parse_songinfo(item["songinfo_loop"])
+            else:
+                # server does not support batches, query all tracks in a single titles request
+                cmd = "titles 0 %s tags:%s track_id:%s" % (len(chunk), TAGS_FULL, ",".join([str(x) for x in chunk]))
+                tracks_result = self.send_request(cmd)
+                if tracks_result and tracks_result.get("titles_loop"):
+                    for item in tracks_result["titles_loop"]:
+                        if "id" in item:
+                            result[str(item["id"])] = item
+        return result
+
+    @staticmethod
+    def split_cmd(cmd):
+        '''split a command string into the list of params for the json api'''
         if isinstance(cmd, (str, unicode)):
             if "[SP]" in cmd:
                 new_cmd = []
@@ -214,33 +473,115 @@ class LMSServer:
                 cmd = new_cmd
             else:
                 cmd = cmd.split()
-        url = "http://%s:%s/jsonrpc.js" % (self._host, self._port)
-        cmd = [self._playerid, cmd]
+        return cmd
+
+    def send_request(self, cmd):
+        '''send request to lms server'''
+        cmd = [self._playerid, self.split_cmd(cmd)]
         params = {"id": 1, "method": "slim.request", "params": cmd}
-        result = self.get_json(url, params)
+        result = self.send_jsonrpc(params)
         return result
 
+    def send_batch(self, cmds):
+        '''send multiple requests to the lms server in a single (json-rpc batch) http exchange
+           returns a list with the results in the same order or None if the server doesn't support batches'''
+        if self._batch_supported is False:
+            return None
+        params = [{"id": idx, "method": "slim.request", "params": [self._playerid, self.split_cmd(cmd)]}
+                  for idx, cmd in enumerate(cmds)]
+        response = self.send_jsonrpc(params)
+        if not isinstance(response, list):
+            # the server drops the connection of a batch if it doesn't support them, so a failed first batch
+            # also means no support, a failure after batches worked is a network hiccup
+            if response or self._batch_supported is None:
+                log_msg("LMS server does not support batched requests", xbmc.LOGDEBUG)
+                self._batch_supported = False
+            return None
+        self._batch_supported = True
+        results = [{} for cmd in cmds]
+        for item in response:
+            if isinstance(item, dict) and item.get("id") in range(len(cmds)):
+                results[item["id"]] = item.get("result", {})
+        return results
+
+    def send_jsonrpc(self, params):
+        '''send the json-rpc request, the request and response are recorded if enabled'''
+        if self.replay:
+            return self.replay.response(params)
+        start = time.time()
+        result = self._send_jsonrpc(params)
+        if self.recorder:
+            self.recorder.record(params, result, time.time() - start)
+        return result
+
+    def _send_jsonrpc(self, params):
+        '''send the json-rpc request, through the gateway of the service if it's available'''
+        if self.gateway:
+            try:
+                return self.get_json("%s/jsonrpc.js" % self.gateway, params, raise_errors=True)
+            except ServerResponseError as exc:
+                # the gateway works, the server itself failed (or rejected the request)
+                log_msg("Request failed on the server - command: %s - %s" % (params, exc), xbmc.LOGDEBUG)
+                return {}
+            except Exception as exc:
+                log_msg("Gateway of the service not available, using the server directly: %s" % exc,
+                        xbmc.LOGWARNING)
+                self.gateway = None
+        return self.get_json("http://%s:%s/jsonrpc.js" % (self._host, self._port), params)
+
     @staticmethod
-    def get_json(url, params):
+    def request_verb(params):
+        '''the command verb (e.g. status, albums) of a json-rpc request for the statistics'''
+        if isinstance(params, list):
+            return "batch"
+        try:
+            return params["params"][1][0]
+        except (TypeError, KeyError, IndexError):
+            return "unknown"
+
+    def get_json(self, url, params, raise_errors=False):
         '''get info from json api'''
         result = {}
+        verb = self.request_verb(params)
+        start = time.time()
         try:
-            response = requests.get(url, data=json.dumps(params), timeout=20)
+            with self._http_lock:
+                self._http_requests += 1
+            response = self._http.get(url, data=json.dumps(params),
+                                      timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
             if response and response.content and response.status_code == 200:
                 result = json.loads(response.content.decode('utf-8', 'replace'))
                 if "result" in result:
                     result = result["result"]
+            elif raise_errors:
+                METRICS.increment("request.%s.errors" % verb)
+                raise ServerResponseError("server response: %s" % response.status_code)
             else:
+                METRICS.increment("request.%s.errors" % verb)
                 log_msg("Invalid or empty reponse from server - command: %s - server response: %s" %
-                        (cmd, response.status_code))
+                        (params, response.status_code))
         except Exception:
+            if raise_errors:
+                raise
+            METRICS.increment("request.%s.errors" % verb)
             log_exception(__name__, "Server is offline or connection error...")
-
-        #log_msg("%s --> %s" %(params, result))
+        METRICS.record_latency("request.%s" % verb, time.time() - start)
         return result
 
-    def get_thumb(self, item):
-        '''get thumb url from the item's properties'''
+    def http_stats(self):
+        '''return the number of requests and connections made by our http session'''
+        stats = {"requests": self._http_requests, "connections": 0}
+        try:
+            pools = self._http_adapter.poolmanager.pools
+            for key in pools.keys():
+                stats["connections"] += pools[key].num_connections
+        except Exception as exc:
+            log_exception(__name__, exc)
+        stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+        return stats
+
+    def get_thumb(self, item, view="other"):
+        '''get thumb url from the item's properties, resized by the server to the size for the view type'''
         thumb = ""
         if item.get("image"):
             thumb = item["image"]
@@ -264,14 +605,45 @@ class LMSServer:
             thumb = "imageproxy/mai/artist/%s/image.png" % item["id"]
         elif "window" in item and "icon-id" in item["window"]:
             thumb = item["window"]["icon-id"]
-
-        if thumb and not thumb.startswith("http"):
-            server_url = "http://%s:%s" % (self._host, self._port)
-            if thumb.startswith("/"):
-                thumb = "%s%s" % (server_url, thumb)
+        return self.get_sized_artwork(thumb, view)
+
+    def get_sized_artwork(self, url, view="other"):
+        '''get the url of the artwork resized by the server to the size for the view type (thumbs or fanart)'''
+        if not url:
+            return url
+        server_url = "http://%s:%s" % (self._host, self._port)
+        local_path = ArtworkCache.parse_local_url(url)
+        if local_path is not None:
+            url = local_path
+        elif url.startswith(server_url):
+            url = url[len(server_url):]
+        size = self.artwork_sizes.get(view, 0)
+        if size and url.startswith("http"):
+            # remote images are resized by the imageproxy of the server
+            url = "imageproxy/%s/image_%sx%s_m.png" % (quote(url.encode("utf-8"), safe=""), size, size)
+        elif size and "?" not in url:
+            # every image served by lms can be resized with a size suffix
+            url = ARTWORK_RESIZE_RE.sub(r"_%sx%s_m\3" % (size, size), url)
+        if not url.startswith("http") and self.artwork_proxy:
+            # served by the cache of the service, repeated browsing doesn't reach the server
+            url = ArtworkCache.get_local_url(self.artwork_proxy, url)
+        elif not url.startswith("http"):
+            if url.startswith("/"):
+                url = "%s%s" % (server_url, url)
             else:
-                thumb = "%s/%s" % (server_url, thumb)
-        return thumb
+                url = "%s/%s" % (server_url, url)
+        return url
+
+    def get_artwork_bytes(self, urls):
+        '''total size in bytes of the artwork at the urls, retrieved with head requests'''
+        total = 0
+        for url in set(urls):
+            try:
+                response = self._http.head(url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+                total += int(response.headers.get("content-length", 0))
+            except Exception as exc:
+                log_exception(__name__, exc)
+        return total
 
 
 
@@ -283,42 +655,104 @@ class LMSDiscovery(object):
         self.last_scan = None
         self._lock = threading.RLock()
 
-    def scan(self):
+    def scan(self, preferred=None, wait_all=False):
         """Scan the network for servers."""
         with self._lock:
-            self.update()
+            self.update(preferred, wait_all)
+            self.last_scan = time.time()
 
-    def all(self):
+    def all(self, preferred=None, wait_all=False):
         """Scan and return all found entries as a list. Each server is a dict."""
-        self.scan()
+        self.scan(preferred, wait_all)
         return list(self.entries)
 
-    def update(self):
-        """update the server netry with details"""
+    def update(self, preferred=None, wait_all=False):
+        """update the server entries with details, ranked by the preferred server and the round trip time"""
         lms_ip = '<broadcast>'
-        lms_port = 3483
-        # JSON tag has the port number, it's all we need here.
-        lms_msg = "eJSON\0"
-        lms_timeout = 5
+        lms_port = DISCOVERY_PORT
+        # ask for the name, uuid and json port of the server
+        lms_msg = "eNAME\0UUID\0JSON\0"
         entries = []
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        sock.settimeout(lms_timeout)
         sock.bind(('', 0))
         try:
+            start = time.time()
             sock.sendto(lms_msg, (lms_ip, lms_port))
-            while True:
+            if preferred and preferred.get("host"):
+                # the last used server is also asked directly in case broadcasts don't reach it
+                sock.sendto(lms_msg, (preferred["host"], lms_port))
+            deadline = start + DISCOVERY_TIMEOUT
+            while time.time() < deadline:
+                sock.settimeout(max(deadline - time.time(), 0.01))
                 try:
                     data, server = sock.recvfrom(1024)
-                    host, _ = server
-                    if data.startswith(b'E'):
-                        port = data.split("\x04")[1]
-                        entries.append({'port': int(port),
-                                        'data': data,
-                                        'from': server,
-                                        'host': host})
                 except socket.timeout:
                     break
+                host, _ = server
+                details = self.parse_response(data)
+                if "JSON" not in details or host in [entry["host"] for entry in entries]:
+                    continue
+                if details.get("UUID") and details["UUID"] in [entry["uuid"] for entry in entries]:
+                    # the same server responded on another address
+                    continue
+                entry = {'port': int(details["JSON"]),
+                         'data': data,
+                         'from': server,
+                         'host': host,
+                         'name': details.get("NAME", "").decode("utf-8", "replace"),
+                         'uuid': details.get("UUID", ""),
+                         'rtt': time.time() - start}
+                entries.append(entry)
+                if wait_all:
+                    continue
+                if self.is_same_server(entry, preferred):
+                    # the server we used last time is still there
+                    break
+                # don't wait for the timeout, only for other servers which respond shortly after
+                deadline = min(deadline, time.time() + DISCOVERY_GRACE)
         finally:
             sock.close()
+        entries.sort(key=lambda entry: (not self.is_same_server(entry, preferred), entry["rtt"]))
         self.entries = entries
+
+    @staticmethod
+    def parse_response(data):
+        """parse the tag/length/value pairs of a discovery response"""
+        details = {}
+        if not data.startswith(b'E'):
+            return details
+        pos = 1
+        while pos + 5 <= len(data):
+            tag = data[pos:pos + 4]
+            length = ord(data[pos + 4])
+            details[tag] = data[pos + 5:pos + 5 + length]
+            pos += 5 + length
+        return details
+
+    @staticmethod
+    def is_same_server(entry, preferred):
+        """bool indicating if the entry is the preferred server, the uuid stays the same if the server moved"""
+        if not preferred:
+            return False
+        if preferred.get("uuid") and entry.get("uuid"):
+            return preferred["uuid"] == entry["uuid"]
+        return preferred.get("host") == entry.get("host")
+
+    @staticmethod
+    def get_cached():
+        """the last server we successfully used, stored in the addon profile"""
+        try:
+            with open(get_profile_path(DISCOVERY_CACHE_FILE)) as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            return None
+
+    @staticmethod
+    def set_cached(entry):
+        """store the server we use so the next startup can try it first"""
+        try:
+            with open(get_profile_path(DISCOVERY_CACHE_FILE), "w") as cache_file:
+                json.dump(dict((key, entry.get(key)) for key in ["host", "port", "name", "uuid"]), cache_file)
+        except IOError as exc:
+            log_exception(__name__, exc)
@@ -11,6 +11,12 @@
 from utils import log_msg, ADDON_ID, log_exception, get_mac, get_squeezelite_binary, get_audiodevice
 from player_monitor import KodiPlayer
 from lmsserver import LMSServer, LMSDiscovery
+from library import LibrarySync
+from httpproxy import ProxyRunner, ENGINE_EVENTLOOP, ENGINE_THREADED
+from startup import StartupPipeline
+from artcache import ArtworkCache, MAX_MB_DEFAULT
+from gateway import LMSGateway
+from metrics import METRICS
 import xbmc
 import xbmcaddon
 import xbmcgui
@@ -20,6 +26,30 @@ import sys
 import xbmcvfs
 import stat
 import threading
+import time
+
+# max seconds to wait for the old squeezelite processes to exit
+KILL_TIMEOUT = 2
+# max seconds to wait for the power commands at start and stop
+POWER_COMMAND_TIMEOUT = 2
+# seconds between the background scans for servers
+DISCOVERY_RESCAN_INTERVAL = 600
+# max seconds kodi and lms may differ before we seek
+SEEK_THRESHOLD = 2
+# kodi is only seeked for a difference without a jump on the server when it persists this many checks
+DRIFT_CHECKS = 5
+
+
+class NotificationMonitor(xbmc.Monitor):
+    '''passes the notifications which the plugin sends with NotifyAll to the service'''
+
+    def __init__(self, callback):
+        self._callback = callback
+        xbmc.Monitor.__init__(self)
+
+    def onNotification(self, sender, method, data):
+        if sender == ADDON_ID:
+            self._callback(method.split(".")[-1], data)
 
 
 class MainService(threading.Thread):
@@ -30,76 +60,208 @@ class MainService(threading.Thread):
     addon = None
     win = None
     kodiplayer = None
+    library_sync = None
     _sl_exec = None
     _prev_checksum = ""
     _temp_power_off = False
+    _ended_stream_index = None
+    _proxy = None
+    _seek_pending = False
+    _drift_checks = 0
+    _notifications = None
+    _profiler = None
+    _profile_ticks = 0
 
     def __init__(self, *args, **kwargs):
         self.win = xbmcgui.Window(10000)
         self.win.clearProperty("lmsexit")
         self.addon = xbmcaddon.Addon(id=ADDON_ID)
         self.kodimonitor = kwargs.get("kodimonitor")
-        self._webport = kwargs.get("webport")
+        self._notifications = NotificationMonitor(self.on_notification)
         self.event = threading.Event()
         threading.Thread.__init__(self, *args)
 
     def run(self):
+        # the startup phases run concurrently where they don't depend on each other
+        pipeline = StartupPipeline()
+        pipeline.add("playerid", self.get_playerid)
+        pipeline.add("discovery", self.discover_server)
+        pipeline.add("audiodevice", self.get_squeezelite_args)
+        pipeline.add("proxy", self.start_proxy)
+        pipeline.add("lmsserver", self.connect_server, ["playerid", "discovery"])
+        pipeline.add("squeezelite", self.start_squeezelite, ["lmsserver", "audiodevice"])
+        pipeline.add("player", self.start_player, ["lmsserver", "proxy", "squeezelite"])
+        results = pipeline.run()
 
-        # get playerid based on mac address
+        if "player" in results:
+            # mainloop
+            playerid = results["playerid"]
+            is_local_android = (xbmc.getCondVisibility("System.Platform.Android") and
+                                playerid.lower() == get_mac().lower())
+            while not self.exit:
+                # monitor the LMS state changes
+                if not is_local_android:
+                    # TODO: implement fake OSD for android
+                    tick_start = time.time()
+                    if self._profile_ticks:
+                        self.profile_tick()
+                    else:
+                        self.monitor_lms()
+                    METRICS.record_latency("service.tick", time.time() - tick_start)
+                # sleep for 1 second or until the server pushes a status change
+                self.event.wait(1)
+                self.event.clear()
+
+    def on_notification(self, message, data):
+        '''handle a notification of the plugin'''
+        if message == "profile_service":
+            if self._profiler:
+                # the running profile is kept, it's written when its iterations are done
+                log_msg("Already profiling the service loop, %s iterations left" % self._profile_ticks,
+                        xbmc.LOGNOTICE)
+                return
+            # the profiler is only loaded when it's used
+            from profiling import Profiler
+            self._profiler = Profiler()
+            self._profile_ticks = int(data)
+            log_msg("Profiling the next %s iterations of the service loop" % data, xbmc.LOGNOTICE)
+
+    def profile_tick(self):
+        '''run monitor_lms in the profiler, the profile is written after the requested number of iterations'''
+        self._profiler.runcall(self.monitor_lms)
+        self._profile_ticks -= 1
+        if not self._profile_ticks:
+            self._profiler.save("service_loop")
+            self._profiler = None
+
+    def get_playerid(self, results):
+        '''startup phase: get playerid based on mac address'''
         if self.addon.getSetting("disable_auto_mac") == "true" and self.addon.getSetting("manual_mac"):
-            playerid = self.addon.getSetting("manual_mac").decode("utf-8")
-        else:
-            playerid = get_mac()
+            return self.addon.getSetting("manual_mac").decode("utf-8")
+        return get_mac()
 
-        # discover server
+    def discover_server(self, results):
+        '''startup phase: get the host and port of the server'''
         if self.addon.getSetting("disable_auto_lms") == "true":
             # manual server
-            lmshost = self.addon.getSetting("lms_hostname")
-            lmsport = self.addon.getSetting("lms_port")
-            self.lmsserver = LMSServer(lmshost, lmsport, playerid)
+            return self.addon.getSetting("lms_hostname"), self.addon.getSetting("lms_port")
+        # auto discovery, the server we used last time is tried first
+        cached = LMSDiscovery.get_cached()
+        while not self.exit:
+            servers = LMSDiscovery().all(preferred=cached)
+            log_msg("discovery: %s" % servers)
+            if servers:
+                # the servers are ranked: the last used server if found, otherwise the fastest responding one
+                server = servers[0]
+                log_msg("LMS server discovered - host: %s - port: %s" % (server.get("host"), server.get("port")))
+                LMSDiscovery.set_cached(server)
+                rescan = threading.Thread(target=self.rescan_servers, args=(server,))
+                rescan.daemon = True
+                rescan.start()
+                return server.get("host"), server.get("port")
+            self.kodimonitor.waitForAbort(2)
+        raise RuntimeError("service stopped before a server was discovered")
+
+    def rescan_servers(self, server):
+        '''keep scanning the network in the background so the cached server follows a server that moved'''
+        while not self.exit:
+            servers = LMSDiscovery().all(preferred=server, wait_all=True)
+            if servers and not LMSDiscovery.is_same_server(servers[0], server):
+                log_msg("LMS server %s:%s not found anymore, %s:%s will be used on the next start" %
+                        (server["host"], server["port"], servers[0]["host"], servers[0]["port"]), xbmc.LOGWARNING)
+            if servers:
+                if servers[0]["host"] != server["host"] and LMSDiscovery.is_same_server(servers[0], server):
+                    log_msg("LMS server moved to %s:%s" % (servers[0]["host"], servers[0]["port"]), xbmc.LOGWARNING)
+                LMSDiscovery.set_cached(servers[0])
+                # the next scans compare with the new address, the change is only logged once
+                server = servers[0]
+            if self.kodimonitor.waitForAbort(DISCOVERY_RESCAN_INTERVAL):
+                break
+
+    def get_squeezelite_args(self, results):
+        '''startup phase: find the squeezelite binary and audio device and stop any running instance'''
+        if self.addon.getSetting("disable_auto_squeezelite") == "true":
+            return None
+        sl_binary = get_squeezelite_binary()
+        if not sl_binary:
+            return None
+        try:
+            sl_output = get_audiodevice(sl_binary)
+        except Exception as exc:
+            log_exception(__name__, exc)
+            return None
+        self.kill_squeezelite()
+        return sl_binary, sl_output
+
+    def start_proxy(self, results):
+        '''startup phase: start the webservice (which hosts our silenced audio tracks)'''
+        if self.addon.getSetting("proxy_threaded") == "true":
+            engine = ENGINE_THREADED
         else:
-            # auto discovery
-            while not self.lmsserver and not self.exit:
-                servers = LMSDiscovery().all()
-                log_msg("discovery: %s" % servers)
-                if servers:
-                    server = servers[0]  # for now, just use the first server discovered
-                    lmshost = server.get("host")
-                    lmsport = server.get("port")
-                    self.lmsserver = LMSServer(lmshost, lmsport, playerid)
-                    log_msg("LMS server discovered - host: %s - port: %s" % (lmshost, lmsport))
-                else:
-                    self.kodimonitor.waitForAbort(2)
+            engine = ENGINE_EVENTLOOP
+        artwork_cache = None
+        if self.addon.getSetting("artwork_cache") == "true":
+            try:
+                artwork_cache = ArtworkCache(
+                    int(self.addon.getSetting("artwork_cache_mb") or MAX_MB_DEFAULT) * 1024 * 1024)
+            except Exception as exc:
+                # the artwork is loaded from the server directly
+                log_exception(__name__, exc)
+        self._proxy = ProxyRunner(host='127.0.0.1', allow_ranges=True, engine=engine, artwork_cache=artwork_cache)
+        self._proxy.start()
+        self._proxy.ready_wait()
+        log_msg('started webproxy at port {0}'.format(self._proxy.get_port()))
+        return self._proxy.get_port()
 
-        if self.lmsserver:
-            # publish lmsdetails as window properties for the plugin entry
-            self.win.setProperty("lmshost", lmshost)
-            self.win.setProperty("lmsport", str(lmsport))
-            self.win.setProperty("lmsplayerid", playerid)
+    def connect_server(self, results):
+        '''startup phase: setup our connection to the server'''
+        lmshost, lmsport = results["discovery"]
+        playerid = results["playerid"]
+        self.lmsserver = LMSServer(lmshost, lmsport, playerid)
+        # publish lmsdetails as window properties for the plugin entry
+        self.win.setProperty("lmshost", lmshost)
+        self.win.setProperty("lmsport", str(lmsport))
+        self.win.setProperty("lmsplayerid", playerid)
+        return self.lmsserver
 
-            # start squeezelite executable
-            self.start_squeezelite()
+    def start_player(self, results):
+        '''startup phase: start monitoring the player'''
+        artwork_cache = self._proxy.artwork_cache
+        if artwork_cache:
+            # the artwork of the server is served from the local cache of our webproxy
+            artwork_cache.set_server(self.lmsserver.host, self.lmsserver.port)
+            self.lmsserver.artwork_proxy = artwork_cache.base_url
+            self.win.setProperty("lmsartwork", artwork_cache.base_url)
+        # the plugin sends its requests through our webproxy
+        self.win.setProperty("lmsgateway", self._proxy.set_gateway(LMSGateway(self.lmsserver.host,
+                                                                              self.lmsserver.port)))
+        # initialize kodi player monitor
+        self.kodiplayer = KodiPlayer(lmsserver=self.lmsserver, webport=results["proxy"], artwork_cache=artwork_cache)
 
-            # initialize kodi player monitor
-            self.kodiplayer = KodiPlayer(lmsserver=self.lmsserver, webport=self._webport)
+        # report player as awake
+        self.lmsserver.queue_command("power 1").result(POWER_COMMAND_TIMEOUT)
 
-            # report player as awake
-            self.lmsserver.send_command("power 1")
+        # get status changes pushed by the server, wakes up our mainloop on every change
+        self.lmsserver.start_listener(on_status=self.event.set)
 
-            # mainloop
-            while not self.exit:
-                # monitor the LMS state changes
-                if not (xbmc.getCondVisibility("System.Platform.Android") and playerid.lower() == get_mac().lower()):
-                    # TODO: implement fake OSD for android
-                    self.monitor_lms()
-                # sleep for 1 second
-                self.kodimonitor.waitForAbort(1)
+        # keep the local library index in sync for browsing
+        if self.addon.getSetting("library_index") == "true":
+            self.library_sync = LibrarySync(self.lmsserver)
+            self.library_sync.start()
+        return True
 
     def stop(self):
         '''stop running our background service '''
+        if self.library_sync:
+            self.library_sync.stop()
         if self.lmsserver:
-            self.lmsserver.send_command("power 0")  # report player as powered off
+            self.lmsserver.stop_listener()
+            # report player as powered off
+            self.lmsserver.queue_command("power 0").result(POWER_COMMAND_TIMEOUT)
+            self.lmsserver.close()
         self.win.setProperty("lmsexit", "true")
+        self.win.clearProperty("lmsartwork")
+        self.win.clearProperty("lmsgateway")
         self.stop_squeezelite()
         if self.kodiplayer:
             self.kodiplayer.close()
@@ -108,13 +270,17 @@ class MainService(threading.Thread):
         self.event.set()
         self.event.clear()
         self.join(0.5)
+        if self._proxy:
+            self._proxy.stop()
+        del self._notifications
         del self.win
         del self.addon
 
     def monitor_lms(self):
         '''monitor the state of the self.lmsserver/player'''
-        # poll the status every interval
-        self.lmsserver.update_status()
+        # only poll the status if the server is not pushing the changes to us
+        if not self.lmsserver.listening:
+            self.lmsserver.update_status()
 
         if self.exit:
             return
@@ -126,20 +292,22 @@ class MainService(threading.Thread):
             if self._sl_exec and (self.lmsserver.power ==
                                   1 or not self._temp_power_off) and xbmc.getCondVisibility("Player.HasVideo"):
                 # turn off lms player when kodi is playing video
-                self.lmsserver.send_command("power 0")
+                self.lmsserver.queue_command("power 0")
                 self._temp_power_off = True
                 self.kodiplayer.is_playing = False
                 log_msg("Kodi started playing video - disabled the LMS player")
             elif self._temp_power_off and not xbmc.getCondVisibility("Player.HasVideo"):
                 # turn on player again when video playback was finished
-                self.lmsserver.send_command("power 1")
+                self.lmsserver.queue_command("power 1")
                 self._temp_power_off = False
             elif self.kodiplayer.is_playing and self._prev_checksum != self.lmsserver.timestamp:
                 # the playlist was modified
                 self._prev_checksum = self.lmsserver.timestamp
                 log_msg("playlist changed on lms server")
-                self.kodiplayer.update_playlist()
-                self.kodiplayer.play(self.kodiplayer.playlist, startpos=self.lmsserver.cur_index)
+                # only restart playback if the current item was changed
+                if (self.kodiplayer.update_playlist() or
+                        self.kodiplayer.playlist.getposition() != self.lmsserver.cur_index):
+                    self.kodiplayer.play(self.kodiplayer.playlist, startpos=self.lmsserver.cur_index)
             elif not self.kodiplayer.is_playing and self.lmsserver.mode == "play":
                 # playback started
                 log_msg("play started by lms server")
@@ -148,6 +316,8 @@ class MainService(threading.Thread):
                 self.kodiplayer.play(self.kodiplayer.playlist, startpos=self.lmsserver.cur_index)
 
             elif self.kodiplayer.is_playing:
+                if self.kodiplayer.playlist.getposition() == self.lmsserver.cur_index:
+                    self._ended_stream_index = None
                 # monitor some conditions if the player is playing
                 if self.kodiplayer.is_playing and self.lmsserver.mode == "stop":
                     # playback stopped
@@ -168,9 +338,19 @@ class MainService(threading.Thread):
                     log_msg("pause requested by lms server")
                     self.kodiplayer.pause()
                 elif self.kodiplayer.playlist.getposition() != self.lmsserver.cur_index:
-                    # other track requested
-                    log_msg("other track requested by lms server")
-                    self.kodiplayer.play(self.kodiplayer.playlist, startpos=self.lmsserver.cur_index)
+                    cur_index = self.kodiplayer.playlist.getposition()
+                    if (self._proxy and self.lmsserver.cur_index == cur_index + 1 and
+                            self.kodiplayer.is_radio_item(cur_index)):
+                        # the server moved on from the radio stream, end our endless stream
+                        # so kodi advances to the next item by itself
+                        if self._ended_stream_index != cur_index:
+                            log_msg("radio stream ended by lms server")
+                            self._ended_stream_index = cur_index
+                            self._proxy.end_streams()
+                    else:
+                        # other track requested
+                        log_msg("other track requested by lms server")
+                        self.kodiplayer.play(self.kodiplayer.playlist, startpos=self.lmsserver.cur_index)
                 elif self.lmsserver.status["title"] != xbmc.getInfoLabel("MusicPlayer.Title").decode("utf-8"):
                     # monitor if title still matches
                     log_msg("title mismatch - updating playlist...")
@@ -178,43 +358,49 @@ class MainService(threading.Thread):
                     self.kodiplayer.play(self.kodiplayer.playlist, startpos=self.lmsserver.cur_index)
                 elif self.lmsserver.mode == "play" and not self.lmsserver.status["current_title"]:
                     # check if seeking is needed - if current_title has value, it means it's a radio stream so we ignore that
-                    # we accept a difference of max 2 seconds
+                    # the playback clock filters the network jitter so we only follow real jumps on the server
+                    # a difference which persists (e.g. kodi stalled) is corrected as well
+                    self._seek_pending = self._seek_pending or self.lmsserver.clock.consume_discontinuity()
                     cur_time_lms = int(self.lmsserver.time)
                     cur_time_kodi = self.kodiplayer.cur_time()
-                    if cur_time_kodi > 2:
-                        if cur_time_kodi != cur_time_lms and abs(
-                                cur_time_lms - cur_time_kodi) > 2 and not xbmc.getCondVisibility("Player.Paused"):
+                    if abs(cur_time_lms - cur_time_kodi) > SEEK_THRESHOLD:
+                        self._drift_checks += 1
+                    else:
+                        self._drift_checks = 0
+                        self._seek_pending = False
+                    if cur_time_kodi > 2 and not xbmc.getCondVisibility("Player.Paused"):
+                        if self._drift_checks and (self._seek_pending or self._drift_checks >= DRIFT_CHECKS):
                             # seek started
                             log_msg("seek requested by lms server - kodi-time: %s  - lmstime: %s" %
                                     (cur_time_kodi, cur_time_lms))
+                            self._seek_pending = False
+                            self._drift_checks = 0
                             self.kodiplayer.is_busy = True
                             self.kodiplayer.seekTime(cur_time_lms)
                             xbmc.sleep(250)
                             self.kodiplayer.is_busy = False
 
-    def start_squeezelite(self):
-        '''On supported platforms we include squeezelite binary'''
+    def start_squeezelite(self, results):
+        '''startup phase: on supported platforms we include squeezelite binary'''
         playername = xbmc.getInfoLabel("System.FriendlyName").decode("utf-8")
-        if self.addon.getSetting("disable_auto_squeezelite") != "true":
-            sl_binary = get_squeezelite_binary()
-            if sl_binary and self.lmsserver:
-                try:
-                    sl_output = get_audiodevice(sl_binary)
-                    self.kill_squeezelite()
-                    log_msg("Starting Squeezelite binary - Using audio device: %s" % sl_output)
-                    args = [sl_binary, "-s", self.lmsserver.host, "-a", "80", "-C", "1", "-m",
-                            self.lmsserver.playerid, "-n", playername, "-M", "Kodi", "-o", sl_output]
-                    startupinfo = None
-                    if os.name == 'nt':
-                        startupinfo = subprocess.STARTUPINFO()
-                        startupinfo.dwFlags |= subprocess._subprocess.STARTF_USESHOWWINDOW
-                    self._sl_exec = subprocess.Popen(args, startupinfo=startupinfo, stderr=subprocess.STDOUT)
-                except Exception as exc:
-                    log_exception(__name__, exc)
+        if results.get("audiodevice"):
+            sl_binary, sl_output = results["audiodevice"]
+            try:
+                log_msg("Starting Squeezelite binary - Using audio device: %s" % sl_output)
+                args = [sl_binary, "-s", self.lmsserver.host, "-a", "80", "-C", "1", "-m",
+                        self.lmsserver.playerid, "-n", playername, "-M", "Kodi", "-o", sl_output]
+                startupinfo = None
+                if os.name == 'nt':
+                    startupinfo = subprocess.STARTUPINFO()
+                    startupinfo.dwFlags |= subprocess._subprocess.STARTF_USESHOWWINDOW
+                self._sl_exec = subprocess.Popen(args, startupinfo=startupinfo, stderr=subprocess.STDOUT)
+            except Exception as exc:
+                log_exception(__name__, exc)
         if not self._sl_exec:
             log_msg("The Squeezelite binary was not automatically started, "
                     "you should make sure of starting it yourself, e.g. as a service.")
             self._sl_exec = False
+        return bool(self._sl_exec)
 
     def stop_squeezelite(self):
         '''stop squeezelite if supported'''
@@ -227,10 +413,22 @@ class MainService(threading.Thread):
         if xbmc.getCondVisibility("System.Platform.Windows"):
             startupinfo = subprocess.STARTUPINFO()
             startupinfo.dwFlags |= subprocess._subprocess.STARTF_USESHOWWINDOW
-            subprocess.Popen(["taskkill", "/IM", "squeezelite-win.exe"], startupinfo=startupinfo, shell=True)
-            subprocess.Popen(["taskkill", "/IM", "squeezelite.exe"], startupinfo=startupinfo, shell=True)
+            names = ["squeezelite-win.exe", "squeezelite.exe"]
+            # taskkill returns 0 if a process was found
+            killed = [subprocess.Popen(["taskkill", "/IM", name], startupinfo=startupinfo, shell=True).wait() == 0
+                      for name in names]
+
+            def is_running():
+                return any([name in subprocess.check_output(["tasklist", "/NH", "/FI", "IMAGENAME eq %s" % name],
+                                                            startupinfo=startupinfo, shell=True) for name in names])
         else:
-            os.system("killall squeezelite")
-            os.system("killall squeezelite-i64")
-            os.system("killall squeezelite-x86")
-        xbmc.sleep(2000)
+            names = ["squeezelite", "squeezelite-i64", "squeezelite-x86"]
+            killed = [os.system("killall %s" % name) == 0 for name in names]
+
+            def is_running():
+                return any([os.system("killall -0 %s >/dev/null 2>&1" % name) == 0 for name in names])
+        # wait until the processes are actually gone instead of a fixed delay
+        if any(killed):
+            deadline = time.time() + KILL_TIMEOUT
+            while time.time() < deadline and is_running():
+                xbmc.sleep(100)
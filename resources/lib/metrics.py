@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    metrics.py
+    Lightweight latency and counter statistics shared by the components of the service
+'''
+
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from utils import log_msg, log_exception
+import xbmc
+
+# number of most recent samples kept per latency metric to calculate the percentiles
+MAX_SAMPLES = 500
+PERCENTILES = (50, 90, 99)
+# upper bounds (in milliseconds) of the histogram buckets, the last bucket has no bound
+HISTOGRAM_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# the rate of a latency metric is calculated over this number of seconds
+RATE_WINDOW = 60
+
+
+class Metrics(object):
+    '''thread safe collection of latency samples, histograms and counters'''
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self._max_samples = max_samples
+        self._lock = threading.Lock()
+        self._latencies = {}  # name --> [total count, deque with the most recent (time, seconds), histogram]
+        self._counters = {}
+        self._sources = {}  # name --> function returning a dict with the statistics of a component
+        self._start = time.time()
+
+    def record_latency(self, name, seconds):
+        '''add a latency sample, returns the total number of samples for this metric'''
+        bucket = bisect_left(HISTOGRAM_BUCKETS, seconds * 1000)
+        with self._lock:
+            metric = self._latencies.get(name)
+            if metric is None:
+                metric = self._latencies[name] = [0, deque(maxlen=self._max_samples),
+                                                  [0] * (len(HISTOGRAM_BUCKETS) + 1)]
+            metric[0] += 1
+            metric[1].append((time.time(), seconds))
+            metric[2][bucket] += 1
+            return metric[0]
+
+    def increment(self, name, value=1):
+        '''increment a counter'''
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def register(self, name, func):
+        '''add the statistics of a component (e.g. a cache) to the summary'''
+        self._sources[name] = func
+
+    def unregister(self, name):
+        '''remove the statistics of a component from the summary'''
+        self._sources.pop(name, None)
+
+    def percentiles(self, name, percents=PERCENTILES):
+        '''the percentiles (in milliseconds) of the recent samples of the latency metric'''
+        with self._lock:
+            samples = sorted([sample[1] for sample in self._latencies.get(name, (0, []))[1]])
+        if not samples:
+            return {}
+        return dict(("p%s" % percent, round(samples[min(len(samples) - 1, len(samples) * percent / 100)] * 1000, 1))
+                    for percent in percents)
+
+    def histogram(self, name):
+        '''list of (upper bound in milliseconds, number of samples) for the buckets of the latency metric'''
+        with self._lock:
+            counts = list(self._latencies[name][2]) if name in self._latencies else []
+        if not counts:
+            return []
+        labels = ["<=%s" % bound for bound in HISTOGRAM_BUCKETS] + [">%s" % HISTOGRAM_BUCKETS[-1]]
+        return zip(labels, counts)
+
+    def rate(self, name):
+        '''the number of samples of the latency metric in the last minute (at most the number of kept samples)'''
+        since = time.time() - RATE_WINDOW
+        with self._lock:
+            samples = self._latencies.get(name, (0, []))[1]
+            return len([sample for sample in samples if sample[0] >= since])
+
+    def summary(self):
+        '''all metrics as a dict'''
+        with self._lock:
+            names = self._latencies.keys()
+            result = {"uptime": int(time.time() - self._start), "counters": dict(self._counters)}
+        latencies = {}
+        for name in names:
+            latencies[name] = self.percentiles(name)
+            latencies[name]["count"] = self._latencies[name][0]
+            latencies[name]["per_minute"] = self.rate(name)
+            latencies[name]["histogram"] = self.histogram(name)
+        result["latencies"] = latencies
+        for name, func in self._sources.items():
+            try:
+                result[name] = func()
+            except Exception as exc:
+                log_exception(__name__, exc)
+        return result
+
+    def log_latency(self, name):
+        '''write the percentiles of the latency metric to the kodi log'''
+        log_msg("%s latency (ms): %s" % (name, self.percentiles(name)), xbmc.LOGDEBUG)
+
+
+# shared by all components of the service
+METRICS = Metrics()
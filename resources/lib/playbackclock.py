@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    playbackclock.py
+    Model of the playback position of the LMS player which filters out network jitter
+'''
+
+import ctypes
+import ctypes.util
+import os
+import sys
+import threading
+import time
+
+# position errors below this are jitter and only nudge the clock, above this it's a (possible) jump
+JUMP_THRESHOLD = 2.0
+# a jump is accepted when this many samples in a row agree on the new position
+JUMP_CONFIRMATIONS = 2
+# part of the jitter which is corrected on every sample
+SMOOTHING = 0.25
+
+
+def _get_monotonic():
+    '''returns a function for a monotonic clock in seconds (python 2 has no time.monotonic)'''
+    try:
+        if os.name == "nt":
+            tick_count = ctypes.windll.kernel32.GetTickCount64
+            tick_count.restype = ctypes.c_ulonglong
+            return lambda: tick_count() / 1000.0
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        clock_id = 6 if sys.platform == "darwin" else 1  # CLOCK_MONOTONIC
+        libc = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c") or "libc.so")
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+
+        def monotonic():
+            timespec = Timespec()
+            if clock_gettime(clock_id, ctypes.byref(timespec)) != 0:
+                raise OSError("clock_gettime failed")
+            return timespec.tv_sec + timespec.tv_nsec / 1000000000.0
+        monotonic()
+        return monotonic
+    except Exception:
+        # wall clock, can jump when the system time is adjusted
+        return time.time
+
+monotonic = _get_monotonic()
+
+
+class PlaybackClock(object):
+    '''extrapolates the player position from the status samples, jumps are only accepted when confirmed'''
+
+    def __init__(self, clock=monotonic):
+        self._clock = clock
+        self._key = None
+        self._mode = None
+        self._rate = 1.0
+        self._base_position = 0.0
+        self._base_time = clock()
+        self._candidate = None  # (position, time, confirmations) of a possible jump
+        self._discontinuity = False
+        self._lock = threading.Lock()
+        self.stats = {"samples": 0, "jitter": 0, "jumps": 0, "outliers": 0, "resets": 0}
+
+    def position(self, now=None):
+        '''the extrapolated position of the player at the given (or current) time'''
+        if self._mode != "play":
+            return self._base_position
+        if now is None:
+            now = self._clock()
+        return self._base_position + (now - self._base_time) * self._rate
+
+    def update(self, position, mode, rate=1, key=None, now=None, trusted=False):
+        '''add a status sample, key identifies the current track
+           trusted samples (pushed by the server on a change) don't need a confirmation for a jump'''
+        with self._lock:
+            self._update(position, mode, rate, key, now, trusted)
+
+    def _update(self, position, mode, rate, key, now, trusted):
+        '''process the status sample'''
+        if now is None:
+            now = self._clock()
+        try:
+            position = float(position)
+            rate = float(rate) if rate not in (None, "") else 1.0
+        except (TypeError, ValueError):
+            return
+        if rate <= 0:
+            rate = 1.0
+        self.stats["samples"] += 1
+        if key != self._key or mode != self._mode or (self._rate != rate and mode == "play"):
+            # other track or the player was paused/resumed, the sample is the truth
+            self.stats["resets"] += 1
+            # a new track which doesn't start at the beginning needs a seek
+            self._discontinuity = self._discontinuity or (key != self._key and position > JUMP_THRESHOLD)
+            self._reset(position, mode, rate, key, now)
+            return
+        error = position - self.position(now)
+        if abs(error) < JUMP_THRESHOLD:
+            # jitter of the network/polling, smooth it out
+            self.stats["jitter"] += 1
+            self._candidate = None
+            self._base_position = self.position(now) + error * SMOOTHING
+            self._base_time = now
+        elif trusted or (self._candidate and
+                         abs(position - self._extrapolate(self._candidate, now)) < JUMP_THRESHOLD):
+            # the previous sample already pointed at this position
+            confirmations = JUMP_CONFIRMATIONS if trusted else self._candidate[2] + 1
+            if confirmations >= JUMP_CONFIRMATIONS:
+                self.stats["jumps"] += 1
+                self._discontinuity = True
+                self._reset(position, mode, rate, key, now)
+            else:
+                self._candidate = (position, now, confirmations)
+        else:
+            # could be a seek on the server or a single bad sample, wait for the next one
+            self.stats["outliers"] += 1
+            self._candidate = (position, now, 1)
+
+    def _extrapolate(self, sample, now):
+        '''the position at the given time based on a single sample'''
+        position, sample_time = sample[:2]
+        if self._mode != "play":
+            return position
+        return position + (now - sample_time) * self._rate
+
+    def _reset(self, position, mode, rate, key, now):
+        '''start the model again from the sample'''
+        self._key = key
+        self._mode = mode
+        self._rate = rate
+        self._base_position = position
+        self._base_time = now
+        self._candidate = None
+
+    def consume_discontinuity(self):
+        '''returns True once after a confirmed jump in the playback position'''
+        result = self._discontinuity
+        self._discontinuity = False
+        return result
@@ -12,6 +12,7 @@ from utils import log_msg, log_exception, parse_duration
 import xbmc
 import xbmcgui
 from urllib import quote_plus
+from difflib import SequenceMatcher
 
 class KodiPlayer(xbmc.Player):
     '''Monitor all player events in Kodi'''
@@ -20,11 +21,16 @@ class KodiPlayer(xbmc.Player):
     exit = False
     is_playing = False
     is_busy = False
+    _queue = []
+    _seq = 0
 
     def __init__(self, **kwargs):
         self.lmsserver = kwargs.get("lmsserver")
         self.webport = kwargs.get("webport")
+        self.artwork_cache = kwargs.get("artwork_cache")
         self.playlist = xbmc.PlayList(xbmc.PLAYLIST_MUSIC)
+        # last known state of the queue, list of (key, filename) in playlist order
+        self._queue = []
         xbmc.Player.__init__(self)
         log_msg("Start Monitoring events for playerid %s" % self.lmsserver.playerid)
 
@@ -65,7 +71,7 @@ class KodiPlayer(xbmc.Player):
                     # figure out which track is requested
                     new_index = self.playlist.getposition()
                     log_msg("other track requested by kodi player - index: %s" % new_index)
-                    self.lmsserver.send_command("playlist index %s" % new_index)
+                    self.lmsserver.queue_command("playlist index %s" % new_index)
         is_busy = False
 
     def onPlayBackSpeedChanged(self, speed):
@@ -82,8 +88,9 @@ class KodiPlayer(xbmc.Player):
 
     def onPlayBackSeek(self, seekTime, seekOffset):
         '''Kodi event fired when the user is seeking'''
-        if self.is_playing and not self.lmsserver.state_changing and not self.is_busy:
-            self.lmsserver.send_command("time %s" % (int(seekTime) / 1000))
+        if self.is_playing and not self.is_busy:
+            # fast scrubbing is merged by the command queue into requests for the last position
+            self.lmsserver.queue_command("time %s" % (int(seekTime) / 1000))
 
     def onPlayBackStopped(self):
         '''Kodi event fired when playback is stopped'''
@@ -110,34 +117,88 @@ class KodiPlayer(xbmc.Player):
                              'year': lms_song.get("year"),
                              'comment': lms_song.get("comment")
                          })
-        listitem.setArt({"thumb": lms_song["thumb"]})
-        listitem.setIconImage(lms_song["thumb"])
-        listitem.setThumbnailImage(lms_song["thumb"])
+        # the cached details can have the artwork in another size or from an earlier session of the webproxy
+        thumb = self.lmsserver.get_sized_artwork(lms_song["thumb"], "tracks")
+        listitem.setArt({"thumb": thumb, "fanart": self.lmsserver.get_sized_artwork(thumb, "fanart")})
+        listitem.setIconImage(thumb)
+        listitem.setThumbnailImage(thumb)
+        # every playlist entry gets a unique filename so we can remove it from the kodi playlist
+        self._seq += 1
         if lms_song.get("remote_title") or not duration:
             # workaround for radio streams
-            file_name = "http://127.0.0.1:%s/track/radio" % (self.webport)
+            file_name = "http://127.0.0.1:%s/track/radio?seq=%s" % (self.webport, self._seq)
         else:
-            file_name = "http://127.0.0.1:%s/track/%s" % (self.webport, "%s" % duration)
+            file_name = "http://127.0.0.1:%s/track/%s?seq=%s" % (self.webport, duration, self._seq)
         listitem.setProperty("sl_path", lms_song["url"])
         listitem.setContentLookup(False)
         listitem.setProperty('do_not_analyze', 'true')
-        cmd = quote_plus("playlist index %s" % lms_song["playlist index"])
-        org_url = "plugin://plugin.audio.squeezebox?action=command&params=%s" % cmd
-        listitem.setProperty("original_listitem_url",org_url)
+        listitem.setProperty("original_listitem_url", self.original_listitem_url(lms_song["playlist index"]))
         return listitem, file_name
 
+    def is_radio_item(self, index):
+        '''bool indicating if the item at the given index of the kodi playlist is an endless radio stream'''
+        return 0 <= index < len(self.playlist) and "/track/radio" in self.playlist[index].getfilename()
+
+    @staticmethod
+    def original_listitem_url(index):
+        '''plugin path to play the item at the given index of the lms playlist'''
+        cmd = quote_plus("playlist index %s" % index)
+        return "plugin://plugin.audio.squeezebox?action=command&params=%s" % cmd
+
+    @staticmethod
+    def queue_key(lms_song):
+        '''key to compare the entries of the lms playlist'''
+        return u"%s-%s" % (lms_song.get("id"), lms_song.get("url"))
+
     def update_playlist(self):
-        '''Update the playlist'''
-        lmsplaylist = self.lmsserver.cur_playlist(True)
-        if len(self.playlist) > len(lmsplaylist):
+        '''Update the kodi playlist with only the changes in the lms playlist
+           returns True if the current item of the kodi playlist was changed'''
+        lmsplaylist = self.lmsserver.cur_playlist()
+        new_keys = [self.queue_key(item) for item in lmsplaylist]
+        current_changed = False
+        if [self.playlist[i].getfilename() for i in range(len(self.playlist))] != [
+                entry[1] for entry in self._queue]:
+            # the kodi playlist was modified outside our control, rebuild it
             log_msg("clearing playlist...")
             self.playlist.clear()
-        for item in lmsplaylist:
-            li, file_name = self.create_listitem(item)
-            self.playlist.add(file_name, li, item["playlist index"])
-        # refresh now playing playlist if needed
-        if xbmc.getInfoLabel("Container.FolderPath") in ["playlistmusic://", "plugin://plugin.audio.squeezebox/?action=currentplaylist"]:
-            xbmc.executebuiltin("Container.Refresh")
+            self._queue = []
+            current_changed = True
+        cur_pos = self.playlist.getposition()
+        opcodes = SequenceMatcher(None, [entry[0] for entry in self._queue], new_keys, autojunk=False).get_opcodes()
+        # only the new entries need the full details
+        new_items = [lmsplaylist[j] for tag, i1, i2, j1, j2 in opcodes if tag != "equal" for j in range(j1, j2)]
+        new_items = iter(self.lmsserver.process_trackdetails(new_items))
+        changes = []
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag != "equal":
+                changes.append((i1, i2, [next(new_items) for j in range(j1, j2)]))
+        # apply the changes from the end of the list so the indexes of the earlier entries stay valid
+        for i1, i2, items in reversed(changes):
+            for entry in reversed(self._queue[i1:i2]):
+                self.playlist.remove(entry[1])
+            if i1 <= cur_pos < i2:
+                current_changed = True
+            new_entries = []
+            for pos, item in enumerate(items):
+                listitem, file_name = self.create_listitem(item)
+                self.playlist.add(file_name, listitem, i1 + pos)
+                new_entries.append((self.queue_key(item), file_name))
+            self._queue[i1:i2] = new_entries
+        # entries that only moved need their index corrected
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == "equal" and i1 != j1:
+                for j in range(j1, j2):
+                    self.playlist[j].setProperty("original_listitem_url", self.original_listitem_url(j))
+        if changes:
+            log_msg("playlist updated - %s changes" % len(changes), xbmc.LOGDEBUG)
+            if self.artwork_cache:
+                # the covers of the queue are in the local cache before kodi shows them
+                self.artwork_cache.prefetch([self.lmsserver.get_sized_artwork(item["thumb"], "tracks")
+                                             for _, _, items in changes for item in items])
+            # refresh now playing playlist if needed
+            if xbmc.getInfoLabel("Container.FolderPath") in ["playlistmusic://", "plugin://plugin.audio.squeezebox/?action=currentplaylist"]:
+                xbmc.executebuiltin("Container.Refresh")
+        return current_changed
 
     def wait_for_player(self):
         count = 0
@@ -17,11 +17,16 @@ import urlparse
 from urllib import quote_plus
 import sys
 import os
+import threading
+from datetime import timedelta
 from operator import itemgetter
 from lmsserver import LMSServer, TAGS_BASIC, TAGS_FULL, TAGS_ALBUM
+from library import LibraryIndex
 
 PLUGIN_BASE = "plugin://%s/" % ADDON_ID
 ADDON_HANDLE = int(sys.argv[1])
+PAGE_SIZE_DEFAULT = 500
+PROFILE_TICKS_DEFAULT = 30
 
 
 class PluginContent:
@@ -29,10 +34,16 @@ class PluginContent:
     params = {}
     lmsserver = None
     addon = None
+    listitems = []
+    library = None
+    from_index = False
+    _prefetch = None
 
     def __init__(self):
         win = xbmcgui.Window(10000)
         self.addon = xbmcaddon.Addon(id=ADDON_ID)
+        # all directory items are collected and added to kodi at once
+        self.listitems = []
 
         # initialize lmsserver object - grab details from window props set by the service
         lmsplayerid = win.getProperty("lmsplayerid").decode("utf-8")
@@ -41,21 +52,42 @@ class PluginContent:
         
         if "select_output" in sys.argv[2]:
             self.select_output()
+        elif "profile_service" in sys.argv[2]:
+            self.profile_service()
         elif not lmsplayerid:
             log_msg("Service not yet ready - try again later!")
             xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
         else:
             # show plugin listing
             self.lmsserver = LMSServer(lmshost, lmsport, lmsplayerid)
+            # the artwork is served by the local cache of the service if it's enabled
+            self.lmsserver.artwork_proxy = win.getProperty("lmsartwork").decode("utf-8") or None
+            # the requests go through the gateway of the service which shares the results between invocations
+            self.lmsserver.gateway = win.getProperty("lmsgateway").decode("utf-8") or None
+            if self.addon.getSetting("library_index") == "true":
+                self.library = LibraryIndex.open_synced(lmshost)
 
             # initialize plugin listing
             try:
                 self.params = dict(urlparse.parse_qsl(sys.argv[2].replace('?', '').decode("utf-8")))
                 log_msg("plugin called with parameters: %s" % self.params, xbmc.LOGDEBUG)
-                self.main()
+                if self.addon.getSetting("profile_plugin") == "true":
+                    # the profiler is only loaded when it's used
+                    from profiling import Profiler
+                    profiler = Profiler()
+                    profiler.runcall(self.main)
+                    profiler.save("plugin_%s" % (self.params.get("action") or "menu"))
+                else:
+                    self.main()
             except Exception as exc:
                 log_exception(__name__, exc)
                 xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+            # the listing is already shown, wait for the prefetch of the next page
+            if self._prefetch:
+                self._prefetch.join()
+            self.lmsserver.close()
+            if self.library:
+                self.library.close()
 
         # cleanup when done processing
         del win
@@ -71,50 +103,117 @@ class PluginContent:
             # load main listing
             self.menu()
 
+    def get_listing(self, listing, cmd, args, loop_key):
+        '''get the items of a listing from the server, paged or all at once depending on the settings
+           returns the items and the start of the next page (0 if there is no next page)'''
+        paged = self.addon.getSetting("paged_%s" % listing) == "true"
+        self.from_index = False
+        if self.library:
+            # answer from the local library index if it supports the requested filters
+            start = int(self.params.get("start", 0)) if paged else 0
+            page_size = self.get_page_size() if paged else 0
+            result = self.library.query(listing, args, start, page_size)
+            if result is not None:
+                self.from_index = True
+                items, total = result
+                next_start = start + page_size if paged and start + page_size < total else 0
+                return items, next_start
+        if not paged:
+            result = self.lmsserver.send_request("%s 0 100000 %s" % (cmd, args))
+            return result.get(loop_key, []) if result else [], 0
+        start = int(self.params.get("start", 0))
+        page_size = self.get_page_size()
+        result = self.get_page("%s %s %s %s" % (cmd, start, page_size, args))
+        if not result:
+            return [], 0
+        next_start = start + page_size
+        if next_start < int(result.get("count", 0)):
+            # fetch the next page in the background while this page is rendered
+            self._prefetch = threading.Thread(target=self.get_page,
+                                              args=("%s %s %s %s" % (cmd, next_start, page_size, args), True))
+            self._prefetch.start()
+        else:
+            next_start = 0
+        return result.get(loop_key, []), next_start
+
+    def get_page_size(self):
+        '''the number of items per page, at least 1 (a page size of 0 would never reach the end)'''
+        return max(1, int(self.addon.getSetting("page_size") or PAGE_SIZE_DEFAULT))
+
+    def get_page(self, request_str, prefetch=False):
+        '''get a page of a listing, prefetched pages are stored in the cache'''
+        cache_str = "lmspage.%s" % request_str
+        if not prefetch:
+            result = self.lmsserver.cache.get(cache_str)
+            if result:
+                return result
+        result = self.lmsserver.send_request(request_str)
+        if prefetch and result:
+            self.lmsserver.cache.set(cache_str, result, expiration=timedelta(minutes=5))
+        return result
+
+    def end_of_directory(self):
+        '''add all collected items to the directory in one go and finish the listing'''
+        xbmcplugin.addDirectoryItems(ADDON_HANDLE, self.listitems, len(self.listitems))
+        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+
+    def create_nextpage_listitem(self, next_start):
+        '''create the entry to open the next page of the current listing'''
+        if next_start:
+            params = quote_plus(self.params.get("params", "").encode("utf-8"))
+            cmd = "%s&params=%s&start=%s" % (self.params.get("action"), params, next_start)
+            self.create_generic_listitem(self.addon.getLocalizedString(32303), "DefaultFolder.png", cmd)
+
     def albums(self):
         '''get albums from server'''
         params = self.params.get("params")
         xbmcplugin.setContent(ADDON_HANDLE, "albums")
         xbmcplugin.setProperty(ADDON_HANDLE, 'FolderName', xbmc.getLocalizedString(132))
-        request_str = "albums 0 100000 tags:%s" % TAGS_ALBUM
+        args = "tags:%s" % TAGS_ALBUM
         if params:
-            request_str += " %s" % params
-            if "artist_id" in params:  # add All tracks entry
+            args += " %s" % params
+            if "artist_id" in params and not self.params.get("start"):  # add All tracks entry
                 self.create_generic_listitem("All Tracks", "DefaultMusicSongs.png", "tracks&params=%s" % params)
-        result = self.lmsserver.send_request(request_str)
-        if result:
-            for item in result.get("albums_loop"):
-                self.create_album_listitem(item)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        items, next_start = self.get_listing("albums", "albums", args, "albums_loop")
+        for item in items:
+            self.create_album_listitem(item)
+        self.create_nextpage_listitem(next_start)
+        self.end_of_directory()
+        if self.addon.getSetting("artwork_log_bytes") == "true":
+            # the listing is already shown, measure what kodi has to download for the artwork
+            thumbs = [self.lmsserver.get_thumb(item, "albums") for item in items]
+            log_msg("Album listing artwork: %s images, %s KB (size %s)" % (
+                len(thumbs), self.lmsserver.get_artwork_bytes(thumbs) / 1024,
+                self.lmsserver.artwork_sizes["albums"] or "original"))
 
     def artists(self):
         '''get artists from server'''
         params = self.params.get("params")
         xbmcplugin.setContent(ADDON_HANDLE, "artists")
         xbmcplugin.setProperty(ADDON_HANDLE, 'FolderName', xbmc.getLocalizedString(133))
-        request_str = "artists 0 100000 tags:%s" % TAGS_FULL
+        args = "tags:%s" % TAGS_FULL
         if params:
-            request_str += " %s" % params
-        result = self.lmsserver.send_request(request_str)
-        if result:
-            for item in result.get("artists_loop"):
-                self.create_artist_listitem(item)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+            args += " %s" % params
+        items, next_start = self.get_listing("artists", "artists", args, "artists_loop")
+        for item in items:
+            self.create_artist_listitem(item)
+        self.create_nextpage_listitem(next_start)
+        self.end_of_directory()
 
     def tracks(self):
         '''get tracks from server'''
         params = self.params.get("params", "")
         xbmcplugin.setContent(ADDON_HANDLE, "songs")
         xbmcplugin.setProperty(ADDON_HANDLE, 'FolderName', xbmc.getLocalizedString(134))
-        request_str = "tracks 0 100000 tags:%s" % TAGS_BASIC
+        args = "tags:%s" % TAGS_BASIC
         if params:
-            request_str += " %s" % params
-        result = self.lmsserver.send_request(request_str)
-        listitems = []
-        if result:
-            result = self.lmsserver.process_trackdetails(result["titles_loop"])
-            result = [self.create_track_listitem(item) for item in result]
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+            args += " %s" % params
+        items, next_start = self.get_listing("tracks", "tracks", args, "titles_loop")
+        # tracks in the library index already have the full details
+        for item in self.lmsserver.process_trackdetails(items, lookup=not self.from_index):
+            self.create_track_listitem(item)
+        self.create_nextpage_listitem(next_start)
+        self.end_of_directory()
 
     def playlisttracks(self):
         '''get tracks from server'''
@@ -125,7 +224,7 @@ class PluginContent:
         if result:
             result = self.lmsserver.process_trackdetails(result["playlisttracks_loop"])
             result = [self.create_track_listitem(item) for item in result]
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def currentplaylist(self):
         '''get the current playlist loaded in the player'''
@@ -135,116 +234,116 @@ class PluginContent:
         if result:
             result = [self.create_track_listitem(item) for item in result]
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def playlists(self):
         '''get playlists from server'''
         xbmcplugin.setContent(ADDON_HANDLE, "files")
         xbmcplugin.setProperty(ADDON_HANDLE, 'FolderName', xbmc.getLocalizedString(136))
         params = self.params.get("params")
-        request_str = "playlists 0 100000 tags:%s" % TAGS_FULL
+        args = "tags:%s" % TAGS_FULL
         if params:
-            request_str += " %s" % params
-        result = self.lmsserver.send_request(request_str)
-        if result:
-            for item in result.get("playlists_loop"):
-                cmd = "playlisttracks&playlistid=%s" % item["id"]
-                self.create_generic_listitem(item["playlist"], "DefaultMusicPlaylists.png", cmd)
+            args += " %s" % params
+        items, next_start = self.get_listing("playlists", "playlists", args, "playlists_loop")
+        for item in items:
+            cmd = "playlisttracks&playlistid=%s" % item["id"]
+            self.create_generic_listitem(item["playlist"], "DefaultMusicPlaylists.png", cmd)
+        self.create_nextpage_listitem(next_start)
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def genres(self):
         '''get genres from server'''
         xbmcplugin.setContent(ADDON_HANDLE, "files")
         xbmcplugin.setProperty(ADDON_HANDLE, 'FolderName', xbmc.getLocalizedString(135))
         params = self.params.get("params")
-        request_str = "genres 0 100000 tags:%s" % TAGS_FULL
+        args = "tags:%s" % TAGS_FULL
         if params:
-            request_str += " %s" % params
-        result = self.lmsserver.send_request(request_str)
-        if result:
-            for item in result.get("genres_loop"):
-                cmd = "tracks&params=genre_id:%s" % item["id"]
-                thumb = self.lmsserver.get_thumb(item)
-                contextmenu = []
-                params = quote_plus("playlist loadalbum %s * *" % item["genre"])
-                contextmenu.append((self.addon.getLocalizedString(32203),
-                                    "RunPlugin(%s?action=command&params=%s)" % (PLUGIN_BASE, params)))
-                params = quote_plus("playlist insertalbum %s * *" % item["genre"])
-                contextmenu.append((self.addon.getLocalizedString(32204),
-                                    "RunPlugin(%s?action=command&params=%s)" % (PLUGIN_BASE, params)))
-                params = quote_plus("playlist addalbum %s * *" % item["genre"])
-                contextmenu.append((self.addon.getLocalizedString(32205),
-                                    "RunPlugin(%s?action=command&params=%s)" % (PLUGIN_BASE, params)))
-                self.create_generic_listitem(item["genre"], thumb, cmd, True, contextmenu)
+            args += " %s" % params
+        items, next_start = self.get_listing("genres", "genres", args, "genres_loop")
+        for item in items:
+            cmd = "tracks&params=genre_id:%s" % item["id"]
+            thumb = self.lmsserver.get_thumb(item)
+            contextmenu = []
+            params = quote_plus("playlist loadalbum %s * *" % item["genre"])
+            contextmenu.append((self.addon.getLocalizedString(32203),
+                                "RunPlugin(%s?action=command&params=%s)" % (PLUGIN_BASE, params)))
+            params = quote_plus("playlist insertalbum %s * *" % item["genre"])
+            contextmenu.append((self.addon.getLocalizedString(32204),
+                                "RunPlugin(%s?action=command&params=%s)" % (PLUGIN_BASE, params)))
+            params = quote_plus("playlist addalbum %s * *" % item["genre"])
+            contextmenu.append((self.addon.getLocalizedString(32205),
+                                "RunPlugin(%s?action=command&params=%s)" % (PLUGIN_BASE, params)))
+            self.create_generic_listitem(item["genre"], thumb, cmd, True, contextmenu)
+        self.create_nextpage_listitem(next_start)
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def years(self):
         '''get years from server'''
         xbmcplugin.setContent(ADDON_HANDLE, "files")
         xbmcplugin.setProperty(ADDON_HANDLE, 'FolderName', xbmc.getLocalizedString(652))
         params = self.params.get("params")
-        request_str = "years 0 100000 tags:%s" % TAGS_FULL
+        args = "tags:%s" % TAGS_FULL
         if params:
-            request_str += " %s" % params
-        result = self.lmsserver.send_request(request_str)
-        if result:
-            for item in result.get("years_loop"):
-                cmd = "albums&params=year:%s" % item["year"]
-                thumb = self.lmsserver.get_thumb(item)
-                self.create_generic_listitem("%s" % item["year"], thumb, cmd)
+            args += " %s" % params
+        items, next_start = self.get_listing("years", "years", args, "years_loop")
+        for item in items:
+            cmd = "albums&params=year:%s" % item["year"]
+            thumb = self.lmsserver.get_thumb(item)
+            self.create_generic_listitem("%s" % item["year"], thumb, cmd)
+        self.create_nextpage_listitem(next_start)
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def musicfolder(self):
         '''explore musicfolder on the server'''
         xbmcplugin.setContent(ADDON_HANDLE, "files")
         xbmcplugin.setProperty(ADDON_HANDLE, 'FolderName', xbmc.getLocalizedString(744))
         params = self.params.get("params")
-        request_str = "musicfolder 0 100000 tags:%s" % TAGS_FULL
+        args = "tags:%s" % TAGS_FULL
         if params:
-            request_str += " %s" % params
-        result = self.lmsserver.send_request(request_str)
-        if result:
-            for item in result.get("folder_loop"):
-                thumb = self.lmsserver.get_thumb(item)
-                if item["type"] == "track":
-                    item = self.get_songinfo(item["url"])
-                    self.create_track_listitem(item)
-                elif item["type"] == "playlist":
-                    cmd = "command&params=playlist play %s" % item["url"]
-                    self.create_generic_listitem("%s" % item["filename"], thumb, cmd, False)
-                else:
-                    cmd = "musicfolder&params=folder_id:%s" % item["id"]
-                    self.create_generic_listitem("%s" % item["filename"], thumb, cmd)
+            args += " %s" % params
+        items, next_start = self.get_listing("musicfolder", "musicfolder", args, "folder_loop")
+        for item in items:
+            thumb = self.lmsserver.get_thumb(item)
+            if item["type"] == "track":
+                item = self.get_songinfo(item["url"])
+                self.create_track_listitem(item)
+            elif item["type"] == "playlist":
+                cmd = "command&params=playlist play %s" % item["url"]
+                self.create_generic_listitem("%s" % item["filename"], thumb, cmd, False)
+            else:
+                cmd = "musicfolder&params=folder_id:%s" % item["id"]
+                self.create_generic_listitem("%s" % item["filename"], thumb, cmd)
+        self.create_nextpage_listitem(next_start)
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def favorites(self):
         '''get favorites from server'''
         xbmcplugin.setContent(ADDON_HANDLE, "files")
         xbmcplugin.setProperty(ADDON_HANDLE, 'FolderName', xbmc.getLocalizedString(1036))
-        request_str = "favorites items 0 100000 want_url:1 tags:%s" % TAGS_FULL
+        args = "want_url:1 tags:%s" % TAGS_FULL
         params = self.params.get("params")
         if params:
-            request_str += " %s" % params
-        result = self.lmsserver.send_request(request_str)
-        if result:
-            for item in result.get("loop_loop"):
-                thumb = self.lmsserver.get_thumb(item)
-                if item.get("isaudio") and "title" in item:
-                    track_details = self.lmsserver.trackdetails(item)
-                    self.create_track_listitem(track_details)
-                elif item["isaudio"] and "url" in item:
-                    result = self.lmsserver.send_request("songinfo 0 100 tags:%s url:%s" % (TAGS_FULL, item["url"]))
-                    cmd = "command&params=" + quote_plus("favorites playlist play item_id:%s" % item["id"])
-                    self.create_generic_listitem(item["name"], thumb, cmd, False)
-                else:
-                    cmd = "favorites&params=item_id:%s" % item["id"]
-                    self.create_generic_listitem(item["name"], thumb, cmd)
+            args += " %s" % params
+        items, next_start = self.get_listing("favorites", "favorites items", args, "loop_loop")
+        for item in items:
+            thumb = self.lmsserver.get_thumb(item)
+            if item.get("isaudio") and "title" in item:
+                track_details = self.lmsserver.trackdetails(item)
+                self.create_track_listitem(track_details)
+            elif item["isaudio"] and "url" in item:
+                result = self.lmsserver.send_request("songinfo 0 100 tags:%s url:%s" % (TAGS_FULL, item["url"]))
+                cmd = "command&params=" + quote_plus("favorites playlist play item_id:%s" % item["id"])
+                self.create_generic_listitem(item["name"], thumb, cmd, False)
+            else:
+                cmd = "favorites&params=item_id:%s" % item["id"]
+                self.create_generic_listitem(item["name"], thumb, cmd)
+        self.create_nextpage_listitem(next_start)
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def get_menu(self, node):
         '''grabs the menu for this player'''
@@ -325,7 +424,7 @@ class PluginContent:
         if node == "home":
             self.create_generic_listitem(self.addon.getLocalizedString(32206), "", "syncsettings")
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def search(self):
         xbmcplugin.setProperty(ADDON_HANDLE, 'FolderName', xbmc.getLocalizedString(19140))
@@ -357,7 +456,7 @@ class PluginContent:
                     cmd = "genres&params=search:%s" % searchterm
                     self.create_generic_listitem(label, "DefaultMusicGenres.png", cmd)
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def globalsearch(self):
         xbmcplugin.setProperty(ADDON_HANDLE, 'FolderName', xbmc.getLocalizedString(19140))
@@ -372,7 +471,7 @@ class PluginContent:
                 cmd = "browse&params=%s" % quote_plus(params)
                 self.create_generic_listitem(item["name"], "DefaultMusicSearch.png", cmd)
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def apps(self):
         '''get apps from server'''
@@ -473,7 +572,7 @@ class PluginContent:
                 cmd = "browse&params=%s&contentttype=%s" % (params, contentttype)
                 self.create_generic_listitem(item["name"], thumb, cmd)
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def syncsettings(self):
         '''sync settings (The synchroniser plugin)'''
@@ -511,25 +610,24 @@ class PluginContent:
                     # header with no action
                     self.create_generic_listitem(item["text"], "", "syncsettings")
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def radios(self):
         '''get radio items'''
         xbmcplugin.setProperty(ADDON_HANDLE, 'FolderName', xbmc.getLocalizedString(19183))
         xbmcplugin.setContent(ADDON_HANDLE, "files")
-        request_str = "radios 0 100000 tags:%s" % TAGS_FULL
-        result = self.lmsserver.send_request(request_str)
-        if result:
-            for item in result.get("radioss_loop"):
-                if item["cmd"] == "search":
-                    params = "%s items 0 100000 search:__TAGGEDINPUT__" % item["cmd"]
-                else:
-                    params = params = "%s items 0 100000" % item["cmd"]
-                cmd = "browse&params=%s" % quote_plus(params)
-                thumb = self.lmsserver.get_thumb(item)
-                self.create_generic_listitem(item["name"], thumb, cmd)
+        items, next_start = self.get_listing("radios", "radios", "tags:%s" % TAGS_FULL, "radioss_loop")
+        for item in items:
+            if item["cmd"] == "search":
+                params = "%s items 0 100000 search:__TAGGEDINPUT__" % item["cmd"]
+            else:
+                params = params = "%s items 0 100000" % item["cmd"]
+            cmd = "browse&params=%s" % quote_plus(params)
+            thumb = self.lmsserver.get_thumb(item)
+            self.create_generic_listitem(item["name"], thumb, cmd)
+        self.create_nextpage_listitem(next_start)
         xbmcplugin.addSortMethod(ADDON_HANDLE, xbmcplugin.SORT_METHOD_UNSORTED)
-        xbmcplugin.endOfDirectory(handle=ADDON_HANDLE)
+        self.end_of_directory()
 
     def get_app_contenttype(self, item):
         '''try to parse the contenttype from the details'''
@@ -554,7 +652,7 @@ class PluginContent:
 
     def create_artist_listitem(self, lms_item):
         '''Create Kodi listitem from LMS artist details'''
-        thumb = self.lmsserver.get_thumb(lms_item)
+        thumb = self.lmsserver.get_thumb(lms_item, "artists")
         listitem = xbmcgui.ListItem(lms_item.get("artist"))
         listitem.setInfo('music',
                          {
@@ -582,8 +680,7 @@ class PluginContent:
                             "RunPlugin(%s?action=command&params=%s)" % (PLUGIN_BASE, params)))
         listitem.addContextMenuItems(contextmenu, True)
         url = "plugin://plugin.audio.squeezebox?action=albums&params=artist_id:%s" % lms_item.get("id")
-        xbmcplugin.addDirectoryItem(handle=ADDON_HANDLE,
-                                    url=url, listitem=listitem, isFolder=True)
+        self.listitems.append((url, listitem, True))
 
     def get_songinfo(self, url):
         '''get songinfo for given path'''
@@ -599,7 +696,7 @@ class PluginContent:
 
     def create_album_listitem(self, lms_item):
         '''Create Kodi listitem from LMS album details'''
-        thumb = self.lmsserver.get_thumb(lms_item)
+        thumb = self.lmsserver.get_thumb(lms_item, "albums")
         listitem = xbmcgui.ListItem(lms_item.get("album"))
         listitem.setInfo('music',
                          {
@@ -632,8 +729,7 @@ class PluginContent:
         except:
             pass
         listitem.addContextMenuItems(contextmenu, True)
-        xbmcplugin.addDirectoryItem(handle=ADDON_HANDLE,
-                                    url=url, listitem=listitem, isFolder=True)
+        self.listitems.append((url, listitem, True))
 
     def create_track_listitem(self, lms_item):
         '''Create Kodi listitem from LMS track details'''
@@ -653,9 +749,11 @@ class PluginContent:
                              'comment': lms_item.get("comment"),
                              "mediatype": "song"
                          })
-        listitem.setArt({"thumb": lms_item["thumb"]})
-        listitem.setIconImage(lms_item["thumb"])
-        listitem.setThumbnailImage(lms_item["thumb"])
+        # the cached details can have the artwork in another size
+        thumb = self.lmsserver.get_sized_artwork(lms_item["thumb"], "tracks")
+        listitem.setArt({"thumb": thumb, "fanart": self.lmsserver.get_sized_artwork(thumb, "fanart")})
+        listitem.setIconImage(thumb)
+        listitem.setThumbnailImage(thumb)
         listitem.setProperty("isPlayable", "false")
         listitem.setProperty("DBYPE", "song")
         cmd = quote_plus("playlist play %s" % lms_item.get("url"))
@@ -696,8 +794,7 @@ class PluginContent:
                                 "RunPlugin(%s?action=command&params=%s)" % (PLUGIN_BASE, params)))
         listitem.addContextMenuItems(contextmenu, True)
         url = "plugin://plugin.audio.squeezebox?action=command&params=%s" % cmd
-        xbmcplugin.addDirectoryItem(handle=ADDON_HANDLE,
-                                    url=url, listitem=listitem, isFolder=False)
+        self.listitems.append((url, listitem, False))
 
     def create_generic_listitem(self, label, icon, cmd, is_folder=True, contextmenu=None):
         listitem = xbmcgui.ListItem(label, iconImage=icon)
@@ -706,8 +803,7 @@ class PluginContent:
             contextmenu = []
         listitem.addContextMenuItems(contextmenu, True)
         listitem.setProperty("isPlayable", "false")
-        xbmcplugin.addDirectoryItem(handle=ADDON_HANDLE,
-                                    url=url, listitem=listitem, isFolder=is_folder)
+        self.listitems.append((url, listitem, is_folder))
 
     def playlistplaynext(self):
         _id = self.params.get("params")
@@ -727,6 +823,12 @@ class PluginContent:
         if refresh:
             xbmc.executebuiltin("Container.Refresh")
             
+    def profile_service(self):
+        '''ask the service to profile the next iterations of its main loop'''
+        ticks = int(self.addon.getSetting("profile_ticks") or PROFILE_TICKS_DEFAULT)
+        xbmc.executebuiltin("NotifyAll(%s,profile_service,%s)" % (ADDON_ID, ticks))
+        xbmcgui.Dialog().notification(self.addon.getAddonInfo("name"), self.addon.getLocalizedString(32405))
+
     def select_output(self):
         '''helper to select the output device for squeezelite'''
         xbmc.executebuiltin("ActivateWindow(busydialog")
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    profiling.py
+    On-demand profiling of the plugin actions and the service loop, only imported when profiling is enabled
+'''
+
+import os
+import time
+import cProfile
+import pstats
+from StringIO import StringIO
+from cherrypy.lib import profiler
+from utils import log_msg, get_profile_path
+import xbmc
+
+PROFILE_DIR = "profiles"
+# number of functions in the text summary of a profile
+TOP_FUNCTIONS = 40
+
+
+class Profiler(profiler.Profiler):
+    '''the cherrypy profiler with cProfile, named profiles in the addon profile and a text summary'''
+
+    def __init__(self, path=None):
+        profiler.Profiler.__init__(self, path or get_profile_path(PROFILE_DIR))
+        self._profile = None
+
+    def run(self, func, *args, **params):
+        '''profile a single call and write the profile'''
+        try:
+            return self.runcall(func, *args, **params)
+        finally:
+            self.save(getattr(func, "__name__", "call"))
+
+    def runcall(self, func, *args, **params):
+        '''profile the call, the stats of successive calls are accumulated until they're saved'''
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+        return self._profile.runcall(func, *args, **params)
+
+    def save(self, name):
+        '''write the accumulated stats to <name>_<time>.prof and the summary to a .txt file next to it'''
+        if self._profile is None:
+            return None
+        filename = "%s_%s.prof" % (name, time.strftime("%Y%m%d-%H%M%S"))
+        count = 1
+        while os.path.exists(os.path.join(self.path, filename)):
+            count += 1
+            filename = "%s_%s-%s.prof" % (name, time.strftime("%Y%m%d-%H%M%S"), count)
+        path = os.path.join(self.path, filename)
+        self._profile.dump_stats(path)
+        self._profile = None
+        with open(path[:-len(".prof")] + ".txt", "w") as summary_file:
+            summary_file.write(self.stats(filename))
+        log_msg("Profile written to %s" % path, xbmc.LOGNOTICE)
+        return path
+
+    def statfiles(self):
+        ''':rtype: list of available profiles.'''
+        return [filename for filename in os.listdir(self.path) if filename.endswith(".prof")]
+
+    def stats(self, filename, sortby="cumulative"):
+        '''the top functions of the profile by cumulative and by own time (the cherrypy version needs python 3)'''
+        output = StringIO()
+        stats = pstats.Stats(os.path.join(self.path, filename), stream=output)
+        stats.strip_dirs()
+        stats.sort_stats(sortby).print_stats(TOP_FUNCTIONS)
+        if sortby != "tottime":
+            stats.sort_stats("tottime").print_stats(TOP_FUNCTIONS)
+        return output.getvalue()
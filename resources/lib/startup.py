@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    startup.py
+    Runs the startup phases of the service concurrently, respecting their dependencies
+'''
+
+import threading
+import time
+from utils import log_msg, log_exception
+import xbmc
+
+
+class StartupPipeline(object):
+    '''dependency graph of startup phases, every phase starts as soon as the phases it depends on are done'''
+
+    def __init__(self):
+        self._phases = []
+        self._results = {}
+        self._durations = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._start = 0
+
+    def add(self, name, func, depends=None):
+        '''add a phase, func is called with the dict of results of the finished phases'''
+        self._phases.append((name, func, depends or []))
+
+    def run(self):
+        '''run all phases and return their results, a failed phase also skips the phases depending on it'''
+        self._start = time.time()
+        pending = list(self._phases)
+        running = set()
+        threads = []
+        with self._done:
+            while pending or running:
+                for phase in list(pending):
+                    name, func, depends = phase
+                    if any(dep in self._failed for dep in depends):
+                        log_msg("Startup phase %s skipped, a phase it depends on failed" % name, xbmc.LOGWARNING)
+                        self._failed.add(name)
+                        pending.remove(phase)
+                    elif all(dep in self._results for dep in depends):
+                        pending.remove(phase)
+                        running.add(name)
+                        thread = threading.Thread(target=self._run_phase, args=(name, func, dict(self._results)))
+                        thread.daemon = True
+                        thread.start()
+                        threads.append(thread)
+                if pending and not running:
+                    # unknown dependencies, nothing can make progress anymore
+                    for name, _, _ in pending:
+                        log_msg("Startup phase %s has unresolvable dependencies" % name, xbmc.LOGERROR)
+                        self._failed.add(name)
+                    break
+                if running:
+                    self._done.wait()
+                    running -= set(self._results.keys()) | self._failed
+        log_msg("Startup finished in %.2f seconds - phases (start, duration): %s" % (
+            time.time() - self._start, ", ".join(["%s (%.2f, %.2f)" % (name, self._durations[name][0],
+                                                                          self._durations[name][1])
+                                                  for name, _, _ in self._phases if name in self._durations])))
+        return dict(self._results)
+
+    def _run_phase(self, name, func, results):
+        '''run a single phase in its own thread and record its duration'''
+        start = time.time()
+        try:
+            result = func(results)
+            failed = False
+        except Exception as exc:
+            log_exception(__name__, exc)
+            result = None
+            failed = True
+        duration = time.time() - start
+        log_msg("Startup phase %s took %.2f seconds" % (name, duration), xbmc.LOGDEBUG)
+        with self._done:
+            self._durations[name] = (start - self._start, duration)
+            if failed:
+                self._failed.add(name)
+            else:
+                self._results[name] = result
+            self._done.notify()
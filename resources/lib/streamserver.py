@@ -0,0 +1,392 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    streamserver.py
+    Single threaded event loop webserver for the silent audio streams of the http proxy
+'''
+
+import errno
+import select
+import socket
+import sys
+import threading
+import time
+from email.utils import formatdate
+from StringIO import StringIO
+from urllib import unquote
+from Queue import Queue
+from utils import log_msg, log_exception
+import xbmc
+
+TRACK_PATH = "/track/"
+MAX_HEADER_SIZE = 16384
+IDLE_TIMEOUT = 60
+POLL_TIMEOUT = 0.5
+# kodi loads the artwork of a listing with several requests in parallel
+WSGI_WORKERS = 4
+SERVER_NAME = "plugin.audio.squeezebox"
+# errors on send/recv which mean we have to try again later
+RETRY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class _Poller(object):
+    '''readiness notification with epoll when available, select otherwise (e.g. on Windows)'''
+
+    def __init__(self):
+        self._epoll = select.epoll() if hasattr(select, "epoll") else None
+        self._readers = set()
+        self._writers = set()
+
+    def register(self, fileno, writable):
+        '''(re)register the file descriptor for read or write readiness'''
+        if self._epoll:
+            events = select.EPOLLOUT if writable else select.EPOLLIN
+            try:
+                self._epoll.modify(fileno, events)
+            except IOError:
+                self._epoll.register(fileno, events)
+        elif writable:
+            self._readers.discard(fileno)
+            self._writers.add(fileno)
+        else:
+            self._writers.discard(fileno)
+            self._readers.add(fileno)
+
+    def unregister(self, fileno):
+        '''stop watching the file descriptor'''
+        if self._epoll:
+            try:
+                self._epoll.unregister(fileno)
+            except (IOError, ValueError):
+                pass
+        else:
+            self._readers.discard(fileno)
+            self._writers.discard(fileno)
+
+    def poll(self, timeout):
+        '''returns the file descriptors which are ready'''
+        if self._epoll:
+            return [fileno for fileno, _ in self._epoll.poll(timeout)]
+        if not self._readers and not self._writers:
+            time.sleep(timeout)
+            return []
+        readable, writable, _ = select.select(self._readers, self._writers, [], timeout)
+        return readable + writable
+
+    def close(self):
+        '''release the epoll object'''
+        if self._epoll:
+            self._epoll.close()
+
+
+class _Connection(object):
+    '''the state of one client connection'''
+    __slots__ = ["sock", "addr", "inbuf", "outbuf", "body", "keepalive", "chunked", "last_activity"]
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = ""
+        self.outbuf = None
+        self.body = None
+        self.keepalive = False
+        self.chunked = False
+        self.last_activity = time.time()
+
+
+class StreamServer(object):
+    '''serves the /track/ urls of the proxy from one thread, other urls are passed to the wsgi app'''
+    ready = False
+    _sock = None
+    _poller = None
+
+    def __init__(self, bind_addr, track, wsgi_app):
+        self.bind_addr = bind_addr
+        self._track = track
+        self._wsgi_app = wsgi_app
+        self._connections = {}
+        self._exit = threading.Event()
+        self._wsgi_queue = Queue()
+        self._workers = []
+
+    def start(self):
+        '''bind the socket and run the event loop until stop is called'''
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(self.bind_addr)
+        self._sock.listen(64)
+        self._sock.setblocking(0)
+        self.bind_addr = self._sock.getsockname()
+        self._poller = _Poller()
+        self._poller.register(self._sock.fileno(), False)
+        for _ in range(WSGI_WORKERS):
+            worker = threading.Thread(target=self._wsgi_worker)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self.ready = True
+        try:
+            self._loop()
+        finally:
+            self.ready = False
+            for conn in self._connections.values():
+                self._close(conn)
+            self._poller.close()
+            self._sock.close()
+            for _ in self._workers:
+                self._wsgi_queue.put(None)
+
+    def stop(self):
+        '''stop the event loop'''
+        self._exit.set()
+
+    @property
+    def connections(self):
+        '''number of open client connections'''
+        return len(self._connections)
+
+    def _loop(self):
+        '''wait for readiness and handle the sockets'''
+        listen_fileno = self._sock.fileno()
+        last_check = time.time()
+        while not self._exit.is_set():
+            for fileno in self._poller.poll(POLL_TIMEOUT):
+                if fileno == listen_fileno:
+                    self._accept()
+                    continue
+                conn = self._connections.get(fileno)
+                if not conn:
+                    continue
+                try:
+                    if conn.body is not None or conn.outbuf is not None:
+                        self._write(conn)
+                    else:
+                        self._read(conn)
+                except socket.error as exc:
+                    if exc.args[0] not in RETRY_ERRORS:
+                        self._close(conn)
+                except Exception as exc:
+                    log_exception(__name__, exc)
+                    self._close(conn)
+            if time.time() - last_check > POLL_TIMEOUT:
+                last_check = time.time()
+                self._close_idle()
+
+    def _accept(self):
+        '''accept all pending connections'''
+        while True:
+            try:
+                sock, addr = self._sock.accept()
+            except socket.error as exc:
+                if exc.args[0] not in RETRY_ERRORS + (errno.ECONNABORTED,):
+                    log_msg("StreamServer - accept failed: %s" % exc, xbmc.LOGWARNING)
+                return
+            sock.setblocking(0)
+            conn = _Connection(sock, addr)
+            self._connections[sock.fileno()] = conn
+            self._poller.register(sock.fileno(), False)
+
+    def _close_idle(self):
+        '''close the connections which are waiting for a request for too long'''
+        timeout = time.time() - IDLE_TIMEOUT
+        for conn in self._connections.values():
+            if conn.body is None and conn.outbuf is None and conn.last_activity < timeout:
+                self._close(conn)
+
+    def _close(self, conn):
+        '''close the connection and forget about it'''
+        fileno = conn.sock.fileno()
+        self._poller.unregister(fileno)
+        self._connections.pop(fileno, None)
+        if conn.body is not None and hasattr(conn.body, "close"):
+            conn.body.close()
+        conn.body = conn.outbuf = None
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+
+    def _read(self, conn):
+        '''read the request headers and start the response when they're complete'''
+        data = conn.sock.recv(4096)
+        if not data:
+            self._close(conn)
+            return
+        conn.last_activity = time.time()
+        conn.inbuf += data
+        self._process(conn)
+
+    def _process(self, conn):
+        '''handle the buffered request if it's complete'''
+        if "\r\n\r\n" not in conn.inbuf:
+            if len(conn.inbuf) > MAX_HEADER_SIZE:
+                self._respond(conn, "431 Request Header Fields Too Large", [], None, False)
+            return
+        head, conn.inbuf = conn.inbuf.split("\r\n\r\n", 1)
+        lines = head.split("\r\n")
+        try:
+            method, uri, protocol = lines[0].split(" ", 2)
+            version = tuple([int(item) for item in protocol.split("/", 1)[1].split(".")])
+        except (ValueError, IndexError):
+            self._respond(conn, "400 Bad Request", [], None, False)
+            return
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+        path, _, query = uri.partition("?")
+        keepalive = version >= (1, 1) and headers.get("connection", "").lower() != "close"
+
+        if not path.startswith(TRACK_PATH):
+            # everything else is served by the wsgi app in a worker thread
+            self._poller.unregister(conn.sock.fileno())
+            self._connections.pop(conn.sock.fileno(), None)
+            self._wsgi_queue.put((conn, method, path, query, protocol, headers))
+        elif method not in ("GET", "HEAD"):
+            self._respond(conn, "405 Method Not Allowed", [], None, keepalive)
+        elif not self._track.is_allowed(conn.addr[0]):
+            self._respond(conn, "403 Forbidden", [], None, keepalive)
+        else:
+            status, response_headers, body = self._track.get_response(
+                unquote(path[len(TRACK_PATH):]), method, headers, version)
+            self._respond(conn, status, response_headers, body, keepalive)
+
+    def _respond(self, conn, status, headers, body, keepalive):
+        '''queue the status line and headers, the body is pulled from the generator when the socket is writable'''
+        header_keys = [key.lower() for key, _ in headers]
+        if "content-length" not in header_keys:
+            if body is not None and keepalive:
+                conn.chunked = True
+                headers.append(("Transfer-Encoding", "chunked"))
+            elif body is None:
+                headers.append(("Content-Length", "0"))
+            else:
+                keepalive = False
+        if ("connection", "close") in [(key.lower(), value.lower()) for key, value in headers]:
+            keepalive = False
+        elif not keepalive:
+            headers.append(("Connection", "close"))
+        conn.keepalive = keepalive
+        headers = headers + [("Date", formatdate(usegmt=True)), ("Server", SERVER_NAME)]
+        conn.outbuf = memoryview("HTTP/1.1 %s\r\n%s\r\n" % (
+            status, "".join(["%s: %s\r\n" % (key, value) for key, value in headers])))
+        conn.body = body if body is not None else iter([])
+        self._poller.register(conn.sock.fileno(), True)
+
+    def _write(self, conn):
+        '''send the next piece of the response'''
+        if conn.outbuf is None:
+            try:
+                chunk = next(conn.body)
+            except StopIteration:
+                chunk = None
+            if chunk is None:
+                self._finish(conn)
+                return
+            if not len(chunk):
+                # an empty chunk would end a chunked response
+                return
+            if conn.chunked:
+                chunk = "%x\r\n%s\r\n" % (len(chunk), chunk)
+            conn.outbuf = memoryview(chunk)
+        sent = conn.sock.send(conn.outbuf)
+        conn.last_activity = time.time()
+        conn.outbuf = conn.outbuf[sent:] if sent < len(conn.outbuf) else None
+
+    def _finish(self, conn):
+        '''the response is sent, wait for the next request or close the connection'''
+        if conn.chunked:
+            conn.chunked = False
+            conn.outbuf = memoryview("0\r\n\r\n")
+            conn.body = iter([])
+            return
+        conn.body = None
+        if not conn.keepalive:
+            self._close(conn)
+            return
+        self._poller.register(conn.sock.fileno(), False)
+        if conn.inbuf:
+            self._process(conn)
+
+    def _wsgi_worker(self):
+        '''serve the requests which are passed to the wsgi app, one connection at a time'''
+        while True:
+            item = self._wsgi_queue.get()
+            if item is None:
+                return
+            conn = item[0]
+            try:
+                # a client which stops sending or reading can't keep the worker forever
+                conn.sock.settimeout(IDLE_TIMEOUT)
+                self._serve_wsgi(*item)
+            except Exception as exc:
+                log_exception(__name__, exc)
+            finally:
+                try:
+                    conn.sock.close()
+                except socket.error:
+                    pass
+
+    def _serve_wsgi(self, conn, method, path, query, protocol, headers):
+        '''run the wsgi app for the request and write the response, the connection is closed afterwards'''
+        body = conn.inbuf
+        content_length = int(headers.get("content-length") or 0)
+        while len(body) < content_length:
+            data = conn.sock.recv(min(65536, content_length - len(body)))
+            if not data:
+                break
+            body += data
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.bind_addr[0],
+            "SERVER_PORT": str(self.bind_addr[1]),
+            "SERVER_PROTOCOL": protocol,
+            "ACTUAL_SERVER_PROTOCOL": "HTTP/1.1",
+            "REMOTE_ADDR": conn.addr[0],
+            "REMOTE_PORT": str(conn.addr[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": StringIO(body[:content_length]),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for key, value in headers.iteritems():
+            key = key.upper().replace("-", "_")
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[key] = value
+            else:
+                environ["HTTP_%s" % key] = value
+        response = {"headers_sent": False}
+
+        def write(chunk):
+            if not response["headers_sent"]:
+                # the connection is closed after the response so the length is known by the client anyway
+                headers = response["headers"] + [("Connection", "close")]
+                conn.sock.sendall("HTTP/1.1 %s\r\n%s\r\n" % (
+                    response["status"], "".join(["%s: %s\r\n" % (key, value) for key, value in headers])))
+                response["headers_sent"] = True
+            if chunk:
+                conn.sock.sendall(chunk)
+
+        def start_response(status, response_headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = [item for item in response_headers if item[0].lower() != "connection"]
+            return write
+
+        result = self._wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                write(chunk)
+            write("")
+        finally:
+            if hasattr(result, "close"):
+                result.close()
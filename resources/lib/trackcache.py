@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    trackcache.py
+    Two tier cache for the track details: bounded in-memory LRU in front of the persistent SimpleCache
+'''
+
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from simplecache import SimpleCache
+from utils import log_msg, json, ADDON_ID
+import xbmc
+import xbmcaddon
+
+MAX_ENTRIES_DEFAULT = 5000
+MAX_MB_DEFAULT = 20
+REMOTE_TTL_DEFAULT = 10
+PERSISTENT_EXPIRATION = timedelta(days=30)
+# key of the expiration (epoch) of a remote item in the persisted details
+EXPIRES_KEY = "_trackcache_expires"
+# log the cache statistics every x lookups
+STATS_LOG_INTERVAL = 1000
+
+
+class TrackCache(object):
+    '''cache for the track details with explicit size bounds and eviction'''
+
+    def __init__(self):
+        addon = xbmcaddon.Addon(id=ADDON_ID)
+        self.max_entries = int(addon.getSetting("trackcache_entries") or MAX_ENTRIES_DEFAULT)
+        self.max_bytes = int(addon.getSetting("trackcache_mb") or MAX_MB_DEFAULT) * 1024 * 1024
+        self.remote_ttl = timedelta(minutes=int(addon.getSetting("trackcache_remote_ttl") or REMOTE_TTL_DEFAULT))
+        del addon
+        self._mem = OrderedDict()  # key --> (checksum, expires, size, data)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._persistent = SimpleCache()
+        self.stats = {"hits": 0, "persistent_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key, checksum=None):
+        '''get the details from the memory tier or else the persistent tier, returns a copy'''
+        with self._lock:
+            entry = self._mem.pop(key, None)
+            if entry:
+                if entry[0] != checksum or (entry[1] and entry[1] < datetime.now()):
+                    # the track was updated on the server or the details expired
+                    self._bytes -= entry[2]
+                    self.stats["invalidations"] += 1
+                    entry = None
+                else:
+                    # most recently used items are kept at the end
+                    self._mem[key] = entry
+                    self.stats["hits"] += 1
+        if entry:
+            result = dict(entry[3])
+        else:
+            result = self._persistent.get(key, checksum=checksum)
+            with self._lock:
+                self.stats["persistent_hits" if result else "misses"] += 1
+            if result:
+                result = dict(result)
+                # remote items keep the expiration they got when they were stored
+                expires = result.pop(EXPIRES_KEY, None)
+                expires = datetime.fromtimestamp(expires) if expires else None
+                self._store_mem(key, result, checksum, expires)
+        if sum([self.stats["hits"], self.stats["persistent_hits"], self.stats["misses"]]) % STATS_LOG_INTERVAL == 0:
+            self.log_stats()
+        return result
+
+    def set(self, key, data, checksum=None, remote=False):
+        '''store the details in both tiers, remote (radio) items expire after the configured ttl'''
+        expiration = self.remote_ttl if remote else PERSISTENT_EXPIRATION
+        expires = datetime.now() + self.remote_ttl if remote else None
+        self._store_mem(key, data, checksum, expires)
+        if expires:
+            data = dict(data)
+            data[EXPIRES_KEY] = time.mktime(expires.timetuple())
+        self._persistent.set(key, data, checksum=checksum, expiration=expiration)
+
+    def _store_mem(self, key, data, checksum, expires):
+        '''store the details in the memory tier and evict the least recently used items if needed'''
+        size = len(json.dumps(data))
+        with self._lock:
+            entry = self._mem.pop(key, None)
+            if entry:
+                self._bytes -= entry[2]
+            self._mem[key] = (checksum, expires, size, dict(data))
+            self._bytes += size
+            while self._mem and (len(self._mem) > self.max_entries or self._bytes > self.max_bytes):
+                evicted = self._mem.popitem(last=False)[1]
+                self._bytes -= evicted[2]
+                self.stats["evictions"] += 1
+
+    def log_stats(self):
+        '''write the cache statistics to the kodi log'''
+        log_msg("Track cache stats: %s - %s entries, %s bytes in memory" %
+                (self.stats, len(self._mem), self._bytes), xbmc.LOGDEBUG)
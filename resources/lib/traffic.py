@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    plugin.audio.squeezebox
+    Squeezelite Player for Kodi
+    traffic.py
+    Recording of the json-rpc requests to the server with their responses and timing, and the offline replay
+'''
+
+import os
+import sys
+import gzip
+import time
+import threading
+from collections import deque
+from utils import log_msg, log_exception, json, get_profile_path
+import xbmc
+
+RECORDINGS_DIR = "recordings"
+RECORDING_VERSION = 1
+# number of most recent recordings which are kept
+MAX_RECORDINGS = 20
+
+
+def request_key(params):
+    '''the request without the json-rpc id and the player id, a recording can be replayed for another player'''
+    if not isinstance(params, list):
+        params = [params]
+    commands = []
+    for request in params:
+        try:
+            commands.append(request["params"][1])
+        except (TypeError, KeyError, IndexError):
+            commands.append(request)
+    return json.dumps(commands, sort_keys=True)
+
+
+class TrafficRecorder(object):
+    '''writes the requests to the server with the response and the duration to a gzipped json lines file'''
+
+    def __init__(self, name="plugin", path=None):
+        if not path:
+            path = get_profile_path(RECORDINGS_DIR)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.prune(path, MAX_RECORDINGS - 1)
+            filename = "%s_%s.jsonl.gz" % (name, time.strftime("%Y%m%d-%H%M%S"))
+            count = 1
+            while os.path.exists(os.path.join(path, filename)):
+                count += 1
+                filename = "%s_%s-%s.jsonl.gz" % (name, time.strftime("%Y%m%d-%H%M%S"), count)
+            path = os.path.join(path, filename)
+        self.path = path
+        self.count = 0
+        self._start = time.time()
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, "wb")
+        # the plugin invocation is needed to rerun the session
+        self._write({"version": RECORDING_VERSION, "argv": sys.argv, "time": int(self._start)})
+        log_msg("Recording the server traffic to %s" % path, xbmc.LOGNOTICE)
+
+    @staticmethod
+    def prune(path, keep):
+        '''remove the oldest recordings in the folder so at most keep recordings are left'''
+        recordings = sorted([os.path.join(path, filename) for filename in os.listdir(path)
+                             if filename.endswith(".jsonl.gz")], key=os.path.getmtime)
+        for filepath in recordings[:max(len(recordings) - keep, 0)]:
+            try:
+                os.remove(filepath)
+            except OSError as exc:
+                log_exception(__name__, exc)
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def record(self, params, response, seconds):
+        '''add a request with its response and the duration'''
+        entry = {"t": round(time.time() - seconds - self._start, 3), "ms": round(seconds * 1000, 1),
+                 "req": params, "res": response}
+        with self._lock:
+            if self._file:
+                self._write(entry)
+                self.count += 1
+
+    def close(self):
+        '''finish the recording'''
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+        log_msg("Recorded %s requests to %s" % (self.count, self.path), xbmc.LOGNOTICE)
+
+
+class TrafficReplay(object):
+    '''serves the responses of a recording instead of the server, identical requests get the responses in the
+       recorded order (the last one is repeated), with realtime the recorded duration is waited for'''
+
+    def __init__(self, path, realtime=False):
+        self.path = path
+        self.realtime = realtime
+        self.header = {}
+        self.entries = []
+        self._responses = {}  # request key --> deque with the (response, seconds) in the recorded order
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+        self._load()
+
+    def _load(self):
+        '''read the recording, a recording of a session which was killed can be truncated'''
+        lines = []
+        try:
+            with gzip.open(self.path, "rb") as recording:
+                for line in recording:
+                    lines.append(line)
+        except (IOError, EOFError) as exc:
+            log_exception(__name__, exc)
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            if "req" not in entry:
+                self.header = entry
+                continue
+            self.entries.append(entry)
+            self._responses.setdefault(request_key(entry["req"]), deque()).append(
+                (entry["res"], entry["ms"] / 1000.0))
+
+    @property
+    def recorded_seconds(self):
+        '''the total time the server needed for the recorded requests'''
+        return sum(entry["ms"] for entry in self.entries) / 1000.0
+
+    def response(self, params):
+        '''the recorded response for the request, an empty response if the request wasn't recorded'''
+        with self._lock:
+            responses = self._responses.get(request_key(params))
+            if not responses:
+                self.stats["misses"] += 1
+                log_msg("Request not in the recording: %s" % params, xbmc.LOGWARNING)
+                return {}
+            self.stats["hits"] += 1
+            response, seconds = responses.popleft() if len(responses) > 1 else responses[0]
+        if self.realtime:
+            time.sleep(seconds)
+        # the caller can modify the result
+        return json.loads(json.dumps(response))
@@ -35,6 +35,17 @@ try:
 except Exception:
     SUPPORTS_POOL = False
 
+# size of the threadpool used to process lists (and of our http connection pool)
+try:
+    from multiprocessing import cpu_count
+    THREADPOOL_SIZE = cpu_count()
+except Exception:
+    THREADPOOL_SIZE = 4
+
+# max time to wait for kodi to detect the mac address and the interval to check it
+MAC_WAIT_SECONDS = 360
+MAC_POLL_INTERVAL = 0.1
+
 
 def log_msg(msg, loglevel=xbmc.LOGNOTICE):
     '''log message to kodi log'''
@@ -49,23 +60,36 @@ def log_exception(modulename, exceptiondetails):
     log_msg("Exception in %s ! --> %s" % (modulename, exceptiondetails), xbmc.LOGWARNING)
 
 
+def get_profile_path(filename=""):
+    '''get the (translated) path to a file in the addon profile directory, creates the directory if needed'''
+    addon = xbmcaddon.Addon(id=ADDON_ID)
+    profile_dir = xbmc.translatePath(addon.getAddonInfo("profile")).decode("utf-8")
+    del addon
+    if not xbmcvfs.exists(profile_dir):
+        xbmcvfs.mkdirs(profile_dir)
+    return os.path.join(profile_dir, filename)
+
+
 def get_mac():
     '''helper to obtain the mac address of the kodi machine'''
     count = 0
-    mac = ""
+    mac = xbmc.getInfoLabel("Network.MacAddress").lower()
     monitor = xbmc.Monitor()
-    while ":" not in mac and count < 360 and not monitor.abortRequested():
+    if ":" not in mac:
         log_msg("Waiting for mac address...")
-        mac = xbmc.getInfoLabel("Network.MacAddress").lower()
+    # the infolabel is filled in async by kodi, poll it often to not delay the startup
+    while ":" not in mac and count < MAC_WAIT_SECONDS / MAC_POLL_INTERVAL and not monitor.abortRequested():
         count += 1
-        monitor.waitForAbort(1)
+        monitor.waitForAbort(MAC_POLL_INTERVAL)
+        mac = xbmc.getInfoLabel("Network.MacAddress").lower()
     del monitor
-    if not mac:
+    if ":" not in mac:
         log_msg("Mac detection failed!")
+        mac = ""
     else:
         log_msg("Detected Mac-Address: %s" % mac)
     return mac
-    
+
 def get_squeezelite_binary():
     '''find the correct squeezelite binary belonging to the platform'''
     sl_binary = ""
@@ -123,15 +147,7 @@ def get_audiodevice(sl_binary):
     del addon
     if user_device and user_device != "auto":
         return user_device
-    
-    args = [sl_binary, "-l"]
-    startupinfo = None
-    if xbmc.getCondVisibility("System.Platform.Windows"):
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess._subprocess.STARTF_USESHOWWINDOW
-    sl_exec = subprocess.Popen(args, startupinfo=startupinfo, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-    stdout, stderr = sl_exec.communicate()
-    for line in get_audiodevices():
+    for line in get_audiodevices(sl_binary):
         if "default" in line:
             return line.split("-")[0].strip()
     return "default"
@@ -140,7 +156,7 @@ def process_method_on_list(method_to_run, items):
     '''helper method that processes a method on each listitem with pooling if the system supports it'''
     all_items = []
     if SUPPORTS_POOL:
-        pool = ThreadPool()
+        pool = ThreadPool(THREADPOOL_SIZE)
         try:
             all_items = pool.map(method_to_run, items)
         except Exception:
@@ -11,21 +11,14 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), "resources", "lib"))
 
 from main_service import MainService
-from httpproxy import ProxyRunner
 from utils import log_msg
 import xbmc
 
 kodimonitor = xbmc.Monitor()
 
 
-# start the webservice (which hosts our silenced audio tracks)
-proxy_runner = ProxyRunner(host='127.0.0.1', allow_ranges=True)
-proxy_runner.start()
-webport = proxy_runner.get_port()
-log_msg('started webproxy at port {0}'.format(webport))
-
-# run the main background service
-main = MainService(kodimonitor=kodimonitor, webport=webport)
+# run the main background service (which also hosts our silenced audio tracks)
+main = MainService(kodimonitor=kodimonitor)
 main.start()
 
 # keep thread alive and send signal when we need to exit
@@ -35,5 +28,4 @@ while not kodimonitor.waitForAbort(10):
 # stop requested
 log_msg("Abort requested !", xbmc.LOGNOTICE)
 main.stop()
-proxy_runner.stop()
 log_msg("Stopped", xbmc.LOGNOTICE)